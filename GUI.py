@@ -4,6 +4,9 @@ import tkinter as tk
 from tkinter import ttk, messagebox, simpledialog
 from ds_messenger import DirectMessenger
 
+POLL_MS = 2000  # how often to ask the server for new messages without a subscription
+EVENT_MS = 200  # how often to drain messages pushed by the server
+
 class Body(tk.Frame):
     """Main body frame for contacts and message editors."""
 
@@ -178,7 +181,7 @@ class MainApp(tk.Frame):
         self.direct_messenger = DirectMessenger(self.server, self.username, self.password)
         self._draw()
         self.configure_server()
-        self.root.after(2000, self.check_new)
+        self.root.after(POLL_MS, self.check_new)
 
     def send_message(self):
         """Send a message to the recipient."""
@@ -229,6 +232,9 @@ class MainApp(tk.Frame):
         # FIXME
         for contact in self.direct_messenger.notebook.contacts:
             self.body.insert_contact(contact)
+        # have new messages pushed instead of polling, if the server supports it
+        if self.direct_messenger.token:
+            self.direct_messenger.subscribe()
 
     def _publish(self, messages: list):
         """Publish new messages to the contact list and entry editor."""
@@ -244,9 +250,17 @@ class MainApp(tk.Frame):
                 self.direct_messenger.notebook_path, self.recipient, msg)
 
     def check_new(self):
-        """Check for new messages from the server and publish them."""
+        """Check for new messages from the server and publish them.
+
+        With a subscription this only drains the messages the server
+        already pushed; otherwise it polls the server.
+        """
         try:
-            new_msg = self.direct_messenger.retrieve_new()
+            subscribed = self.direct_messenger.subscribed
+            if subscribed:
+                new_msg = self.direct_messenger.pending_events()
+            else:
+                new_msg = self.direct_messenger.retrieve_new()
             for msg in new_msg:
                 if msg.from_name not in self.body.contacts:
                     self.body.insert_contact(msg.from_name)
@@ -254,7 +268,7 @@ class MainApp(tk.Frame):
                         self.direct_messenger.notebook_path, msg.from_name, msg)
             if new_msg:
                 self._publish(new_msg)
-            self.root.after(2000, self.check_new)
+            self.root.after(EVENT_MS if subscribed else POLL_MS, self.check_new)
         except ConnectionError as error:
             messagebox.showerror("Connection Error", str(error))
 
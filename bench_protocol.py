@@ -0,0 +1,155 @@
+"""
+Codec benchmark for ds_protocol.
+
+Times the request builders (auth_request, direct_message_request and
+fetch_request) per call, and extract_json on fetch responses of --sizes
+messages. Half of those messages are received and half sent, as in a
+conversation. extract_json is also compared with the earlier two-pass
+conversion, kept here as a frozen reference (two_pass), and
+json.loads alone is timed to show how much is parsing and how much is
+building records.
+
+    python bench_protocol.py --sizes 1,100,10000,1000000 --output codec.json
+    python bench_protocol.py --baseline codec.json    # flag regressions
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+from ds_protocol import (
+    auth_request,
+    direct_message_request,
+    fetch_request,
+    extract_json,
+    MessageReceived,
+    MessageSent
+)
+
+SIZES = [1, 10, 100, 1000, 10000, 100000, 1000000]
+MIN_SECONDS = 0.2  # each measurement repeats until it has run this long
+ROUNDS = 3  # measurements per benchmark; the fastest is kept
+TOLERANCE = 0.10  # relative slowdown reported as a regression
+
+
+def fetch_response(size: int) -> str:
+    """A fetch response holding size messages, alternating received and sent."""
+    messages = []
+    for index in range(size):
+        message = {'id': index + 1, 'message': f'message number {index}',
+                   'timestamp': 1700000000.0 + index}
+        if index % 2:
+            message['recipient'] = 'bob'
+        else:
+            message['from'] = 'alice'
+        messages.append(message)
+    return json.dumps({'response': {'type': 'ok', 'messages': messages}})
+
+
+def two_pass(json_msg: str) -> list:
+    """The conversion extract_json used to do: received first, then sent.
+
+    Frozen copy of the old _extract_messages_received and
+    _extract_messages_sent; keep it as is so results stay comparable."""
+    json_obj = json.loads(json_msg)
+    received = []
+    for msg in json_obj['response']['messages']:
+        if 'from' in msg:
+            received.append(MessageReceived(
+                msg['message'], msg['from'], msg['timestamp'], msg.get('status'), msg.get('id')))
+    sent = []
+    for msg in json_obj['response']['messages']:
+        if 'recipient' in msg:
+            sent.append(MessageSent(
+                msg['message'], msg['recipient'], msg['timestamp'], msg.get('status'),
+                msg.get('id')))
+    return received + sent
+
+
+def measure(call) -> float:
+    """Seconds per call of call, the fastest of ROUNDS measurements."""
+    calls = 1
+    while True:
+        before = time.perf_counter()
+        for _ in range(calls):
+            call()
+        elapsed = time.perf_counter() - before
+        if elapsed >= MIN_SECONDS / ROUNDS or calls >= 1 << 20:
+            break
+        calls *= 2
+    best = elapsed / calls
+    for _ in range(ROUNDS - 1):
+        before = time.perf_counter()
+        for _ in range(calls):
+            call()
+        best = min(best, (time.perf_counter() - before) / calls)
+    return best
+
+
+def run(sizes: list) -> list:
+    """Return a row per benchmark: name, size and microseconds per call."""
+    rows = [
+        {'name': 'auth_request', 'size': 0,
+         'us': 1e6 * measure(lambda: auth_request('alice', 'password'))},
+        {'name': 'direct_message_request', 'size': 0,
+         'us': 1e6 * measure(lambda: direct_message_request(
+             'token', 'bob', 'hello there', 1700000000.0))},
+        {'name': 'fetch_request', 'size': 0,
+         'us': 1e6 * measure(lambda: fetch_request('token', 'unread'))}]
+    for size in sizes:
+        print(f'size={size} ...', file=sys.stderr)
+        response = fetch_response(size)
+        for name, call in (('json.loads', json.loads),
+                           ('extract_json', extract_json),
+                           ('two_pass', two_pass)):
+            rows.append({'name': name, 'size': size,
+                         'us': 1e6 * measure(lambda: call(response))})
+    return rows
+
+
+def compare(rows: list, baseline: dict, tolerance: float) -> list:
+    """Return a line per benchmark slower than in baseline by more than tolerance."""
+    previous = {(row['name'], row['size']): row['us'] for row in baseline['rows']}
+    return [f"{row['name']} size={row['size']}: {previous[key]:.2f} -> {row['us']:.2f} us"
+            for row in rows
+            for key in [(row['name'], row['size'])]
+            if key in previous and row['us'] > previous[key] * (1 + tolerance)]
+
+
+def print_rows(rows: list) -> None:
+    print(f"{'benchmark':<24} {'messages':>9} {'us/call':>14} {'ns/message':>11}")
+    for row in rows:
+        per_message = f"{1000 * row['us'] / row['size']:11.1f}" if row['size'] else ''
+        print(f"{row['name']:<24} {row['size']:>9} {row['us']:>14.2f} {per_message}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the ds_protocol codec')
+    parser.add_argument('--sizes', type=lambda text: [int(v) for v in text.split(',')],
+                        default=SIZES,
+                        help='comma separated response sizes, in messages '
+                             f'(default {",".join(map(str, SIZES))})')
+    parser.add_argument('--output', type=argparse.FileType('w'),
+                        help='write the results as JSON')
+    parser.add_argument('--baseline', type=argparse.FileType('r'),
+                        help='results JSON of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help=f'relative slowdown reported as a regression (default {TOLERANCE})')
+    options = parser.parse_args(argv)
+
+    rows = run(options.sizes)
+    print_rows(rows)
+    if options.output:
+        json.dump({'python': platform.python_version(), 'rows': rows},
+                  options.output, indent=2)
+    if options.baseline:
+        regressions = compare(rows, json.load(options.baseline), options.tolerance)
+        for line in regressions:
+            print(f'REGRESSION {line}')
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,400 @@
+"""
+Load generator and benchmark for server.py.
+
+Each scenario starts server.py on a free localhost port, in a temporary
+directory so it gets a fresh store/. It preloads every user's history
+(already read), then runs simulated clients that replay a weighted mix of
+requests built with the ds_protocol helpers:
+
+    auth          connect, authenticate and disconnect
+    send          one direct message to a random user
+    fetch_unread  fetch new messages, acknowledging the previous batch
+    fetch_all     fetch the whole history
+
+An auth the server turns away as busy is timed as "refused" instead, so
+the auth latencies only cover logins that were served.
+
+Scenarios are every combination of --users, --clients (concurrent
+connections; several may share a user) and --history. Throughput and
+p50/p95/p99 latency per request kind are printed, written as JSON with
+--output, and compared against an earlier --output with --baseline.
+
+    python bench_server.py --users 10 --clients 1,16,64 --history 0,1000 \\
+        --output before.json
+    python bench_server.py --users 10 --clients 1,16,64 --history 0,1000 \\
+        --baseline before.json
+
+Clients run as threads spread over --procs processes, so the client side
+does not share one interpreter lock with itself or with the server.
+A request that fails, or takes longer than CLIENT_TIMEOUT seconds, counts
+as an error; so does every request of a client that cannot log in.
+"""
+
+import argparse
+import json
+import math
+import multiprocessing
+import platform
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from itertools import product
+from pathlib import Path
+from ds_protocol import (
+    auth_request,
+    direct_message_request,
+    direct_message_batch_request,
+    fetch_request,
+    ack_request,
+    stats_request,
+    extract_json,
+    read_message
+)
+from server import BUSY_REPLY
+
+SERVER_PATH = Path(__file__).resolve().parent / 'server.py'
+OPS = ('auth', 'send', 'fetch_unread', 'fetch_all')
+REFUSED = 'refused'  # kind under which connections turned away as busy are timed
+DEFAULT_MIX = 'send=4,fetch_unread=4,fetch_all=1,auth=1'
+PASSWORD = 'bench'
+PRELOAD_BATCH = 1000  # messages per batch directmessage while preloading
+STARTUP_TIMEOUT = 10  # seconds to wait for the server to listen
+CLIENT_TIMEOUT = 30  # seconds a request may take before it counts as an error
+TOLERANCE = 0.10  # relative change reported as a regression
+
+
+class ServerBusy(ConnectionError):
+    """The server turned a new connection away with BUSY_REPLY."""
+
+
+class BenchClient:
+    """One connection to the server, authenticated as username."""
+
+    def __init__(self, port: int, username: str):
+        self.port = port
+        self.username = username
+        self.token, self.sock, self.send_file, self.recv = self._login()
+        self.acked = 0  # newest message id acknowledged
+        self.unacked = 0  # newest message id fetched but not acknowledged
+
+    def _login(self):
+        sock = socket.create_connection(('127.0.0.1', self.port), timeout=CLIENT_TIMEOUT)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        send_file = sock.makefile('wb')
+        recv = sock.makefile('rb')
+        send_file.write(auth_request(self.username, PASSWORD).encode() + b'\r\n')
+        send_file.flush()
+        line = read_message(recv)
+        if line == BUSY_REPLY.decode():
+            sock.close()
+            raise ServerBusy(f'Server busy, {self.username} was turned away')
+        response = extract_json(line)
+        if not response or response.type != 'ok':
+            sock.close()
+            raise ConnectionError(f'Authentication of {self.username} failed')
+        return response.token, sock, send_file, recv
+
+    def call(self, *requests):
+        """Write requests in one go and return their parsed responses."""
+        self.send_file.write(b''.join(request.encode() + b'\r\n' for request in requests))
+        self.send_file.flush()
+        return [extract_json(read_message(self.recv)) for _ in requests]
+
+    def auth(self, rng, users) -> bool:
+        _, sock, _, _ = self._login()
+        sock.close()
+        return True
+
+    def send(self, rng, users) -> bool:
+        recipient = rng.choice(users)
+        response, = self.call(direct_message_request(
+            self.token, recipient, f'bench message from {self.username}', time.time()))
+        return response.type == 'ok'
+
+    def fetch_unread(self, rng, users) -> bool:
+        requests = [fetch_request(self.token, 'unread')]
+        if self.unacked > self.acked:
+            requests.insert(0, ack_request(self.token, upto=self.unacked))
+        *acks, response = self.call(*requests)
+        if acks and acks[0].type == 'ok':
+            self.acked = self.unacked
+        ids = [message.id for message in response.message or () if message.id]
+        self.unacked = max(ids, default=self.unacked)
+        return response.type == 'ok'
+
+    def fetch_all(self, rng, users) -> bool:
+        response, = self.call(fetch_request(self.token, 'all'))
+        return response.type == 'ok'
+
+    def close(self):
+        self.sock.close()
+
+
+def parse_mix(text: str) -> dict:
+    """Parse 'send=4,fetch_all=1' into {'send': 4, 'fetch_all': 1}."""
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in OPS:
+            raise ValueError(f'Unknown request kind {name!r}; choose from {", ".join(OPS)}')
+        mix[name] = float(weight or 1)
+    if not any(mix.values()):
+        raise ValueError('The mix needs a positive weight')
+    return mix
+
+
+def _counts(text: str) -> list:
+    return [int(value) for value in text.split(',')]
+
+
+def percentile(ordered: list, fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not ordered:
+        return None
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(workdir: Path, port: int, storage: str, mode: str) -> subprocess.Popen:
+    """Start server.py in workdir and wait until it accepts connections."""
+    log = open(workdir / 'server.log', 'wb')
+    process = subprocess.Popen(
+        [sys.executable, str(SERVER_PATH), str(port), '--storage', storage,
+         '--mode', mode, '--log-level', 'WARNING'],
+        cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'server.py exited; see {workdir / "server.log"}')
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError('server.py did not start listening')
+
+
+def stop_server(process: subprocess.Popen) -> None:
+    """Interrupt the server so it shuts down cleanly, killing it if it hangs."""
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def preload(port: int, users: list, history: int) -> None:
+    """Give every user history messages and mark them read."""
+    for user in users:
+        client = BenchClient(port, user)
+        peer = users[(users.index(user) + 1) % len(users)]
+        for start in range(0, history, PRELOAD_BATCH):
+            count = min(PRELOAD_BATCH, history - start)
+            client.call(direct_message_batch_request(
+                client.token, [(peer, f'history {start + i}') for i in range(count)],
+                time.time()))
+        client.close()
+    for user in users:
+        client = BenchClient(port, user)
+        client.fetch_unread(None, users)
+        client.fetch_unread(None, users)  # acknowledges what the first returned
+        client.close()
+
+
+def run_clients(port: int, assignments: list, users: list, mix: dict, requests: int) -> dict:
+    """Run one thread per (username, seed) assignment; return their merged samples."""
+    results = [None] * len(assignments)
+
+    def run(index, username, seed):
+        rng = random.Random(seed)
+        kinds = rng.choices(list(mix), weights=list(mix.values()), k=requests)
+        samples = {kind: [] for kind in (*mix, REFUSED)}
+        started = time.time()
+        try:
+            client = BenchClient(port, username)
+        except Exception as exc:
+            # every request of a client that cannot log in fails
+            print(f'client {index} ({username}): {exc!r}', file=sys.stderr)
+            results[index] = (samples, len(kinds), started, time.time())
+            return
+        errors = 0
+        for kind in kinds:
+            before = time.perf_counter()
+            try:
+                ok = getattr(client, kind)(rng, users)
+            except ServerBusy:
+                kind, ok = REFUSED, False
+            except Exception:
+                ok = False
+            samples[kind].append(time.perf_counter() - before)
+            errors += not ok
+        finished = time.time()
+        client.close()
+        results[index] = (samples, errors, started, finished)
+
+    threads = [threading.Thread(target=run, args=(index, username, seed))
+               for index, (username, seed) in enumerate(assignments)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    merged = {kind: [] for kind in (*mix, REFUSED)}
+    for samples, _, _, _ in results:
+        for kind, values in samples.items():
+            merged[kind].extend(values)
+    return {
+        'samples': merged,
+        'errors': sum(result[1] for result in results),
+        'started': min(result[2] for result in results),
+        'finished': max(result[3] for result in results)}
+
+
+def _run_group(args):
+    return run_clients(*args)
+
+
+def run_scenario(users: int, clients: int, history: int, options) -> dict:
+    """Benchmark one combination of user count, concurrency and history size."""
+    names = [f'bench{i}' for i in range(users)]
+    mix = parse_mix(options.mix)
+    with tempfile.TemporaryDirectory() as workdir:
+        port = free_port()
+        server = start_server(Path(workdir), port, options.storage, options.mode)
+        try:
+            preload(port, names, history)
+            assignments = [(names[i % users], options.seed + i) for i in range(clients)]
+            procs = max(1, min(options.procs, clients))
+            groups = [(port, assignments[i::procs], names, mix, options.requests)
+                      for i in range(procs)]
+            with multiprocessing.Pool(procs) as pool:
+                parts = pool.map(_run_group, groups)
+            probe = BenchClient(port, names[0])
+            server_stats = probe.call(stats_request(probe.token))[0].stats
+            probe.close()
+        finally:
+            stop_server(server)
+
+    seconds = max(part['finished'] for part in parts) - min(part['started'] for part in parts)
+    latency = {}
+    total = 0
+    for kind in (*mix, REFUSED):
+        ordered = sorted(value for part in parts for value in part['samples'][kind])
+        total += len(ordered)
+        if ordered:
+            latency[kind] = {
+                'count': len(ordered),
+                'mean_ms': 1000 * sum(ordered) / len(ordered),
+                'p50_ms': 1000 * percentile(ordered, 0.50),
+                'p95_ms': 1000 * percentile(ordered, 0.95),
+                'p99_ms': 1000 * percentile(ordered, 0.99)}
+    return {
+        'users': users,
+        'clients': clients,
+        'history': history,
+        'requests': total,
+        'errors': sum(part['errors'] for part in parts),
+        'seconds': seconds,
+        'throughput': total / seconds if seconds else 0,
+        'latency': latency,
+        'server_stats': server_stats}
+
+
+def _key(result: dict, meta: dict) -> tuple:
+    return (meta['mode'], meta['storage'], meta['mix'],
+            result['users'], result['clients'], result['history'])
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    """Return a line per scenario that got slower than baseline by more than tolerance."""
+    previous = {_key(result, baseline['meta']): result for result in baseline['results']}
+    regressions = []
+    for result in report['results']:
+        before = previous.get(_key(result, report['meta']))
+        if before is None:
+            continue
+        scenario = f"users={result['users']} clients={result['clients']} history={result['history']}"
+        if result['throughput'] < before['throughput'] * (1 - tolerance):
+            regressions.append(
+                f"{scenario}: throughput {before['throughput']:.0f} -> {result['throughput']:.0f} req/s")
+        for kind, now in result['latency'].items():
+            was = before['latency'].get(kind)
+            if was and now['p95_ms'] > was['p95_ms'] * (1 + tolerance):
+                regressions.append(
+                    f"{scenario}: {kind} p95 {was['p95_ms']:.2f} -> {now['p95_ms']:.2f} ms")
+    return regressions
+
+
+def print_result(result: dict) -> None:
+    print(f"users={result['users']:<5} clients={result['clients']:<5} "
+          f"history={result['history']:<7} {result['throughput']:9.0f} req/s  "
+          f"errors={result['errors']}")
+    for kind, stats in result['latency'].items():
+        print(f"    {kind:<13} n={stats['count']:<7} p50={stats['p50_ms']:7.2f}  "
+              f"p95={stats['p95_ms']:7.2f}  p99={stats['p99_ms']:7.2f} ms")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark server.py under load')
+    parser.add_argument('--users', type=_counts, default=[10],
+                        help='comma separated user counts (default 10)')
+    parser.add_argument('--clients', type=_counts, default=[1, 8, 32],
+                        help='comma separated concurrent client counts (default 1,8,32)')
+    parser.add_argument('--history', type=_counts, default=[0, 1000],
+                        help='comma separated messages preloaded per user (default 0,1000)')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests each client makes (default 200)')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help=f'weights of {", ".join(OPS)} (default {DEFAULT_MIX})')
+    parser.add_argument('--storage', default='json', help='server --storage')
+    parser.add_argument('--mode', default='threaded', help='server --mode')
+    parser.add_argument('--procs', type=int, default=multiprocessing.cpu_count(),
+                        help='client processes (default: one per CPU)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=Path, help='write the results as JSON')
+    parser.add_argument('--baseline', type=Path,
+                        help='results JSON of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help=f'relative slowdown reported as a regression (default {TOLERANCE})')
+    options = parser.parse_args(argv)
+    parse_mix(options.mix)
+
+    report = {
+        'meta': {
+            'mode': options.mode,
+            'storage': options.storage,
+            'mix': options.mix,
+            'requests_per_client': options.requests,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.time()},
+        'results': []}
+    for users, clients, history in product(options.users, options.clients, options.history):
+        result = run_scenario(users, clients, history, options)
+        print_result(result)
+        report['results'].append(result)
+
+    if options.output:
+        options.output.write_text(json.dumps(report, indent=2))
+    if options.baseline:
+        regressions = compare(report, json.loads(options.baseline.read_text()), options.tolerance)
+        for line in regressions:
+            print(f'REGRESSION {line}')
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,217 @@
+"""
+Storage-layer microbenchmarks for server.py.
+
+For every combination of --users and --messages, a synthetic users.json
+holding that many users and messages is written to a temporary store.
+The store is opened with the chosen backend, and these DSUServer wrappers
+are called directly, with no sockets involved:
+
+    create_user   _get_or_create_new_user for a new user
+    login         _get_or_create_new_user for an existing user
+    send          _send_message between two random users
+    read_all      _read_all_messages of a random user
+    read_unread   _read_unread_messages of a random user
+
+Opening the store is measured too (load). Each operation is first timed
+without tracing. A second pass measures its peak memory with tracemalloc,
+which would otherwise slow the timings down. The results are printed as
+one scaling curve per operation, and written with --output (JSON) or
+--csv for plotting.
+
+    python bench_storage.py --users 10,1000,100000 --messages 10,10000,1000000
+"""
+
+import argparse
+import csv
+import json
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from itertools import product
+from pathlib import Path
+from server import DSUServer, STORAGE_BACKENDS
+from ds_storage import USERS_PATH, _new_user, migrate_json_to_sqlite
+
+OPERATIONS = ('create_user', 'login', 'send', 'read_all', 'read_unread')
+UNREAD_FRACTION = 0.1  # share of received messages left unread in the synthetic store
+REPEAT = 200  # calls per operation, unless BUDGET runs out first
+BUDGET = 5.0  # seconds an operation may take in total
+MIN_REPEAT = 3
+
+
+def build_store(store_dir: Path, users: int, messages: int, seed: int = 0) -> None:
+    """Write a users.json with users users and messages messages between them."""
+    rng = random.Random(seed)
+    names = [f'user{i}' for i in range(users)]
+    records = {name: _new_user('pw') for name in names}
+    started = time.time() - messages
+    for index in range(messages):
+        sender = rng.randrange(users)
+        recipient = rng.randrange(users - 1) if users > 1 else 0
+        if users > 1 and recipient >= sender:
+            recipient += 1
+        entry = f'synthetic message {index}'
+        timestamp = started + index
+        records[names[sender]]['messages'].append(
+            {'message': entry, 'recipient': names[recipient],
+             'timestamp': timestamp, 'status': 'sent'})
+        records[names[recipient]]['messages'].append(
+            {'message': entry, 'from': names[sender], 'timestamp': timestamp,
+             'status': 'unread' if rng.random() < UNREAD_FRACTION else 'read'})
+    store_dir.mkdir(parents=True, exist_ok=True)
+    with (store_dir / USERS_PATH).open('w') as users_file:
+        json.dump(records, users_file)
+
+
+def open_storage(store_dir: Path, storage: str):
+    """Open the synthetic store with the given backend."""
+    if storage == 'sqlite':
+        migrate_json_to_sqlite(store_dir)
+    return STORAGE_BACKENDS[storage](store_dir)
+
+
+def _calls(operation: str, server: DSUServer, users: int, rng: random.Random):
+    """Return a function making one call of operation with fresh random arguments."""
+    names = [f'user{i}' for i in range(users)]
+    created = iter(range(sys.maxsize))
+    if operation == 'create_user':
+        return lambda: server._get_or_create_new_user(f'new{next(created)}', 'pw')
+    if operation == 'login':
+        return lambda: server._get_or_create_new_user(rng.choice(names), 'pw')
+    if operation == 'send':
+        return lambda: server._send_message('benchmark message', *rng.sample(names, 2))
+    if operation == 'read_all':
+        return lambda: server._read_all_messages(rng.choice(names))
+    return lambda: server._read_unread_messages(rng.choice(names))
+
+
+def time_operation(call, repeat: int, budget: float) -> list:
+    """Call call up to repeat times, or until budget seconds pass; return the durations."""
+    durations = []
+    deadline = time.perf_counter() + budget
+    while len(durations) < repeat and (
+            len(durations) < MIN_REPEAT or time.perf_counter() < deadline):
+        before = time.perf_counter()
+        call()
+        durations.append(time.perf_counter() - before)
+    return durations
+
+
+def peak_memory(call, count: int) -> int:
+    """Largest extra memory, in bytes, held during any of count calls."""
+    peak = 0
+    for _ in range(count):
+        baseline = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        call()
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - baseline)
+    return peak
+
+
+def run_scenario(users: int, messages: int, options) -> list:
+    """Benchmark every operation on one synthetic store; return a row per operation."""
+    workdir = Path(tempfile.mkdtemp())
+    rows = []
+    try:
+        build_store(workdir, users, messages, options.seed)
+        tracemalloc.start()
+        before = time.perf_counter()
+        storage = open_storage(workdir, options.storage)
+        load_seconds = time.perf_counter() - before
+        load_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        rows.append(_row(users, messages, 'load', [load_seconds], load_peak))
+
+        server = DSUServer(storage=storage)
+        for operation in options.operations:
+            rng = random.Random(options.seed)
+            durations = time_operation(
+                _calls(operation, server, users, rng), options.repeat, options.budget)
+            tracemalloc.start()
+            peak = peak_memory(
+                _calls(operation, server, users, rng), min(len(durations), MIN_REPEAT * 3))
+            tracemalloc.stop()
+            rows.append(_row(users, messages, operation, durations, peak))
+        storage.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return rows
+
+
+def _row(users: int, messages: int, operation: str, durations: list, peak: int) -> dict:
+    ordered = sorted(durations)
+    return {
+        'users': users,
+        'messages': messages,
+        'operation': operation,
+        'calls': len(ordered),
+        'mean_us': 1e6 * sum(ordered) / len(ordered),
+        'p50_us': 1e6 * ordered[len(ordered) // 2],
+        'p95_us': 1e6 * ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))],
+        'peak_kib': peak / 1024}
+
+
+def print_curves(rows: list) -> None:
+    """Print, per operation, mean time and peak memory against store size."""
+    for operation in ('load',) + OPERATIONS:
+        curve = [row for row in rows if row['operation'] == operation]
+        if not curve:
+            continue
+        print(f'\n{operation}')
+        print(f"  {'users':>8} {'messages':>9} {'mean us':>12} {'p95 us':>12} {'peak KiB':>10}")
+        for row in curve:
+            print(f"  {row['users']:>8} {row['messages']:>9} {row['mean_us']:>12.1f} "
+                  f"{row['p95_us']:>12.1f} {row['peak_kib']:>10.1f}")
+
+
+def _counts(text: str) -> list:
+    return [int(value) for value in text.split(',')]
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the server storage layer')
+    parser.add_argument('--users', type=_counts, default=[10, 1000],
+                        help='comma separated user counts (default 10,1000)')
+    parser.add_argument('--messages', type=_counts, default=[10, 10000, 100000],
+                        help='comma separated message counts (default 10,10000,100000)')
+    parser.add_argument('--storage', choices=sorted(STORAGE_BACKENDS), default='json')
+    parser.add_argument('--operations', type=lambda text: text.split(','),
+                        default=list(OPERATIONS),
+                        help=f'comma separated subset of {",".join(OPERATIONS)}')
+    parser.add_argument('--repeat', type=int, default=REPEAT,
+                        help=f'calls per operation (default {REPEAT})')
+    parser.add_argument('--budget', type=float, default=BUDGET,
+                        help=f'seconds per operation before stopping early (default {BUDGET})')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=Path, help='write the rows as JSON')
+    parser.add_argument('--csv', type=Path, help='write the rows as CSV')
+    options = parser.parse_args(argv)
+    unknown = set(options.operations) - set(OPERATIONS)
+    if unknown:
+        parser.error(f'unknown operations: {", ".join(sorted(unknown))}')
+    if min(options.users) < 2:
+        parser.error('every store needs at least 2 users')
+
+    rows = []
+    for users, messages in product(options.users, options.messages):
+        print(f'users={users} messages={messages} ...', file=sys.stderr)
+        rows.extend(run_scenario(users, messages, options))
+    print_curves(rows)
+
+    if options.output:
+        options.output.write_text(json.dumps(
+            {'storage': options.storage, 'python': sys.version.split()[0], 'rows': rows},
+            indent=2))
+    if options.csv:
+        with options.csv.open('w', newline='') as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -15,16 +15,34 @@ Handles connecting, sending, and receiving messages with the DS server.
 # 14645993
 
 import socket
+import threading
 import time
 import json
+import queue
 from pathlib import Path
-from ds_protocol import extract_json, auth_request, direct_message_request, fetch_request
+from ds_protocol import (
+    extract_json,
+    auth_request,
+    direct_message_request,
+    direct_message_batch_request,
+    direct_message_multi_request,
+    fetch_request,
+    ack_request,
+    subscribe_request,
+    stats_request,
+    is_event,
+    extract_event,
+    read_message,
+    iter_messages,
+    encode_frame,
+    MessageSent,
+    MessageBatch,
+    DSPError
+)
 from notebook import Notebook
-from collections import namedtuple
 
-MessageSent = namedtuple(
-    'MessageSent', [
-        'message', 'recipient', 'timestamp', 'status'])
+ACK_BATCH = 100  # pushed messages acknowledged on their own once this many wait
+MAX_PAGE = 1000  # largest page the server returns
 
 class DirectMessenger:
     """
@@ -33,16 +51,39 @@ class DirectMessenger:
     local message storage. Handles server communication and user session
     management for messaging functionality.
     """
-    def __init__(self, dsuserver=None, username=None, password=None):
-        """Initialize the DirectMessenger with server, username, and password."""
+    def __init__(self, dsuserver=None, username=None, password=None,
+                 compress=False, binary=False):
+        """Initialize the DirectMessenger with server, username, and password.
+
+        With compress=True the server is asked to zlib-compress large
+        replies, which are decompressed transparently on receipt. With
+        binary=True requests and replies use the binary encoding of
+        ds_protocol instead of JSON lines once authenticated.
+        """
         self.token = None
         # more code should go in here
         self.sock = None
         self.server = dsuserver
         self.username = username
         self.password = password
+        self.compress = compress
+        self.binary = binary
+        self._framed = False  # whether the server agreed to binary frames
         self.notebook_path = Path(".") / f"{username}_notebook.json"
         self.response = None
+        self.events = queue.Queue()  # pushed messages, once subscribed
+        self.on_message = None  # optional callback for pushed messages
+        self._reader = None
+        self._replies = queue.Queue()
+        self._subscribed = False
+        # fetching does not mark messages read on the server; they are
+        # acknowledged in batches, ahead of the next request
+        self._ack_upto = 0  # every unread message up to this id
+        self._ack_ids = set()  # and these ids
+        # newest id of the new messages returned; the server hands out unread
+        # messages and pushes in ascending id order, so older ids are repeats
+        self._delivered_upto = 0
+        self._ack_lock = threading.Lock()
 
         if self.notebook_path.exists():
             self.notebook = Notebook(username, password, bio="")
@@ -50,6 +91,8 @@ class DirectMessenger:
         else:
             self.notebook = Notebook(username, password, bio="")
             self.notebook.save(str(self.notebook_path))
+        # server cursor of the last retrieve_since(), kept in the notebook
+        self.cursor = self.notebook.cursor
 
         try:
             self._connect(self.server, 3001)
@@ -63,20 +106,151 @@ class DirectMessenger:
         self.port = port
         self.client.connect((self.host, self.port))
 
-        self.send_file = self.client.makefile('w')
-        self.recv = self.client.makefile('r')
+        self.send_file = self.client.makefile('wb')
+        self.recv = self.client.makefile('rb')
 
-        join_msg = auth_request(self.username, self.password)
-        self.send_file.write(join_msg + '\r\n')
-        self.send_file.flush()
-        resp = self.recv.readline()
+        join_msg = auth_request(self.username, self.password,
+                                compress='zlib' if self.compress else None,
+                                encoding='binary' if self.binary else None)
+        self._write([join_msg])
+        resp = self._readline()
         self.response = extract_json(resp)
 
         if self.response and self.response.type == 'ok':
             self.token = self.response.token
+            self._framed = self.binary
         else:
             print('Authentication Failed')
 
+    def _readline(self) -> str:
+        """Read the next response line, from the reader thread once subscribed."""
+        if getattr(self, '_reader', None) is not None:
+            return self._replies.get()
+        return read_message(self.recv)
+
+    def _write(self, requests: list) -> None:
+        """Write requests built with the ds_protocol helpers, in the negotiated encoding."""
+        if getattr(self, '_framed', False):
+            data = b''.join(encode_frame(json.loads(request)) for request in requests)
+        else:
+            data = ''.join(request + '\r\n' for request in requests).encode()
+        self.send_file.write(data)
+        self.send_file.flush()
+
+    def _request(self, request: str) -> str:
+        """Send one request, after any pending acknowledgement, and return its reply line."""
+        ack = self._take_ack()
+        self._write(([ack] if ack else []) + [request])
+        if ack:
+            self._readline()
+        return self._readline()
+
+    def _take_ack(self):
+        """Return the ack request for everything waiting to be acknowledged, or None."""
+        with self._ack_lock:
+            if not self._ack_upto and not self._ack_ids:
+                return None
+            request = ack_request(self.token, self._ack_upto or None, self._ack_ids)
+            self._ack_upto = 0
+            self._ack_ids = set()
+        return request
+
+    def _ack_through(self, message_id) -> None:
+        """Acknowledge every message up to message_id with the next request."""
+        with self._ack_lock:
+            self._ack_upto = max(self._ack_upto, message_id or 0)
+
+    def _new_messages(self, messages: list) -> list:
+        """Drop messages already returned and queue the rest for acknowledgement."""
+        new = []
+        with self._ack_lock:
+            for msg in messages:
+                msg_id = getattr(msg, 'id', None)
+                if msg_id is not None:
+                    if msg_id <= self._delivered_upto:
+                        continue
+                    self._delivered_upto = msg_id
+                    self._ack_ids.add(msg_id)
+                new.append(msg)
+        return new
+
+    def _add_chats(self, messages: MessageBatch) -> None:
+        """Start an empty chat for every peer of messages not in the notebook yet."""
+        for peer in messages.peers:
+            self.notebook.chats.setdefault(peer, MessageBatch())
+
+    def flush_acks(self) -> None:
+        """Acknowledge the messages received so far right away."""
+        ack = self._take_ack()
+        if ack and hasattr(self, 'send_file'):
+            self._write([ack])
+            self._readline()
+
+    def _read_loop(self) -> None:
+        """Route pushed events to self.events and responses to _readline()."""
+        try:
+            while True:
+                line = read_message(self.recv)
+                if not line:
+                    break
+                if is_event(line):
+                    msg = extract_event(line)
+                    if msg is None or not self._new_messages([msg]):
+                        continue
+                    self.events.put(msg)
+                    if self.on_message is not None:
+                        self.on_message(msg)
+                else:
+                    self._replies.put(line)
+        except (OSError, ValueError, DSPError):
+            pass  # connection closed
+        self._replies.put('')
+
+    @property
+    def subscribed(self) -> bool:
+        """Whether new messages are pushed by the server."""
+        return getattr(self, '_subscribed', False)
+
+    def subscribe(self, callback=None) -> bool:
+        """Ask the server to push new direct messages to this connection.
+
+        Pushed messages are put on self.events (see pending_events()) and
+        passed to callback, which runs on a background reader thread.
+        Unread messages already waiting on the server are pushed at once.
+        """
+
+        if not hasattr(self, 'send_file'):
+            raise ConnectionError("Not connected to server.")
+
+        self.on_message = callback
+        if self._reader is None:
+            self._reader = threading.Thread(target=self._read_loop, daemon=True)
+            self._reader.start()
+        self.response = extract_json(self._request(subscribe_request(self.token)))
+        self._subscribed = bool(self.response and self.response.type == 'ok')
+        return self._subscribed
+
+    def server_stats(self) -> dict:
+        """Return the server's request statistics, or None if it refused."""
+
+        if not hasattr(self, 'send_file'):
+            raise ConnectionError("Not connected to server.")
+
+        self.response = extract_json(self._request(stats_request(self.token)))
+        return self.response.stats if self.response else None
+
+    def pending_events(self) -> list:
+        """Return the pushed messages received since the last call, without blocking."""
+        messages = []
+        while True:
+            try:
+                messages.append(self.events.get_nowait())
+            except queue.Empty:
+                break
+        if len(self._ack_ids) >= ACK_BATCH:
+            self.flush_acks()
+        return messages
+
     def send(self, message: str, recipient: str) -> bool:
         """Send a direct message to a recipient."""
         if not hasattr(self, 'send_file'):
@@ -85,9 +259,7 @@ class DirectMessenger:
         msg = direct_message_request(
             self.token, recipient, message, str(
                 time.time()))
-        self.send_file.write(msg + '\r\n')
-        self.send_file.flush()
-        resp = self.recv.readline()
+        resp = self._request(msg)
         self.response = extract_json(resp)
         self.notebook.chats[recipient].append(MessageSent(
             message=message,
@@ -97,56 +269,220 @@ class DirectMessenger:
         ))
         self.notebook.save(self.notebook_path)
 
+    def send_many(self, items=None, message: str = None, recipients=None) -> list:
+        """Send several direct messages in one request.
 
-    def retrieve_new(self) -> list:
-        """Retrieve all unread direct messages."""
+        Pass items as (message, recipient) pairs, or one message and a list
+        of recipients. Returns one bool per message telling whether the
+        server stored it.
+        """
+        if not hasattr(self, 'send_file'):
+            raise ConnectionError("Not connected to server.")
+
+        if items is None:
+            items = [(message, recipient) for recipient in recipients]
+            msg = direct_message_multi_request(
+                self.token, recipients, message, str(time.time()))
+        else:
+            items = list(items)
+            msg = direct_message_batch_request(
+                self.token, [(recipient, entry) for entry, recipient in items],
+                str(time.time()))
+        self.response = extract_json(self._request(msg))
+        statuses = (self.response and self.response.statuses) or []
+        sent = [status == 'ok' for status in statuses]
+        for (entry, recipient), ok in zip(items, sent):
+            if ok:
+                self.notebook.chats.setdefault(recipient, MessageBatch()).append(MessageSent(
+                    message=entry,
+                    recipient=recipient,
+                    timestamp=time.time(),
+                    status="sent"
+                ))
+        self.notebook.save(self.notebook_path)
+        return sent + [False] * (len(items) - len(sent))
+
+    def retrieve_new(self, wait: float = None) -> list:
+        """Retrieve all unread direct messages.
+
+        With wait, the server holds the request for up to that many seconds
+        until a message arrives, so polling in a loop delivers messages as
+        soon as they are sent. Returned messages are acknowledged with the
+        next request, and a message is never returned twice.
+        """
 
         if not hasattr(self, 'send_file'):
             print("Not connected to server.")
             return []
         # must return a list of DirectMessage objects containing all new
         # messages
-        self.send_file.write(fetch_request(self.token, 'unread') + '\r\n')
-        self.send_file.flush()
-        resp = self.recv.readline()
+        resp = self._request(fetch_request(self.token, 'unread', wait=wait))
         self.response = extract_json(resp)
 
         if self.response:
-            for msg in self.response:
-                sender = getattr(
-                    msg, 'from_name', None) or getattr(
-                    msg, 'recipient', None)
-                if sender not in self.notebook.chats:
-                    self.notebook.chats[sender] = []
+            if isinstance(self.response.message, MessageBatch):
+                self._add_chats(self.response.message)
+                return self._new_messages(self.response.message)
             return self.response.message
         return []
 
-    def retrieve_all(self) -> list:
-        """Retrieve all direct messages."""
+    def retrieve_all(self) -> MessageBatch:
+        """Retrieve all direct messages as a MessageBatch, which builds message
+        objects only as they are used; they are all acknowledged as read."""
 
         if not hasattr(self, 'send_file'):
             print("Not connected to server.")
             return []
 
         # must return a list of DirectMessage objects containing all messages
-        self.send_file.write(fetch_request(self.token, 'all') + '\r\n')
-        self.send_file.flush()
-        resp = self.recv.readline()
+        resp = self._request(fetch_request(self.token, 'all'))
         self.response = extract_json(resp)
 
         if self.response:
-            for msg in self.response:
-                sender = getattr(
-                    msg, 'from_name', None) or getattr(
-                    msg, 'recipient', None)
-                if sender not in self.notebook.chats:
-                    self.notebook.chats[sender] = []
+            if isinstance(self.response.message, MessageBatch):
+                self._add_chats(self.response.message)
+                self._ack_through(max(self.response.message.ids, default=0))
+                return self.response.message
             return self.response.message
         return []
 
+    def iter_all(self, chunk_size: int = 1 << 16):
+        """Yield every direct message, like retrieve_all(), while the reply is read.
+
+        Messages are decoded one at a time as the reply arrives, so memory
+        does not grow with the history. The messages yielded are
+        acknowledged as read; stopping early leaves the rest unread.
+        """
+
+        if not hasattr(self, 'send_file'):
+            raise ConnectionError("Not connected to server.")
+        if getattr(self, '_reader', None) is not None:
+            # the reader thread owns the socket once subscribed
+            yield from self.retrieve_all()
+            return
+
+        ack = self._take_ack()
+        self._write(([ack] if ack else []) + [fetch_request(self.token, 'all')])
+        if ack:
+            self._readline()
+        messages = iter_messages(self.recv, chunk_size)
+        newest = 0
+        try:
+            while True:
+                try:
+                    msg = next(messages)
+                except StopIteration as done:
+                    self.response = done.value
+                    break
+                self.notebook.chats.setdefault(msg.peer, MessageBatch())
+                newest = max(newest, msg.id or 0)
+                yield msg
+        finally:
+            messages.close()
+            self._ack_through(newest)
+
+    def retrieve_since(self) -> MessageBatch:
+        """Retrieve the direct messages stored since the last call.
+
+        The first call for a notebook returns the whole history; later
+        calls only return what the server stored since. The cursor is
+        saved in the notebook, so this holds across reconnects and new
+        DirectMessenger objects for the same user.
+        """
+
+        if not hasattr(self, 'send_file'):
+            print("Not connected to server.")
+            return []
+
+        resp = self._request(fetch_request(self.token, since=self.cursor))
+        self.response = extract_json(resp)
+
+        if self.response and self.response.type == 'ok':
+            self.cursor = self.response.cursor
+            self._ack_through(self.cursor)
+            self.notebook.cursor = self.cursor
+            self.notebook.save(self.notebook_path)
+            return self.response.message
+        return []
+
+    def iter_history(self, page_size: int = 100, **filters):
+        """Yield every direct message, oldest first, one page at a time.
+
+        Each page is requested only when the previous one has been
+        consumed, so the client never holds more than page_size messages.
+        This bounds the client only: the server may still hold the user's
+        whole history, as the JSON and sharded stores keep it in memory.
+        filters are the peer, direction, start and end of fetch_request.
+        """
+
+        if not hasattr(self, 'send_file'):
+            print("Not connected to server.")
+            return
+
+        cursor = 0
+        while True:
+            resp = self._request(
+                fetch_request(self.token, since=cursor, limit=page_size, **filters))
+            self.response = extract_json(resp)
+            if not self.response or self.response.type != 'ok':
+                return
+            cursor = self.response.cursor
+            if filters:
+                # only what was returned; other conversations stay unread
+                with self._ack_lock:
+                    self._ack_ids.update(
+                        msg_id for msg_id in self.response.message.ids if msg_id)
+            else:
+                self._ack_through(cursor)
+            yield from self.response.message
+            if not self.response.more:
+                return
+
+    def retrieve_conversation(self, peer: str, direction: str = None,
+                              start: float = None, end: float = None) -> list:
+        """Retrieve the direct messages exchanged with one contact.
+
+        The server reads them from its index of that conversation, so
+        only they are sent. direction ('sent' or 'received') and the
+        timestamps start and end narrow the result further.
+        """
+        filters = {'peer': peer, 'direction': direction, 'start': start, 'end': end}
+        return list(self.iter_history(
+            MAX_PAGE, **{name: value for name, value in filters.items()
+                         if value is not None}))
+
+    def pipeline(self, requests: list) -> list:
+        """Send several protocol requests at once and return their responses.
+
+        All requests (strings built with the ds_protocol helpers) are
+        written in one go, without waiting for each reply; the server
+        answers them in order, so the responses line up with the requests.
+        """
+
+        if not hasattr(self, 'send_file'):
+            raise ConnectionError("Not connected to server.")
+
+        ack = self._take_ack()
+        lines = ([ack] if ack else []) + list(requests)
+        self._write(lines)
+        responses = [extract_json(self._readline()) for _ in lines]
+        if ack:
+            responses = responses[1:]
+        if responses:
+            self.response = responses[-1]
+        return responses
+
     def close(self) -> None:
         """Close the connection to the Direct Social Messenger server."""
+        if getattr(self, '_ack_lock', None) is not None:
+            try:
+                self.flush_acks()
+            except (OSError, ValueError) as error:
+                print(f"Unable to acknowledge messages: {error}")
         try:
+            if getattr(self, '_reader', None) is not None:
+                # unblock the reader thread before closing the file it reads
+                self.client.shutdown(socket.SHUT_RDWR)
             if hasattr(self, 'send_file'):
                 self.send_file.close()
             if self.recv:
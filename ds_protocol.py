@@ -13,17 +13,286 @@
 Defines protocol message formats, parsing, and helpers for server communication.
 """
 
+import codecs
 import json
+import re
+import struct
+import zlib
+from array import array
 from collections import namedtuple
 
+# A reply the server compressed is sent as this byte, the length of the zlib
+# data as 4 big-endian bytes and the zlib data; a JSON line never starts with it.
+COMPRESSED_FRAME = b'\x01'
+# A message in the binary encoding is sent as this byte, the length of the
+# encoded value as 4 big-endian bytes and the value (see encode_binary).
+BINARY_FRAME = b'\x02'
+
+# Keys of the protocol's objects, sent as their one-byte index in the binary
+# encoding; other keys are sent as strings. Only ever append to this tuple.
+WIRE_KEYS = (
+    'token', 'authenticate', 'username', 'password', 'directmessage', 'entry',
+    'recipient', 'timestamp', 'fetch', 'response', 'type', 'message', 'messages',
+    'from', 'id', 'cursor', 'more', 'statuses', 'since', 'limit', 'peer',
+    'direction', 'start', 'end', 'wait', 'ack', 'upto', 'ids', 'subscribe',
+    'event', 'compress', 'method', 'threshold', 'encoding', 'status')
+_KEY_BYTES = {key: bytes([code]) for code, key in enumerate(WIRE_KEYS)}
+_NAMED_KEY = 0xFF
+_NONE, _FALSE, _TRUE, _INT, _FLOAT, _STR, _LIST, _DICT = range(8)
+_TAGGED_INT = struct.Struct('>Bq')
+_TAGGED_FLOAT = struct.Struct('>Bd')
+_TAGGED_SIZE = struct.Struct('>BI')
+_SIZE = struct.Struct('>I')
+_KEY_SIZE = struct.Struct('>BH')
+# where the messages array of a fetch response starts; a JSON string cannot
+# hold an unescaped quote, so this only matches the key itself
+_MESSAGES_KEY = re.compile(r'"messages"\s*:\s*\[')
+_DECODER = json.JSONDecoder()
+
 # Create a namedtuple to hold the values we expect to retrieve from json messages.
-ServerResponse = namedtuple('ServerResponse', ['type', 'message', 'token'])
-MessageReceived = namedtuple(
-    'MessageReceived', [
-        'message', 'from_name', 'timestamp', 'status'])
-MessageSent = namedtuple(
-    'MessageSent', [
-        'message', 'recipient', 'timestamp', 'status'])
+# cursor and more are only set by incremental fetches (see fetch_request),
+# statuses only by batch direct messages ('ok' or 'error' per message),
+# stats only by the stats command (a dict, see stats_request)
+ServerResponse = namedtuple(
+    'ServerResponse', ['type', 'message', 'token', 'cursor', 'more', 'statuses', 'stats'],
+    defaults=[None, False, None, None])
+# Message statuses in the order of their codes in a MessageBatch status column
+MESSAGE_STATUSES = (None, 'unread', 'read', 'sent')
+_STATUS_CODES = {status: code for code, status in enumerate(MESSAGE_STATUSES)}
+
+
+class MessageRecord:
+    '''
+    One direct message: the message, the other user, its timestamp, its status and the
+    server-assigned id that ack_request refers to. It replaces the namedtuples used before
+    and still behaves like the tuple (message, peer, timestamp, status, id): it can be
+    indexed, unpacked and compared with tuples. Use MessageReceived or MessageSent.
+    '''
+    __slots__ = ('message', 'peer', 'timestamp', 'status', 'id')
+    sent = False
+    _peer_field = 'peer'
+
+    def __init__(self, message, peer, timestamp, status=None, id=None):
+        self.message = message
+        self.peer = peer
+        self.timestamp = timestamp
+        self.status = status
+        self.id = id
+
+    def _astuple(self) -> tuple:
+        return (self.message, self.peer, self.timestamp, self.status, self.id)
+
+    def __iter__(self):
+        return iter(self._astuple())
+
+    def __len__(self) -> int:
+        return 5
+
+    def __getitem__(self, index):
+        return self._astuple()[index]
+
+    def __eq__(self, other):
+        if isinstance(other, MessageRecord):
+            return self.sent == other.sent and self._astuple() == other._astuple()
+        if isinstance(other, tuple):
+            return self._astuple() == other
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self._astuple())
+
+    def __repr__(self) -> str:
+        return (f'{type(self).__name__}(message={self.message!r}, '
+                f'{self._peer_field}={self.peer!r}, timestamp={self.timestamp!r}, '
+                f'status={self.status!r}, id={self.id!r})')
+
+
+class MessageReceived(MessageRecord):
+    '''
+    A message from_name sent to us
+    '''
+    __slots__ = ()
+    _peer_field = 'from_name'
+
+    def __init__(self, message, from_name, timestamp, status=None, id=None):
+        super().__init__(message, from_name, timestamp, status, id)
+
+    @property
+    def from_name(self):
+        return self.peer
+
+
+class MessageSent(MessageRecord):
+    '''
+    A message we sent to recipient
+    '''
+    __slots__ = ()
+    sent = True
+    _peer_field = 'recipient'
+
+    def __init__(self, message, recipient, timestamp, status=None, id=None):
+        super().__init__(message, recipient, timestamp, status, id)
+
+    @property
+    def recipient(self):
+        return self.peer
+
+
+class MessageBatch:
+    '''
+    Many messages held in columns instead of one object each: the texts in a list, and
+    arrays of peer codes (into a table of peer names, each stored once), directions,
+    timestamps (seconds, as floats), status codes (see MESSAGE_STATUSES) and ids (0 for
+    none). Indexing or iterating it builds MessageReceived/MessageSent objects on demand,
+    so it can be used like the list of records it replaces.
+    '''
+    __slots__ = ('_text', '_peer', '_sent', '_timestamp', '_status', '_id',
+                 '_peers', '_peer_codes')
+
+    def __init__(self, messages=()):
+        '''
+        messages are records, or sequences (message, peer, timestamp, status[, id]) such
+        as the lists a notebook file holds; these are sent messages if status is 'sent'.
+        '''
+        self._text = []
+        self._peer = array('I')
+        self._sent = array('b')
+        self._timestamp = array('d')
+        self._status = array('b')
+        self._id = array('q')
+        self._peers = []
+        self._peer_codes = {}
+        self.extend(messages)
+
+    @classmethod
+    def from_server(cls, messages_data: list) -> 'MessageBatch':
+        '''
+        Build a batch from the message objects of a response in one pass, keeping the order
+        the server sent them in. A message with both 'from' and 'recipient' gives two records.
+        '''
+        batch = cls()
+        add = batch._add
+        for msg in messages_data:
+            if 'from' in msg:
+                add(msg['message'], msg['from'], False, msg['timestamp'],
+                    msg.get('status'), msg.get('id'))
+            if 'recipient' in msg:
+                add(msg['message'], msg['recipient'], True, msg['timestamp'],
+                    msg.get('status'), msg.get('id'))
+        return batch
+
+    def _add(self, message, peer, sent, timestamp, status, message_id) -> None:
+        code = self._intern(peer)
+        try:
+            timestamp = float(timestamp)
+        except (TypeError, ValueError):
+            timestamp = 0.0
+        try:
+            status = _STATUS_CODES[status]
+        except KeyError:
+            raise ValueError(f'Unknown message status {status!r}') from None
+        self._text.append(message)
+        self._peer.append(code)
+        self._sent.append(sent)
+        self._timestamp.append(timestamp)
+        self._status.append(status)
+        self._id.append(message_id or 0)
+
+    def append(self, message) -> None:
+        '''
+        Add a record, or a sequence (message, peer, timestamp, status[, id])
+        '''
+        if isinstance(message, MessageRecord):
+            sent = message.sent
+        elif isinstance(message, (list, tuple)) and len(message) in (4, 5):
+            sent = message[3] == 'sent'
+        else:
+            raise TypeError(f'Not a message: {message!r}')
+        self._add(message[0], message[1], sent, message[2], message[3],
+                  message[4] if len(message) > 4 else None)
+
+    def extend(self, messages) -> None:
+        if isinstance(messages, MessageBatch):
+            for column in ('_text', '_sent', '_timestamp', '_status', '_id'):
+                getattr(self, column).extend(getattr(messages, column))
+            for code in messages._peer:
+                self._peer.append(self._intern(messages._peers[code]))
+            return
+        for message in messages:
+            self.append(message)
+
+    def _intern(self, peer) -> int:
+        code = self._peer_codes.get(peer)
+        if code is None:
+            code = self._peer_codes[peer] = len(self._peers)
+            self._peers.append(peer)
+        return code
+
+    @property
+    def ids(self) -> array:
+        '''
+        The id column, 0 where a message has no id
+        '''
+        return self._id
+
+    @property
+    def peers(self) -> list:
+        '''
+        Every peer name in the batch, once each
+        '''
+        return list(self._peers)
+
+    def _record(self, index: int) -> MessageRecord:
+        record_type = MessageSent if self._sent[index] else MessageReceived
+        return record_type(
+            self._text[index], self._peers[self._peer[index]], self._timestamp[index],
+            MESSAGE_STATUSES[self._status[index]], self._id[index] or None)
+
+    def __len__(self) -> int:
+        return len(self._text)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return MessageBatch(self._record(i) for i in range(*index.indices(len(self))))
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('MessageBatch index out of range')
+        return self._record(index)
+
+    def __iter__(self):
+        peers = self._peers
+        for text, code, sent, timestamp, status, message_id in zip(
+                self._text, self._peer, self._sent, self._timestamp, self._status, self._id):
+            yield (MessageSent if sent else MessageReceived)(
+                text, peers[code], timestamp, MESSAGE_STATUSES[status], message_id or None)
+
+    def __reversed__(self):
+        for index in range(len(self) - 1, -1, -1):
+            yield self._record(index)
+
+    def __bool__(self) -> bool:
+        return bool(self._text)
+
+    def __eq__(self, other):
+        if not isinstance(other, (MessageBatch, list, tuple)):
+            return NotImplemented
+        return len(self) == len(other) and all(
+            mine == theirs for mine, theirs in zip(self, other))
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return f'MessageBatch({list(self)!r})'
+
+    def to_json(self) -> list:
+        '''
+        The messages as [message, peer, timestamp, status, id] lists, for json.dump
+        '''
+        return [[text, self._peers[code], timestamp, MESSAGE_STATUSES[status],
+                 message_id or None]
+                for text, code, timestamp, status, message_id in zip(
+                    self._text, self._peer, self._timestamp, self._status, self._id)]
 
 
 class DSPError(Exception):
@@ -33,27 +302,209 @@ class DSPError(Exception):
     # pass
 
 
-def extract_json(json_msg: str) -> ServerResponse:
+class LineFramer:
+    '''
+    Splits a byte stream into the CRLF terminated lines of the protocol.
+    Bytes are fed as they arrive; a line split across reads is kept until its end
+    arrives, and one read may complete several lines (pipelined commands).
+    '''
+
+    def __init__(self, max_line: int = 1 << 20):
+        self.max_line = max_line
+        self._parts = []  # pieces of the line that is not complete yet
+        self._size = 0
+
+    def feed(self, data: bytes) -> list[bytes]:
+        '''
+        Add received bytes and return the lines they complete, without terminators
+        '''
+        self._parts.append(data)
+        if b'\n' not in data:
+            self._size += len(data)
+            if self._size > self.max_line:
+                raise DSPError('Line longer than the maximum line length')
+            return []
+        *lines, rest = b''.join(self._parts).split(b'\n')
+        self._parts = [rest]
+        self._size = len(rest)
+        return [line.rstrip(b'\r') for line in lines]
+
+
+class MessageFramer(LineFramer):
+    '''
+    A LineFramer that also accepts binary frames (see encode_frame) between lines;
+    feed() returns them decoded, as dicts, in order with the lines.
+    '''
+
+    def __init__(self, max_line: int = 1 << 20):
+        super().__init__(max_line)
+        self._framed = False  # whether the peer has sent a binary frame
+
+    def feed(self, data: bytes) -> list:
+        '''
+        Add received bytes and return the lines and decoded frames they complete
+        '''
+        # JSON text never holds a raw control byte, so lines alone take the fast path
+        if not self._framed and BINARY_FRAME not in data:
+            return super().feed(data)
+        self._framed = True
+        buffer = b''.join(self._parts) + data
+        messages = []
+        pos = 0
+        while pos < len(buffer):
+            if buffer[pos] == BINARY_FRAME[0]:
+                if len(buffer) - pos < 5:
+                    break
+                length = _SIZE.unpack_from(buffer, pos + 1)[0]
+                if length > self.max_line:
+                    raise DSPError('Frame longer than the maximum line length')
+                end = pos + 5 + length
+                if end > len(buffer):
+                    break
+                messages.append(decode_binary(buffer[pos + 5:end]))
+                pos = end
+            else:
+                end = buffer.find(b'\n', pos)
+                if end < 0:
+                    if len(buffer) - pos > self.max_line:
+                        raise DSPError('Line longer than the maximum line length')
+                    break
+                messages.append(buffer[pos:end].rstrip(b'\r'))
+                pos = end + 1
+        self._parts = [buffer[pos:]]
+        self._size = len(buffer) - pos
+        return messages
+
+
+def encode_binary(value) -> bytes:
+    '''
+    Encode a JSON-compatible value (dicts, lists, strings, numbers, booleans, None)
+    in the compact binary encoding: a tag byte per value, fixed-size numbers,
+    length-prefixed strings and protocol keys as single bytes
+    '''
+    out = []
+    _encode_value(value, out)
+    return b''.join(out)
+
+
+def _encode_value(value, out: list) -> None:
+    if isinstance(value, str):
+        data = value.encode()
+        out.append(_TAGGED_SIZE.pack(_STR, len(data)))
+        out.append(data)
+    elif isinstance(value, dict):
+        out.append(_TAGGED_SIZE.pack(_DICT, len(value)))
+        for key, item in value.items():
+            code = _KEY_BYTES.get(key)
+            if code is None:
+                if not isinstance(key, str):
+                    raise DSPError(f'Cannot encode a {type(key).__name__} key')
+                name = key.encode()
+                code = _KEY_SIZE.pack(_NAMED_KEY, len(name)) + name
+            out.append(code)
+            _encode_value(item, out)
+    elif value is None:
+        out.append(b'\x00')
+    elif value is True or value is False:
+        out.append(b'\x02' if value else b'\x01')
+    elif isinstance(value, int):
+        try:
+            out.append(_TAGGED_INT.pack(_INT, value))
+        except struct.error as exc:
+            raise DSPError(f'Integer out of range: {value}') from exc
+    elif isinstance(value, float):
+        out.append(_TAGGED_FLOAT.pack(_FLOAT, value))
+    elif isinstance(value, (list, tuple)):
+        out.append(_TAGGED_SIZE.pack(_LIST, len(value)))
+        for item in value:
+            _encode_value(item, out)
+    else:
+        raise DSPError(f'Cannot encode a {type(value).__name__}')
+
+
+def decode_binary(data: bytes):
+    '''
+    Decode a value produced by encode_binary
+    '''
+    try:
+        value, end = _decode_value(data, 0)
+    except (IndexError, KeyError, UnicodeDecodeError, struct.error) as exc:
+        raise DSPError('Malformed binary message') from exc
+    if end != len(data):
+        raise DSPError('Trailing bytes after binary message')
+    return value
+
+
+def _decode_value(data: bytes, pos: int):
+    tag = data[pos]
+    if tag == _STR:
+        length = _SIZE.unpack_from(data, pos + 1)[0]
+        start = pos + 5
+        if start + length > len(data):
+            raise IndexError(pos)
+        return data[start:start + length].decode(), start + length
+    if tag == _DICT:
+        count = _SIZE.unpack_from(data, pos + 1)[0]
+        pos += 5
+        value = {}
+        for _ in range(count):
+            code = data[pos]
+            if code == _NAMED_KEY:
+                length = _KEY_SIZE.unpack_from(data, pos)[1]
+                key = data[pos + 3:pos + 3 + length].decode()
+                pos += 3 + length
+            else:
+                key = WIRE_KEYS[code]
+                pos += 1
+            value[key], pos = _decode_value(data, pos)
+        return value, pos
+    if tag == _INT:
+        return _TAGGED_INT.unpack_from(data, pos)[1], pos + 9
+    if tag == _LIST:
+        count = _SIZE.unpack_from(data, pos + 1)[0]
+        pos += 5
+        value = []
+        for _ in range(count):
+            item, pos = _decode_value(data, pos)
+            value.append(item)
+        return value, pos
+    if tag == _FLOAT:
+        return _TAGGED_FLOAT.unpack_from(data, pos)[1], pos + 9
+    if tag in (_NONE, _FALSE, _TRUE):
+        return (None, False, True)[tag], pos + 1
+    raise KeyError(tag)
+
+
+def encode_frame(value) -> bytes:
+    '''
+    Encode a message as a binary frame, the binary counterpart of a JSON line
+    '''
+    body = encode_binary(value)
+    return BINARY_FRAME + _SIZE.pack(len(body)) + body
+
+
+def extract_json(json_msg) -> ServerResponse:
     '''
-    Call the json.loads function on a json response and convert it to a DataTuple object
+    Call the json.loads function on a json response and convert it to a DataTuple object.
+    A response read from a binary frame is already decoded and is passed as a dict.
     '''
     try:
-        json_obj = json.loads(json_msg)
+        json_obj = json_msg if isinstance(json_msg, dict) else json.loads(json_msg)
         if 'response' in json_obj:
             resp_type = json_obj['response']['type']
             if 'message' in json_obj['response']:
                 message = json_obj['response']['message']
             elif 'messages' in json_obj['response']:
-                message = json_obj['response']['messages']
-                received = _extract_messages_received(json_obj)
-                sent = _extract_messages_sent(json_obj)
-                # print(f"Received: {received}, Sent: {sent}")
-                message = received + sent
+                message = MessageBatch.from_server(json_obj['response']['messages'])
             else:
                 message = None
             # some replies may not have a token
             token = json_obj['response'].get('token')
-            return ServerResponse(resp_type, message, token)
+            cursor = json_obj['response'].get('cursor')
+            more = json_obj['response'].get('more', False)
+            statuses = json_obj['response'].get('statuses')
+            stats = json_obj['response'].get('stats')
+            return ServerResponse(resp_type, message, token, cursor, more, statuses, stats)
         return None
     except json.JSONDecodeError:
         print("Json cannot be decoded.")
@@ -62,9 +513,13 @@ def extract_json(json_msg: str) -> ServerResponse:
         raise DSPError from exc
 
 
-def auth_request(username: str, password: str) -> str:
+def auth_request(username: str, password: str, compress: str = None,
+                 threshold: int = None, encoding: str = None) -> str:
     '''
-    This function takes a username and password and returns a json string sent to the server
+    This function takes a username and password and returns a json string sent to the server.
+    With compress (e.g. "zlib") the server is asked to compress replies of at least threshold
+    bytes; with encoding="binary" to exchange binary frames from then on. Read the replies
+    with read_message.
     '''
     auth = {
         "authenticate": {
@@ -72,9 +527,129 @@ def auth_request(username: str, password: str) -> str:
             "password": password
         }
     }
+    if compress:
+        auth["authenticate"]["compress"] = {"method": compress}
+        if threshold is not None:
+            auth["authenticate"]["compress"]["threshold"] = threshold
+    if encoding:
+        auth["authenticate"]["encoding"] = encoding
     return json.dumps(auth)
 
 
+def compress_frame(payload: bytes, level: int = 6) -> bytes:
+    '''
+    Wrap an encoded JSON message in a length-prefixed zlib frame
+    '''
+    body = zlib.compress(payload, level)
+    return COMPRESSED_FRAME + struct.pack('>I', len(body)) + body
+
+
+def read_message(stream):
+    '''
+    Read one reply or event from a buffered binary stream (socket.makefile('rb')),
+    either a CRLF terminated line, a compressed frame or a binary frame. Lines and
+    compressed frames are returned as JSON text, binary frames decoded as a dict.
+    Returns '' once the stream ends.
+    '''
+    kind = stream.peek(1)[:1]
+    if kind not in (COMPRESSED_FRAME, BINARY_FRAME):
+        return stream.readline().decode()
+    header = stream.read(5)
+    length = struct.unpack('>I', header[1:])[0] if len(header) == 5 else 0
+    body = stream.read(length)
+    if len(header) < 5 or len(body) < length:
+        raise DSPError('Connection closed inside a frame')
+    if kind == BINARY_FRAME:
+        return decode_binary(body)
+    try:
+        return zlib.decompress(body).decode()
+    except zlib.error as error:
+        raise DSPError(f'Corrupt compressed frame: {error}') from error
+
+
+def iter_messages(stream, chunk_size: int = 1 << 16):
+    '''
+    Read one fetch response from a buffered binary stream (socket.makefile('rb')) and yield
+    its messages as MessageReceived/MessageSent objects while the messages array is still
+    arriving, so only a chunk of the response and the messages decoded from it are held
+    at a time.
+    The generator returns the ServerResponse of the reply, with message set to None once
+    the messages were yielded. Closing it early skips the rest of the response, so the
+    stream stays usable. Frames (see read_message) arrive whole and are decoded as usual.
+    '''
+    if stream.peek(1)[:1] in (COMPRESSED_FRAME, BINARY_FRAME):
+        response = extract_json(read_message(stream))
+        if response is None:
+            raise DSPError('Malformed response')
+        if not isinstance(response.message, MessageBatch):
+            return response
+        yield from response.message
+        return response._replace(message=None)
+
+    decode = codecs.getincrementaldecoder('utf-8')().decode
+    text, ended = '', False
+    finished = False
+    try:
+        # the fields before the messages array
+        match = None
+        while not match and not ended:
+            text, ended = _read_more(stream, text, decode, chunk_size)
+            match = _MESSAGES_KEY.search(text)
+        if not match:
+            # no messages array: an error or some other reply
+            finished = True
+            response = extract_json(text)
+            if response is None:
+                raise DSPError('Malformed response')
+            return response
+        head, pos = text[:match.end()], match.end()
+        pending = []  # message objects decoded from the chunk read last
+        while True:
+            while pos < len(text) and text[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(text) and text[pos] == ']':
+                break
+            try:
+                if pos == len(text):
+                    raise json.JSONDecodeError('Incomplete message', text, pos)
+                msg, pos = _DECODER.raw_decode(text, pos)
+            except json.JSONDecodeError as exc:
+                if ended:
+                    raise DSPError('Malformed messages array in response') from exc
+                yield from MessageBatch.from_server(pending)
+                pending = []
+                text, ended = _read_more(stream, text[pos:], decode, chunk_size)
+                pos = 0
+                continue
+            pending.append(msg)
+        yield from MessageBatch.from_server(pending)
+        tail = text[pos + 1:]
+        while not ended:
+            tail, ended = _read_more(stream, tail, decode, chunk_size)
+        finished = True
+        response = extract_json(head + ']' + tail)
+        if response is None:
+            raise DSPError('Malformed response')
+        return response._replace(message=None)
+    finally:
+        if not finished and not ended:
+            while True:
+                data = stream.readline(chunk_size)
+                if not data or data.endswith(b'\n'):
+                    break
+
+
+def _read_more(stream, text: str, decode, chunk_size: int):
+    '''
+    Append up to chunk_size more bytes of the current line to text; also tell whether
+    the line has ended
+    '''
+    data = stream.readline(chunk_size)
+    if not data:
+        raise DSPError('Connection closed inside a response')
+    return text + decode(data), data.endswith(b'\n')
+
+
 def direct_message_request(
         token: str,
         recipient: str,
@@ -94,50 +669,136 @@ def direct_message_request(
     return json.dumps(direct_message)
 
 
-def fetch_request(token: str, what: str) -> str:
+def direct_message_batch_request(
+        token: str,
+        items: list,
+        timestamp: float) -> str:
+    '''
+    This function takes a token and (recipient, message) pairs and returns one json string
+    that sends all of them; the response's statuses field has one entry per pair
     '''
-    This function takes a token and fetch (all / unread) and returns a json string to the server
+    direct_message = {
+        "token": token,
+        "directmessage": [
+            {"entry": message, "recipient": recipient, "timestamp": timestamp}
+            for recipient, message in items]
+    }
+    return json.dumps(direct_message)
+
+
+def direct_message_multi_request(
+        token: str,
+        recipients: list,
+        message: str,
+        timestamp: float) -> str:
     '''
+    This function takes a token, several recipients and one message and returns a json string
+    that sends the message to each of them; the response's statuses field has one entry per recipient
+    '''
+    direct_message = {
+        "token": token,
+        "directmessage": {
+            "entry": message,
+            "recipients": list(recipients),
+            "timestamp": timestamp
+        }
+    }
+    return json.dumps(direct_message)
+
+
+def fetch_request(
+        token: str,
+        what: str = 'all',
+        since: int = None,
+        limit: int = None,
+        wait: float = None,
+        peer: str = None,
+        direction: str = None,
+        start: float = None,
+        end: float = None) -> str:
+    '''
+    This function takes a token and fetch (all / unread) and returns a json string to the server.
+    If since is given, only the messages stored after that server-issued cursor are requested;
+    the response carries the cursor to pass next time (0 starts from the beginning).
+    If limit is given, at most that many messages come back and the response's more field
+    tells whether to fetch again from the returned cursor.
+    If wait is given with unread, the server holds the request for up to that many seconds
+    until a message arrives instead of answering with an empty list right away.
+    peer, direction ('sent' or 'received') and the timestamps start (inclusive) and end
+    (exclusive) narrow an incremental fetch down to part of one conversation.
+    '''
+    filters = {"peer": peer, "direction": direction, "start": start, "end": end}
+    filters = {name: value for name, value in filters.items() if value is not None}
+    if since is None and limit is None and not filters:
+        what_obj = what
+    else:
+        what_obj = {"since": since or 0}
+        if limit is not None:
+            what_obj["limit"] = limit
+        what_obj.update(filters)
     fetch_obj = {
         "token": token,
-        "fetch": what
+        "fetch": what_obj
     }
+    if wait is not None:
+        fetch_obj["wait"] = wait
     return json.dumps(fetch_obj)
 
 
-def _extract_messages_received(json_obj: dict) -> list[MessageReceived]:
-    '''
-    This function takes json messages and returns a list of MessageReceived objects
-    '''
-    messages = []
-    messages_data = json_obj['response']['messages']
-    for msg in messages_data:
-        if 'from' in msg:
-            messages.append(
-                MessageReceived(
-                    msg['message'],
-                    msg['from'],
-                    msg['timestamp'],
-                    msg.get('status')
-                )
-            )
-    return messages
-
-
-def _extract_messages_sent(json_obj: dict) -> list[MessageSent]:
-    '''
-    This function takes json messages and returns a list of MessageSent objects
-    '''
-    messages = []
-    messages_data = json_obj['response']['messages']
-    for msg in messages_data:
-        if 'recipient' in msg:
-            messages.append(
-                MessageSent(
-                    msg['message'],
-                    msg['recipient'],
-                    msg['timestamp'],
-                    msg.get('status')
-                )
-            )
-    return messages
+def ack_request(token: str, upto: int = None, ids=None) -> str:
+    '''
+    This function takes a token and message ids and returns a json string that marks messages
+    as read: every unread message with an id up to upto, and each message whose id is in ids.
+    Fetching never marks messages as read, so received messages must be acknowledged.
+    '''
+    ack = {}
+    if upto is not None:
+        ack["upto"] = upto
+    if ids:
+        ack["ids"] = sorted(ids)
+    return json.dumps({"token": token, "ack": ack})
+
+
+def subscribe_request(token: str) -> str:
+    '''
+    This function takes a token and returns a json string asking the server to push
+    new direct messages on this connection as they arrive
+    '''
+    subscribe_obj = {
+        "token": token,
+        "subscribe": True
+    }
+    return json.dumps(subscribe_obj)
+
+
+def stats_request(token: str) -> str:
+    '''
+    This function takes a token and returns a json string asking the server for its
+    request statistics: counts and errors per command, latency percentiles, sessions,
+    connections and message bytes read from and written to storage
+    '''
+    return json.dumps({"token": token, "stats": True})
+
+
+def is_event(json_msg) -> bool:
+    '''
+    Tell a pushed event line (or decoded binary frame) apart from the response to a request
+    '''
+    if isinstance(json_msg, dict):
+        return 'event' in json_msg
+    return json_msg.lstrip().startswith('{"event"')
+
+
+def extract_event(json_msg) -> MessageReceived:
+    '''
+    Convert a pushed directmessage event into a MessageReceived, or None for other events
+    '''
+    try:
+        event = (json_msg if isinstance(json_msg, dict) else json.loads(json_msg))['event']
+        if event.get('type') != 'directmessage':
+            return None
+        return MessageReceived(
+            event['message'], event['from'], event['timestamp'], event.get('status'),
+            event.get('id'))
+    except (json.JSONDecodeError, KeyError, TypeError) as exc:
+        raise DSPError from exc
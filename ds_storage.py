@@ -0,0 +1,1096 @@
+'''Storage backends for the DSU server.
+
+JsonStorage keeps every user record in memory, in the same shape as
+store/users.json, and appends each mutation to a write-ahead log
+(store/users.log). The log is periodically folded back into users.json
+and is replayed on top of it when the server starts.
+
+ShardedStorage keeps one file per user under store/users/ and locks
+per user, so requests for unrelated users never wait on each other.
+
+SqliteStorage keeps users and messages in store/users.db, indexed so
+that unread fetches and appends are indexed queries and row updates.
+
+All of them implement the Storage interface that DSUServer talks to.
+Run this module to migrate a JSON store into SQLite:
+
+    python ds_storage.py [store_dir]
+'''
+
+import bisect
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+import weakref
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from operator import itemgetter
+from pathlib import Path
+from urllib.parse import quote
+
+USERS_PATH = 'users.json'
+LOG_PATH = 'users.log'
+SHARDS_PATH = 'users'
+DB_PATH = 'users.db'
+COMPACT_EVERY = 1000  # log records between two snapshots of users.json
+GROUP_COMMIT_BATCH = 256  # most log records written by a single flush
+GROUP_COMMIT_INTERVAL = 0.002  # seconds a flush waits for more records
+
+# How a commit reaches the disk:
+#   commit - every record is written and fsynced on its own before the
+#            request that made it returns
+#   batch  - records from concurrent requests are grouped and fsynced
+#            once per batch; every request waits for its batch
+#   os     - records are grouped and handed to the OS without fsync;
+#            requests do not wait (a crash can lose the last records)
+DURABILITY_MODES = ('commit', 'batch', 'os')
+
+# fetch direction filter -> key a stored message of that direction has
+MESSAGE_DIRECTIONS = {'received': 'from', 'sent': 'recipient'}
+
+
+def _new_user(password):
+    '''Return an empty user record in the users.json schema'''
+    return {'password': password, 'bio': {
+        "entry": "", "timestamp": ""}, 'posts': [], 'messages': []}
+
+
+def _to_timestamp(value):
+    '''Parse a stored timestamp (legacy stores keep them as strings)'''
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _format_message(message, message_id):
+    '''Strip the status off a stored message and add its id before it is sent to a client'''
+    if 'from' in message:
+        return {
+            'id': message_id,
+            'from': message['from'],
+            'message': message['message'],
+            'timestamp': message['timestamp']}
+    return {
+        'id': message_id,
+        'recipient': message['recipient'],
+        'message': message['message'],
+        'timestamp': message['timestamp']}
+
+
+class Storage(ABC):
+    '''Interface between DSUServer and where its users and messages live.
+
+    A user record is a dict with at least a 'password' key. Messages are
+    returned as dicts with 'id', 'message', 'timestamp' and either 'from'
+    (the user received it) or 'recipient' (the user sent it), oldest first.
+    Ids are positive integers that grow with every message a user gets,
+    so a message keeps its id however often it is fetched.
+
+    Reading never changes anything: a received message stays unread until
+    it is acknowledged with ack_messages().
+
+    Timestamps are floats. Every backend keeps each user's messages in
+    timestamp order as they are appended: a new message never gets a
+    timestamp older than the last one of its sender or recipient, so
+    fetches return stored order as is, without sorting.
+
+    Backends with shared set to True can be opened by several server
+    processes at once; they also keep the session tokens those processes
+    issue, so every process can look up a token. The others keep tokens
+    in memory, for the one process that opened them.
+    '''
+
+    shared = False
+
+    @abstractmethod
+    def get_user(self, username):
+        '''Return the user record for username, or None'''
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_or_create_user(self, username, password):
+        '''Return the existing record for username, or create it and return None'''
+        raise NotImplementedError
+
+    @abstractmethod
+    def send_message(self, entry, username, recipient, timestamp=None):
+        '''Store a message from username to recipient. False if either is unknown.'''
+        raise NotImplementedError
+
+    @abstractmethod
+    def send_messages(self, username, items):
+        '''Store several messages from username in one transaction.
+
+        items are (entry, recipient, timestamp) triples, timestamp may be
+        None. Returns one bool per item, False where the recipient (or the
+        sender) is unknown; the other items are stored regardless.
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def read_all_messages(self, username):
+        '''Return every message of a user'''
+        raise NotImplementedError
+
+    @abstractmethod
+    def read_unread_messages(self, username, after=0):
+        '''Return the unread messages of a user with an id greater than after'''
+        raise NotImplementedError
+
+    @abstractmethod
+    def ack_messages(self, username, upto=None, ids=()):
+        '''Mark unread messages as read: every one up to id upto, and those in ids.
+
+        Returns how many messages changed, or False if the user is unknown.'''
+        raise NotImplementedError
+
+    @abstractmethod
+    def read_messages_since(self, username, cursor, limit=None, peer=None,
+                            direction=None, start=None, end=None):
+        '''Return (messages stored after cursor, next cursor, more), or False.
+
+        Cursors are opaque non-negative integers issued by the backend; 0
+        means from the beginning. At most limit messages are returned, in
+        timestamp order, and more tells whether another page follows; the
+        next cursor doubles as the continuation token for that page.
+        The cursor is the id of the last message the client has seen.
+
+        The filters keep only the conversation with peer, one direction
+        ('sent' or 'received', see MESSAGE_DIRECTIONS) and timestamps in
+        [start, end). A conversation is read through a per-(user, peer)
+        index, so it costs O(that conversation), not O(every message).
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_session(self, token, username):
+        '''Record that token was issued to username'''
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_session(self, token):
+        '''Return the username token was issued to, or None'''
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_session(self, token):
+        '''Forget token'''
+        raise NotImplementedError
+
+    @abstractmethod
+    def clear_sessions(self):
+        '''Forget every token, as when the server starts'''
+        raise NotImplementedError
+
+    @abstractmethod
+    def commit_stats(self):
+        '''Return commit latency and throughput since the store was opened (see CommitStats)'''
+        raise NotImplementedError
+
+    def close(self):
+        '''Flush anything buffered and release files'''
+
+
+class _MemoryStorage(Storage):
+    '''Message handling shared by the backends that keep users in memory.
+
+    Every change is described by a record ({'op': 'user' | 'message' |
+    'read' | 'messages', ...}) that subclasses persist in _commit() and
+    apply with _apply(); a 'messages' record holds the 'message' records
+    of one batch send. Subclasses also decide how users are locked and looked up,
+    and call _index_user() for every user record they load.
+
+    Next to the records, each user has a queue of their unread messages
+    as (position in 'messages', message dict) pairs, so an unread fetch
+    only ever touches unread messages and an empty one costs O(1), and an
+    index of the positions of their messages with each peer. The id of a
+    message is its position plus one.
+
+    These backends are not shared, so session tokens are kept in a dict
+    (_sessions) that subclasses create.
+    '''
+
+    @abstractmethod
+    def _locked(self, *usernames):
+        '''Return a context manager that guards the given users'''
+        raise NotImplementedError
+
+    def _get(self, username):
+        '''Return the in-memory record for username, or None'''
+        return self.users.get(username, None)
+
+    @abstractmethod
+    def _commit(self, record):
+        '''Persist and apply a record. Caller holds the relevant locks.'''
+        raise NotImplementedError
+
+    def _commit_many(self, records):
+        '''Persist and apply several records, as one batch where the backend can'''
+        for record in records:
+            self._commit(record)
+
+    def _index_user(self, username, user):
+        '''Normalise a user record that was just loaded and build its unread queue'''
+        messages = user['messages']
+        for message in messages:
+            if not isinstance(message['timestamp'], float):
+                message['timestamp'] = _to_timestamp(message['timestamp'])
+        if any(earlier['timestamp'] > later['timestamp']
+               for earlier, later in zip(messages, messages[1:])):
+            # out-of-order import; timsort merges the already sorted runs
+            messages.sort(key=lambda message: message['timestamp'])
+        self._unread[username] = [
+            (position, message)
+            for position, message in enumerate(user['messages'])
+            if message['status'] == 'unread']
+        conversations = self._conversations[username] = {}
+        for position, message in enumerate(messages):
+            peer = message['from'] if 'from' in message else message['recipient']
+            conversations.setdefault(peer, []).append(position)
+
+    def _apply(self, record):
+        '''Apply one log record to the in-memory users'''
+        op = record['op']
+        if op == 'messages':
+            for message_record in record['records']:
+                self._apply(message_record)
+        elif op == 'user':
+            if record['username'] not in self.users:
+                self.users[record['username']] = _new_user(record['password'])
+                self._unread[record['username']] = []
+                self._conversations[record['username']] = {}
+        elif op == 'message':
+            messages = self.users[record['from']]['messages']
+            self._conversations[record['from']].setdefault(
+                record['to'], []).append(len(messages))
+            messages.append(
+                {'message': record['entry'], 'recipient': record['to'],
+                 'timestamp': record['timestamp'], 'status': 'sent'})
+            received = {'message': record['entry'], 'from': record['from'],
+                        'timestamp': record['timestamp'], 'status': 'unread'}
+            messages = self.users[record['to']]['messages']
+            self._conversations[record['to']].setdefault(
+                record['from'], []).append(len(messages))
+            self._unread[record['to']].append((len(messages), received))
+            messages.append(received)
+        elif op == 'read':
+            # 'upto' limits the flip to messages before that position and
+            # 'positions' adds single messages; a bare record flips them all
+            unread = self._unread[record['username']]
+            upto = record.get('upto')
+            flipped = len(unread)
+            if upto is not None:
+                flipped = bisect.bisect_left(unread, upto, key=itemgetter(0))
+            for _, message in unread[:flipped]:
+                message['status'] = 'read'
+            del unread[:flipped]
+            positions = set(record.get('positions', ()))
+            if positions:
+                kept = []
+                for position, message in unread:
+                    if position in positions:
+                        message['status'] = 'read'
+                    else:
+                        kept.append((position, message))
+                unread[:] = kept
+
+    def get_user(self, username):
+        '''Return the user record for username, or None'''
+        with self._locked(username):
+            return self._get(username)
+
+    def get_or_create_user(self, username, password):
+        '''Return the existing record for username, or create it and return None'''
+        with self._locked(username):
+            fetched_user = self._get(username)
+            if fetched_user:
+                return fetched_user
+            self._commit(
+                {'op': 'user', 'username': username, 'password': password})
+            return None
+
+    def send_message(self, entry, username, recipient, timestamp=None):
+        '''Append a message to both the sender and the recipient'''
+        return self.send_messages(username, [(entry, recipient, timestamp)])[0]
+
+    def send_messages(self, username, items):
+        '''Append several messages from username under one lock acquisition'''
+        items = [(entry, recipient,
+                  time.time() if timestamp is None else _to_timestamp(timestamp))
+                 for entry, recipient, timestamp in items]
+        with self._locked(username, *{recipient for _, recipient, _ in items}):
+            sender = self._get(username)
+            last = {}  # newest timestamp per user, including this batch
+            records, statuses = [], []
+            for entry, recipient, timestamp in items:
+                receiver = self._get(recipient)
+                if sender is None or receiver is None:
+                    statuses.append(False)
+                    continue
+                for name, user in ((username, sender), (recipient, receiver)):
+                    if name not in last and user['messages']:
+                        last[name] = user['messages'][-1]['timestamp']
+                    timestamp = max(timestamp, last.get(name, timestamp))
+                last[username] = last[recipient] = timestamp
+                records.append({'op': 'message', 'from': username, 'to': recipient,
+                                'entry': entry, 'timestamp': timestamp})
+                statuses.append(True)
+            self._commit_many(records)
+        return statuses
+
+    def read_all_messages(self, username):
+        '''Return every message of a user'''
+        fetched = self.read_messages_since(username, 0)
+        return fetched and fetched[0]
+
+    def read_messages_since(self, username, cursor, limit=None, peer=None,
+                            direction=None, start=None, end=None):
+        '''Return the messages after cursor, which is a position in the user's message list'''
+        with self._locked(username):
+            fetched_user = self._get(username)
+            if not fetched_user:
+                return False
+            messages = fetched_user['messages']
+            positions = range(len(messages)) if peer is None else \
+                self._conversations[username].get(peer, [])
+            # positions and timestamps both ascend, so the range is two bisections
+            def timestamp(position):
+                return messages[position]['timestamp']
+            first = bisect.bisect_left(positions, cursor)
+            if start is not None:
+                first = max(first, bisect.bisect_left(positions, start, key=timestamp))
+            stop = len(positions) if end is None else \
+                bisect.bisect_left(positions, end, key=timestamp)
+            key = MESSAGE_DIRECTIONS.get(direction)
+            result, next_cursor, more = [], cursor, False
+            for index in range(first, stop):
+                message = messages[positions[index]]
+                if key is not None and key not in message:
+                    continue
+                if limit is not None and len(result) == limit:
+                    more = True
+                    break
+                next_cursor = positions[index] + 1
+                result.append(_format_message(message, next_cursor))
+        return result, next_cursor, more
+
+    def read_unread_messages(self, username, after=0):
+        '''Return the unread messages of a user with an id greater than after'''
+        with self._locked(username):
+            if self._get(username) is None:
+                return False
+            unread = self._unread[username]
+            start = bisect.bisect_left(unread, after, key=itemgetter(0)) if after else 0
+            return [_format_message(message, position + 1)
+                    for position, message in unread[start:]]
+
+    def ack_messages(self, username, upto=None, ids=()):
+        '''Mark messages read with a single 'read' record'''
+        with self._locked(username):
+            if self._get(username) is None:
+                return False
+            unread = self._unread[username]
+            flipped = bisect.bisect_left(unread, upto, key=itemgetter(0)) if upto else 0
+            wanted = {message_id - 1 for message_id in ids}
+            positions = [position for position, _ in unread[flipped:]
+                         if position in wanted]
+            if not flipped and not positions:
+                return 0
+            record = {'op': 'read', 'username': username, 'upto': upto or 0}
+            if positions:
+                record['positions'] = positions
+            self._commit(record)
+        return flipped + len(positions)
+
+    def save_session(self, token, username):
+        self._sessions[token] = username
+
+    def get_session(self, token):
+        return self._sessions.get(token)
+
+    def delete_session(self, token):
+        self._sessions.pop(token, None)
+
+    def clear_sessions(self):
+        self._sessions.clear()
+
+
+class CommitStats:
+    '''Latency and throughput of the commits of a storage backend.
+
+    A commit is one change made durable as a unit: a log record, or a
+    write transaction. add() is called once per write to disk with the
+    latency of every commit it made durable; several commits written
+    together form a batch.
+    '''
+
+    def __init__(self, durability):
+        self.durability = durability
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+        self._commits = 0
+        self._batches = 0
+        self._latency = 0.0
+        self._max_latency = 0.0
+
+    def add(self, latencies):
+        '''Count one batch of commits, given the seconds each of them took'''
+        with self._lock:
+            self._batches += 1
+            self._commits += len(latencies)
+            self._latency += sum(latencies)
+            self._max_latency = max([self._max_latency, *latencies])
+
+    def snapshot(self):
+        '''Return the totals as a JSON-compatible dict'''
+        with self._lock:
+            elapsed = time.perf_counter() - self._started
+            return {
+                'durability': self.durability,
+                'commits': self._commits,
+                'batches': self._batches,
+                'avg_batch': self._commits / self._batches if self._batches else 0,
+                'avg_latency_ms': 1000 * self._latency / self._commits if self._commits else 0,
+                'max_latency_ms': 1000 * self._max_latency,
+                'commits_per_sec': self._commits / elapsed if elapsed else 0}
+
+
+class GroupCommitLog:
+    '''Append-only log file flushed by a background writer thread.
+
+    append() queues a line and returns a ticket; wait(ticket) blocks until
+    that line is as durable as the durability mode promises. The writer
+    drains the queue in batches of up to batch_size lines, waiting at most
+    interval seconds for a batch to fill, so concurrent requests share one
+    write (and one fsync).
+    '''
+
+    def __init__(self, path, first_line, durability='os',
+                 batch_size=GROUP_COMMIT_BATCH, interval=GROUP_COMMIT_INTERVAL):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f'Unknown durability mode {durability}')
+        self.durability = durability
+        self.batch_size = 1 if durability == 'commit' else batch_size
+        self.interval = 0 if durability == 'commit' else interval
+        self._file = open(path, 'w', encoding='utf-8')
+        self._file.write(first_line)
+        self._sync_file()
+        self._cond = threading.Condition()
+        self._queue = []  # (ticket, line, time queued)
+        self._queued = 0  # ticket of the last queued line
+        self._written = 0  # ticket of the last durable line
+        self._closing = False
+        self._stats = CommitStats(durability)
+        self._writer = threading.Thread(target=self._run, daemon=True)
+        self._writer.start()
+
+    def _sync_file(self):
+        self._file.flush()
+        if self.durability != 'os':
+            os.fsync(self._file.fileno())
+
+    def append(self, line):
+        '''Queue a line (ending in a newline) and return its ticket'''
+        with self._cond:
+            self._queued += 1
+            self._queue.append((self._queued, line, time.perf_counter()))
+            self._cond.notify_all()
+            return self._queued
+
+    def wait(self, ticket):
+        '''Block until the line with this ticket is durable. No-op in os mode.'''
+        if self.durability == 'os':
+            return
+        with self._cond:
+            while self._written < ticket:
+                self._cond.wait()
+
+    def sync(self):
+        '''Block until everything queued so far has been written out'''
+        with self._cond:
+            while self._written < self._queued:
+                self._cond.wait()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closing:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                deadline = time.perf_counter() + self.interval
+                while len(self._queue) < self.batch_size and not self._closing:
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._queue[:self.batch_size]
+                del self._queue[:self.batch_size]
+            self._file.write(''.join(line for _, line, _ in batch))
+            self._sync_file()
+            now = time.perf_counter()
+            self._stats.add([now - queued_at for _, _, queued_at in batch])
+            with self._cond:
+                self._written = batch[-1][0]
+                self._cond.notify_all()
+
+    def truncate(self, first_line):
+        '''Write out what is queued, then empty the file and start it with first_line'''
+        self.sync()
+        with self._cond:
+            self._file.seek(0)
+            self._file.truncate()
+            self._file.write(first_line)
+            self._sync_file()
+
+    def stats(self):
+        '''Return commit latency and throughput since the log was opened'''
+        return self._stats.snapshot()
+
+    def close(self):
+        '''Write out what is queued and stop the writer'''
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._writer.join()
+        self._file.close()
+
+
+class JsonStorage(_MemoryStorage):
+    '''In-memory user store backed by users.json plus an append-only log.
+
+    Every mutation is written to the log as one JSON line before it is
+    applied in memory, so a request costs one small append instead of a
+    rewrite of the whole store. The first line of the log names the sha1
+    of the snapshot it applies to; a log left behind by a compaction that
+    crashed after replacing users.json no longer matches and is dropped.
+
+    The log is a GroupCommitLog. A request queues its record under the
+    store lock but waits for it to be flushed only after releasing the
+    lock, so concurrent requests end up in the same flush.
+    '''
+
+    def __init__(self, store_dir, compact_every=COMPACT_EVERY,
+                 durability='os'):
+        self.store_dir = Path(store_dir)
+        self.users_path = self.store_dir / USERS_PATH
+        self.log_path = self.store_dir / LOG_PATH
+        self.compact_every = compact_every
+        self.durability = durability
+        self.users = {}
+        self._unread = {}
+        self._conversations = {}  # user -> peer -> positions of their messages
+        self._sessions = {}  # token -> user
+        self._lock = threading.Lock()
+        self._pending = threading.local()  # ticket of this thread's last commit
+        self._log = None
+        self._log_records = 0
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        '''Read the snapshot and replay the log on top of it'''
+        if not self.users_path.exists():
+            with self.users_path.open('w') as json_file:
+                json.dump({}, json_file, indent=4)
+        data = self.users_path.read_bytes()
+        base = hashlib.sha1(data).hexdigest()
+        self.users = json.loads(data or b'{}')
+        for username, user in self.users.items():
+            self._index_user(username, user)
+
+        replayed = 0
+        if self.log_path.exists():
+            with self.log_path.open('r', encoding='utf-8') as log_file:
+                header = log_file.readline()
+                if header.strip() and json.loads(header).get('sha1') == base:
+                    for line in log_file:
+                        try:
+                            record = json.loads(line)
+                        except json.JSONDecodeError:
+                            break  # torn write at the tail of the log
+                        self._apply(record)
+                        replayed += 1
+
+        if replayed:
+            self._compact_locked()
+        else:
+            self._start_log(base)
+
+    def _start_log(self, base):
+        '''Truncate the log and tag it with the snapshot it applies to'''
+        header = json.dumps({'op': 'base', 'sha1': base}) + '\n'
+        if self._log:
+            self._log.truncate(header)
+        else:
+            self._log = GroupCommitLog(self.log_path, header, self.durability)
+        self._log_records = 0
+
+    @contextmanager
+    def _locked(self, *usernames):
+        self._pending.ticket = None
+        with self._lock:
+            yield
+        if self._pending.ticket is not None:
+            self._log.wait(self._pending.ticket)
+
+    def _commit(self, record):
+        '''Log a mutation, then apply it. Caller holds the lock.'''
+        self._pending.ticket = self._log.append(json.dumps(record) + '\n')
+        self._apply(record)
+        self._log_records += 1
+        if self._log_records >= self.compact_every:
+            self._compact_locked()
+
+    def _commit_many(self, records):
+        '''Log the records of a batch send as one 'messages' line, then apply them.
+
+        One line is written and replayed whole or, when its write was torn,
+        not at all, and compaction never runs in the middle of a batch.'''
+        if len(records) == 1:
+            self._commit(records[0])
+        elif records:
+            self._commit({'op': 'messages', 'records': records})
+
+    def _compact_locked(self):
+        '''Fold the log into users.json and start a fresh log'''
+        data = json.dumps(self.users).encode()
+        tmp_path = self.users_path.with_suffix('.json.tmp')
+        with tmp_path.open('wb') as tmp_file:
+            tmp_file.write(data)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, self.users_path)
+        self._start_log(hashlib.sha1(data).hexdigest())
+
+    def compact(self):
+        '''Write a snapshot of all users to users.json and truncate the log'''
+        with self._lock:
+            self._compact_locked()
+
+    def commit_stats(self):
+        '''Every log record is a commit; a batch is one flush of the log'''
+        return self._log.stats()
+
+    def close(self):
+        '''Compact and release the log file'''
+        with self._lock:
+            if self._log:
+                self._compact_locked()
+                self._log.close()
+                self._log = None
+
+
+class ShardedStorage(_MemoryStorage):
+    '''One JSON file per user under store/users/, with one lock per user.
+
+    A direct message locks only the sender and the recipient, always in
+    sorted order so two opposite sends cannot deadlock, and rewrites only
+    those two files. A user's lock lives only while someone holds or waits
+    for it. Users are loaded on first use. An existing users.json is split
+    into per-user files the first time the sharded layout is opened; the
+    files are written to a temporary directory that is renamed into place
+    once complete, so an interrupted split is started over. Any durability
+    mode but os fsyncs every file write.
+
+    Each file is replaced atomically, but there is no atomicity across
+    files: a crash while a batch send rewrites the files of its users can
+    leave it stored for some of them only, and a crash between the two
+    files of a single message can leave it with the sender or the
+    recipient only.
+    '''
+
+    def __init__(self, store_dir, durability='os'):
+        self.store_dir = Path(store_dir)
+        self.durability = durability
+        self.shards_dir = self.store_dir / SHARDS_PATH
+        self.users = {}
+        self._unread = {}
+        self._conversations = {}  # user -> peer -> positions of their messages
+        self._sessions = {}  # token -> user
+        self._locks = weakref.WeakValueDictionary()  # user -> lock, while in use
+        self._locks_lock = threading.Lock()
+        self._stats = CommitStats(durability)
+        if not self.shards_dir.exists():
+            self._split_users_json()
+
+    def _split_users_json(self):
+        '''Create the shards directory, with a file per user of an existing users.json'''
+        tmp_dir = self.shards_dir.with_name(self.shards_dir.name + '.tmp')
+        if tmp_dir.exists():
+            shutil.rmtree(tmp_dir)  # left behind by an interrupted split
+        tmp_dir.mkdir(parents=True)
+        users_path = self.store_dir / USERS_PATH
+        if users_path.exists():
+            with users_path.open('r') as user_file:
+                for username, user in json.load(user_file).items():
+                    self._write_user(username, user, tmp_dir)
+        os.replace(tmp_dir, self.shards_dir)
+
+    def _user_path(self, username, shards_dir=None):
+        return (shards_dir or self.shards_dir) / f'{quote(username, safe="")}.json'
+
+    def _lock_for(self, username):
+        # callers keep the lock referenced while they use it
+        with self._locks_lock:
+            lock = self._locks.get(username)
+            if lock is None:
+                lock = self._locks[username] = threading.Lock()
+            return lock
+
+    @contextmanager
+    def _locked(self, *usernames):
+        locks = [self._lock_for(name) for name in sorted(set(usernames))]
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def _get(self, username):
+        fetched_user = self.users.get(username, None)
+        if fetched_user is None:
+            user_path = self._user_path(username)
+            if user_path.exists():
+                with user_path.open('r') as user_file:
+                    fetched_user = json.load(user_file)
+                self._index_user(username, fetched_user)
+                self.users[username] = fetched_user
+        return fetched_user
+
+    def _write_user(self, username, user, shards_dir=None):
+        '''Atomically replace the file of a single user'''
+        user_path = self._user_path(username, shards_dir)
+        tmp_path = user_path.with_name(user_path.name + '.tmp')
+        with tmp_path.open('w') as user_file:
+            json.dump(user, user_file)
+            if self.durability != 'os':
+                user_file.flush()
+                os.fsync(user_file.fileno())
+        os.replace(tmp_path, user_path)
+
+    def _commit(self, record):
+        self._commit_many([record])
+
+    def _commit_many(self, records):
+        '''Apply the records, then rewrite each touched user file once (atomically per
+        file, not across files)'''
+        if not records:
+            return
+        started = time.perf_counter()
+        touched = set()
+        for record in records:
+            self._apply(record)
+            if record['op'] == 'message':
+                touched.update((record['from'], record['to']))
+            else:
+                touched.add(record['username'])
+        for username in touched:
+            self._write_user(username, self.users[username])
+        self._stats.add([time.perf_counter() - started])
+
+    def commit_stats(self):
+        '''Every commit rewrites the files of the users it touches'''
+        return self._stats.snapshot()
+
+    def close(self):
+        '''Nothing is buffered; every commit already wrote its files'''
+
+
+class SqliteStorage(Storage):
+    '''Users and messages in a SQLite database (store/users.db).
+
+    Each message is stored once per owner: the sender's copy has
+    direction 'recipient' and the recipient's copy has direction 'from',
+    mirroring the users.json schema. Indexes on (username, status) and
+    (username, timestamp) make unread lookups and ordered history reads
+    index scans, the (username, id) index serves cursor fetches and
+    (username, peer, id) serves the fetches of one conversation.
+    Every thread gets its own connection. The durability modes map onto
+    PRAGMA synchronous: commit is FULL, batch is NORMAL (WAL syncs at
+    checkpoints) and os is OFF.
+
+    SQLite does its own locking between processes, so this backend is
+    shared: the sessions table holds the tokens of every server process.
+    '''
+
+    shared = True
+    SYNCHRONOUS = {'commit': 'FULL', 'batch': 'NORMAL', 'os': 'OFF'}
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            password TEXT NOT NULL,
+            bio TEXT NOT NULL DEFAULT '{"entry": "", "timestamp": ""}',
+            posts TEXT NOT NULL DEFAULT '[]');
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL,
+            peer TEXT NOT NULL,
+            direction TEXT NOT NULL CHECK (direction IN ('from', 'recipient')),
+            message TEXT NOT NULL,
+            timestamp REAL NOT NULL,
+            status TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS messages_by_status
+            ON messages (username, status);
+        CREATE INDEX IF NOT EXISTS messages_by_timestamp
+            ON messages (username, timestamp);
+        CREATE INDEX IF NOT EXISTS messages_by_id
+            ON messages (username, id);
+        CREATE INDEX IF NOT EXISTS messages_by_peer
+            ON messages (username, peer, id);
+        CREATE TABLE IF NOT EXISTS sessions (
+            token TEXT PRIMARY KEY,
+            username TEXT NOT NULL);
+    '''
+
+    def __init__(self, store_dir, db_name=DB_PATH, durability='commit'):
+        self.store_dir = Path(store_dir)
+        self.durability = durability
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        self.db_path = self.store_dir / db_name
+        self._local = threading.local()
+        self._conns = []
+        self._conns_lock = threading.Lock()
+        self._stats = CommitStats(durability)
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(self.SCHEMA)
+
+    def _conn(self):
+        '''Return the connection of the calling thread'''
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute(
+                f'PRAGMA synchronous={self.SYNCHRONOUS[self.durability]}')
+            self._local.conn = conn
+            with self._conns_lock:
+                self._conns.append(conn)
+        return conn
+
+    def get_user(self, username):
+        row = self._conn().execute(
+            'SELECT password, bio, posts FROM users WHERE username = ?',
+            (username,)).fetchone()
+        if row is None:
+            return None
+        return {'password': row[0], 'bio': json.loads(row[1]),
+                'posts': json.loads(row[2])}
+
+    def get_or_create_user(self, username, password):
+        started = time.perf_counter()
+        created = self._conn().execute(
+            'INSERT OR IGNORE INTO users (username, password) VALUES (?, ?)',
+            (username, password)).rowcount
+        if created:
+            self._stats.add([time.perf_counter() - started])
+            return None
+        return self.get_user(username)
+
+    def send_message(self, entry, username, recipient, timestamp=None):
+        return self.send_messages(username, [(entry, recipient, timestamp)])[0]
+
+    def send_messages(self, username, items):
+        items = [(entry, recipient,
+                  time.time() if timestamp is None else _to_timestamp(timestamp))
+                 for entry, recipient, timestamp in items]
+        names = sorted({username} | {recipient for _, recipient, _ in items})
+        conn = self._conn()
+        started = time.perf_counter()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            known = set()
+            for start in range(0, len(names), 500):  # under SQLite's parameter limit
+                chunk = names[start:start + 500]
+                known.update(row[0] for row in conn.execute(
+                    f'SELECT username FROM users WHERE username IN '
+                    f'({", ".join("?" * len(chunk))})', chunk))
+            last = {}  # newest timestamp per user, including this batch
+            rows, statuses = [], []
+            for entry, recipient, timestamp in items:
+                if username not in known or recipient not in known:
+                    statuses.append(False)
+                    continue
+                for name in (username, recipient):
+                    if name not in last:
+                        last[name] = conn.execute(
+                            'SELECT MAX(timestamp) FROM messages WHERE username = ?',
+                            (name,)).fetchone()[0]
+                    if last[name] is not None:
+                        timestamp = max(timestamp, last[name])
+                last[username] = last[recipient] = timestamp
+                rows.append((username, recipient, 'recipient', entry, timestamp, 'sent'))
+                rows.append((recipient, username, 'from', entry, timestamp, 'unread'))
+                statuses.append(True)
+            conn.executemany(
+                'INSERT INTO messages (username, peer, direction, message, '
+                'timestamp, status) VALUES (?, ?, ?, ?, ?, ?)', rows)
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        else:
+            conn.execute('COMMIT')
+        if rows:
+            self._stats.add([time.perf_counter() - started])
+        return statuses
+
+    def _user_exists(self, conn, username):
+        return conn.execute('SELECT 1 FROM users WHERE username = ?',
+                            (username,)).fetchone() is not None
+
+    def read_all_messages(self, username):
+        fetched = self.read_messages_since(username, 0)
+        return fetched and fetched[0]
+
+    def read_messages_since(self, username, cursor, limit=None, peer=None,
+                            direction=None, start=None, end=None):
+        '''The cursor is the id of the last message row the client has seen'''
+        conn = self._conn()
+        if not self._user_exists(conn, username):
+            return False
+        where, params = ['username = ?', 'id > ?'], [username, cursor]
+        for clause, value in (('peer = ?', peer),
+                              ('direction = ?', MESSAGE_DIRECTIONS.get(direction)),
+                              ('timestamp >= ?', start),
+                              ('timestamp < ?', end)):
+            if value is not None:
+                where.append(clause)
+                params.append(value)
+        rows = conn.execute(
+            f'SELECT id, direction, peer, message, timestamp, status '
+            f'FROM messages WHERE {" AND ".join(where)} ORDER BY id LIMIT ?',
+            (*params, -1 if limit is None else limit + 1)).fetchall()
+        more = limit is not None and len(rows) > limit
+        if more:
+            rows = rows[:limit]
+        next_cursor = rows[-1][0] if rows else cursor
+        result = [{'id': row_id, direction: peer, 'message': message,
+                   'timestamp': timestamp}
+                  for row_id, direction, peer, message, timestamp, _ in rows]
+        return result, next_cursor, more
+
+    def read_unread_messages(self, username, after=0):
+        '''Message ids are row ids, so after is compared with the row id'''
+        conn = self._conn()
+        # a single index probe on (username, status); never a write
+        rows = conn.execute(
+            'SELECT id, direction, peer, message, timestamp FROM messages '
+            'WHERE username = ? AND status = ? AND id > ? ORDER BY id',
+            (username, 'unread', after)).fetchall()
+        if not rows and not self._user_exists(conn, username):
+            return False
+        return [{'id': row_id, direction: peer, 'message': message,
+                 'timestamp': timestamp}
+                for row_id, direction, peer, message, timestamp in rows]
+
+    def ack_messages(self, username, upto=None, ids=()):
+        conn = self._conn()
+        if not self._user_exists(conn, username):
+            return False
+        ids = list(ids)
+        if not upto and not ids:
+            return 0
+        changed = 0
+        started = time.perf_counter()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if upto:
+                changed += conn.execute(
+                    "UPDATE messages SET status = 'read' "
+                    "WHERE username = ? AND status = 'unread' AND id <= ?",
+                    (username, upto)).rowcount
+            for start in range(0, len(ids), 500):  # under SQLite's parameter limit
+                chunk = ids[start:start + 500]
+                changed += conn.execute(
+                    f"UPDATE messages SET status = 'read' "
+                    f"WHERE username = ? AND status = 'unread' AND id IN "
+                    f"({', '.join('?' * len(chunk))})", [username, *chunk]).rowcount
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        if changed:
+            self._stats.add([time.perf_counter() - started])
+        return changed
+
+    def save_session(self, token, username):
+        self._conn().execute(
+            'INSERT OR REPLACE INTO sessions (token, username) VALUES (?, ?)',
+            (token, username))
+
+    def get_session(self, token):
+        row = self._conn().execute(
+            'SELECT username FROM sessions WHERE token = ?', (token,)).fetchone()
+        return row and row[0]
+
+    def delete_session(self, token):
+        self._conn().execute('DELETE FROM sessions WHERE token = ?', (token,))
+
+    def clear_sessions(self):
+        self._conn().execute('DELETE FROM sessions')
+
+    def commit_stats(self):
+        '''Every write transaction on users or messages is a commit; sessions are not counted'''
+        return self._stats.snapshot()
+
+    def close(self):
+        with self._conns_lock:
+            for conn in self._conns:
+                conn.close()
+            self._conns = []
+        self._local = threading.local()
+
+
+def migrate_json_to_sqlite(store_dir, db_name=DB_PATH):
+    '''Copy every user and message of a JSON store into a SQLite store.
+
+    The JSON store is opened through JsonStorage so that entries still
+    waiting in users.log are included. Returns the number of users copied.
+    '''
+    source = JsonStorage(store_dir)
+    target = SqliteStorage(store_dir, db_name)
+    conn = target._conn()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        for username, user in source.users.items():
+            conn.execute(
+                'INSERT OR REPLACE INTO users (username, password, bio, posts) '
+                'VALUES (?, ?, ?, ?)',
+                (username, user['password'],
+                 json.dumps(user.get('bio', {'entry': '', 'timestamp': ''})),
+                 json.dumps(user.get('posts', []))))
+            conn.execute('DELETE FROM messages WHERE username = ?', (username,))
+            # JsonStorage already put the messages in timestamp order, which
+            # keeps the row ids of each user in timestamp order too
+            conn.executemany(
+                'INSERT INTO messages (username, peer, direction, message, '
+                'timestamp, status) VALUES (?, ?, ?, ?, ?, ?)',
+                [(username,
+                  message['from'] if 'from' in message else message['recipient'],
+                  'from' if 'from' in message else 'recipient',
+                  message['message'], message['timestamp'], message['status'])
+                 for message in user['messages']])
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+    source.close()
+    target.close()
+    return len(source.users)
+
+
+if __name__ == '__main__':
+    migrate_dir = sys.argv[1] if len(sys.argv) >= 2 else 'store'
+    count = migrate_json_to_sqlite(migrate_dir)
+    print(f'Migrated {count} users into {Path(migrate_dir) / DB_PATH}')
@@ -19,14 +19,8 @@ Handles diary entries, contacts, chats, and file operations for user notebooks.
 import json
 import time as time_module
 from pathlib import Path
-from collections import namedtuple
+from ds_protocol import MessageRecord, MessageBatch
 
-MessageReceived = namedtuple(
-    'MessageReceived', [
-        'message', 'from_name', 'timestamp', 'status'])
-MessageSent = namedtuple(
-    'MessageSent', [
-        'message', 'recipient', 'timestamp', 'status'])
 
 class NotebookFileError(Exception):
     """
@@ -78,6 +72,30 @@ class Diary(dict):
     timestamp = property(get_time, set_time)
 
 
+def _chat_to_json(obj):
+    """Convert the messages of a chat for json.dump."""
+    if isinstance(obj, MessageBatch):
+        return obj.to_json()
+    if isinstance(obj, MessageRecord):
+        return list(obj)
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+def _load_chats(chats: dict) -> dict:
+    """Hold each chat read from a notebook file in a MessageBatch.
+
+    Messages are stored as [message, peer, timestamp, status, id] lists;
+    a chat holding anything else is kept as the list it was.
+    """
+    loaded = {}
+    for contact, messages in chats.items():
+        try:
+            loaded[contact] = MessageBatch(messages)
+        except (TypeError, ValueError):
+            loaded[contact] = messages
+    return loaded
+
+
 class Notebook:
     """Notebook is a class that can be used to manage a diary notebook."""
 
@@ -89,6 +107,7 @@ class Notebook:
         self._diaries = []
         self.contacts = []
         self.chats = {}
+        self.cursor = 0  # server cursor messages were retrieved up to
 
     def add_diary(self, diary: Diary) -> None:
         """Append a Diary object to the diary list."""
@@ -118,7 +137,7 @@ class Notebook:
         if file_path.suffix == '.json':
             try:
                 with open(file_path, 'w', encoding='utf-8') as file:
-                    json.dump(self.__dict__, file, indent=4)
+                    json.dump(self.__dict__, file, indent=4, default=_chat_to_json)
             except Exception as ex:
                 raise NotebookFileError(
                     "Error while attempting to process the notebook file.", ex
@@ -143,30 +162,33 @@ class Notebook:
                         diary = Diary(diary_obj['entry'], diary_obj['timestamp'])
                         self._diaries.append(diary)
                     self.contacts = obj.get('contacts', [])
-                    self.chats = obj.get('chats', {})
+                    self.chats = _load_chats(obj.get('chats', {}))
+                    self.cursor = obj.get('cursor', 0)
             except Exception as ex:
                 raise IncorrectNotebookError(ex) from ex
         else:
             raise NotebookFileError()
-        self.chats = obj.get('chats', {})
 
     def add_contact_and_message(
             self,
             path: str,
             contact: str,
-            message: namedtuple = None) -> None:
+            message: MessageRecord = None) -> None:
         """
         Add a message to the chat history with a contact.
         Args:
             contact (str): The contact's username.
-            message (namedtuple): The message object.
+            message (MessageRecord): The message object.
         """
         if contact and contact not in self.contacts:
             self.contacts.append(contact)
         if contact and contact not in self.chats:
-            self.chats[contact] = []
+            self.chats[contact] = MessageBatch()
         if contact and message:
-            self.chats[contact].append(message)
+            chat = self.chats[contact]
+            if isinstance(chat, MessageBatch) and not isinstance(message, MessageRecord):
+                chat = self.chats[contact] = list(chat)
+            chat.append(message)
         self.save(path)
 
     def load_local_contacts_and_chats(self, username, password) -> bool:
@@ -1,22 +1,69 @@
+import argparse
+import asyncio
+import heapq
+import itertools
+import multiprocessing
+import os
+import selectors
 import socket
 import threading
 import json
+import logging
+from bisect import bisect_left
+from collections import deque
+from collections.abc import MutableMapping
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
-import sys
 from datetime import datetime
 import string
 import secrets
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+from ds_protocol import (BINARY_FRAME, DSPError, MessageFramer, compress_frame,
+                         decode_binary, encode_frame)
+from ds_storage import (DURABILITY_MODES, MESSAGE_DIRECTIONS, JsonStorage,
+                        ShardedStorage, SqliteStorage)
 
-USERS_PATH = 'users.json'
 STORE_DIR_PATH = 'store'
-DEBUG = True  # SET THIS TO FALSE IF YOU DONT WANT DEBUGGING OUTPUT
+LOG_LEVEL = 'INFO'  # DEBUG logs every message received and sent; costly under load
+MAX_FETCH_LIMIT = 1000  # largest page a paginated fetch returns
+MAX_LINE_BYTES = 1 << 20  # longest command line the server accepts
+RECV_BYTES = 65536  # bytes read from a client socket at a time
+LISTEN_BACKLOG = 128  # listen backlog of the threaded server
+ASYNC_BACKLOG = 1024  # listen backlog of the asyncio server
+WORKERS = 64  # threads executing requests in the threaded server
+MAX_CONNECTIONS = 1024  # connections open at once; more are turned away
+ASYNC_MAX_CONNECTIONS = 65536  # the same for the asyncio server, where a connection is a coroutine
+IDLE_TIMEOUT = 300  # seconds a silent, unsubscribed connection is kept open (0 keeps it forever)
+PROCESS_WAKEUP = 0.5  # seconds between storage checks of long-poll fetches when several processes serve
+BUSY_REPLY = b'{"response": {"type": "error", "message": "Server busy, try again later."}}\r\n'
+MAX_OUTBOUND_BYTES = 1 << 20  # unsent bytes a connection may queue before pushes to it stop
+ASYNC_STORAGE_WORKERS = 8  # threads running storage work for the asyncio server
+MAX_BATCH_MESSAGES = 1000  # most messages a batch directmessage may carry
+FETCH_FILTERS = ('peer', 'direction', 'start', 'end')  # optional filters of a cursor fetch
+FETCH_FIELDS = {'since', 'limit', *FETCH_FILTERS}
+COMPRESSIONS = ('zlib',)  # reply compressions a client may ask for when authenticating
+COMPRESS_THRESHOLD = 1024  # default size from which replies are compressed, in bytes
+COMPRESS_LEVEL = 1  # zlib level; repetitive JSON shrinks well even at the fastest level
+ENCODINGS = ('json', 'binary')  # wire encodings a client may ask for when authenticating
+MAX_FETCH_WAIT = 60  # longest a long-poll fetch is held open, in seconds
+COMMAND_KINDS = ('authenticate', 'directmessage', 'subscribe', 'ack', 'fetch', 'stats')  # in dispatch order
+LATENCY_BUCKETS_MS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500,
+                      1000, 2500, 5000)  # upper bounds of the latency histogram buckets
+
+logger = logging.getLogger('server')
 
 # The server uses a json files to store data:
 # users - bio's, posts
+# users are kept in memory by JsonStorage; every change is appended to
+# store/users.log and folded back into users.json periodically
 
 # user schema:
 # {user_name: {'password', messages[{'entry','from/recipient', 'timestamp','status'}]
-# status can be "unread" or "read"
+# timestamp is a float and each user's messages are kept in timestamp order
+# status can be "unread" or "read"; fetches never change it, an "ack" command does
+# messages are sent to clients with an "id" that the ack command refers to
 # "from" denotes the user recieved the message and "recipient" denotes that they sent it
 
 
@@ -26,350 +73,1391 @@ def generate_token():
         _generate_random_string(4)}-{_generate_random_string(12)}'
 
 
+def _is_count(value) -> bool:
+    '''True for non-negative ints (and not bools), as used by cursors and limits'''
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+
+def _is_seconds(value) -> bool:
+    '''True for non-negative ints and floats (and not bools), as used by fetch waits'''
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and value >= 0
+
+
+def _batch_items(args):
+    '''(entry, recipient) pairs of a batch directmessage, or None if it is malformed.
+
+    A batch is either a list of {'entry', 'recipient'} objects or one
+    {'entry', 'recipients'} object; timestamps are allowed and ignored.'''
+    if isinstance(args, dict):
+        recipients = args.get('recipients')
+        if (not set(args) <= {'entry', 'recipients', 'timestamp'} or 'entry' not in args
+                or not isinstance(recipients, list)):
+            return None
+        items = [(args['entry'], recipient) for recipient in recipients]
+    else:
+        if not all(isinstance(item, dict) and 'entry' in item and 'recipient' in item
+                   and set(item) <= {'entry', 'recipient', 'timestamp'} for item in args):
+            return None
+        items = [(item['entry'], item['recipient']) for item in args]
+    if not 0 < len(items) <= MAX_BATCH_MESSAGES or not all(
+            isinstance(entry, str) and isinstance(recipient, str)
+            for entry, recipient in items):
+        return None
+    return items
+
+
+def _compress_threshold(option):
+    '''Reply size from which to compress, for an authenticate compress option; None if unsupported'''
+    if not isinstance(option, dict) or not set(option) <= {'method', 'threshold'} \
+            or option.get('method') not in COMPRESSIONS:
+        return None
+    threshold = option.get('threshold', COMPRESS_THRESHOLD)
+    return threshold if _is_count(threshold) else None
+
+
+async def _read_command(reader):
+    '''Read the next command from an asyncio stream: a stripped JSON line, or the dict
+    decoded from a binary frame. Blank lines are skipped, as by MessageFramer.
+    Returns '' once the stream ends.'''
+    first = await reader.read(1)
+    while first != BINARY_FRAME:
+        line = (first + await reader.readline()).decode().strip()
+        if line or not first:
+            return line
+        first = await reader.read(1)
+    length = int.from_bytes(await reader.readexactly(4), 'big')
+    if length > MAX_LINE_BYTES:
+        raise DSPError('Frame longer than the maximum line length')
+    return decode_binary(await reader.readexactly(length))
+
+
 def _generate_random_string(n: int) -> str:
     '''Generate a randm alphanumeric string of length n'''
     alphanums = string.ascii_letters + string.digits
     return ''.join(secrets.choice(alphanums) for _ in range(n))
 
 
-users_file_lock = threading.Lock()
+class ClientSession:
+    '''State of one client connection.
+
+    send(data, push=False) queues bytes for the connection and may be called
+    from any thread; it never waits for the client. With push, as used for
+    direct messages pushed to subscribed connections, it raises OSError
+    instead once MAX_OUTBOUND_BYTES are waiting, so a client that stops
+    reading cannot hold up the users sending to it.'''
+
+    def __init__(self, address, send=None):
+        self.address = address
+        self.send = send
+        self.token = None  # set once the connection authenticated
+        self.adopted = False  # whether token was issued by another process
+        self.last_active = time.monotonic()  # when the client last sent something
+        self.subscribed_as = None  # username whose messages are pushed here
+        self.pushed_upto = 0  # id of the newest message pushed here
+        self.compress_threshold = None  # replies this large are compressed, once negotiated
+        self.binary = False  # whether replies and pushes are sent as binary frames
+        self.push_lock = threading.Lock()
+
+
+class _Connection:
+    '''A client socket of the threaded server, read by its selector loop.
+
+    busy is set while a worker serves the commands waiting in commands, or
+    while a long-poll fetch (poll) is parked; parked is then the callback
+    that resumes it. Bytes the socket did not take yet wait in outbox and
+    are written by the loop. All of these are guarded by lock.'''
+
+    def __init__(self, client_socket, session):
+        self.socket = client_socket
+        self.session = session
+        self.framer = MessageFramer(MAX_LINE_BYTES)
+        self.commands = deque()
+        self.lock = threading.Lock()
+        self.busy = False
+        self.closed = False
+        self.poll = None  # (command, username, deadline) of a parked long-poll fetch
+        self.parked = None
+        self.outbox = deque()
+        self.outbox_bytes = 0
+
+
+class MessageNotifier:
+    '''Wakes up long-poll fetches when a message arrives for their user.
+
+    Every delivered message bumps the recipient's generation. A fetch
+    remembers the generation before it reads the unread messages and then
+    waits for it to change, so a message stored in between is never missed.
+    Parked requests and coroutines register a callback with watch().'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._generations = {}  # user -> messages delivered so far
+        self._watchers = {}  # user -> [callback] called on the next message
+
+    def generation(self, username):
+        with self._lock:
+            return self._generations.get(username, 0)
+
+    def notify(self, username):
+        '''Record a new message for username and wake everyone waiting for one'''
+        with self._lock:
+            self._generations[username] = self._generations.get(username, 0) + 1
+            watchers = self._watchers.pop(username, [])
+        for callback in watchers:
+            callback()
+
+    def watch(self, username, generation, callback):
+        '''Call callback() from the notifying thread once username's generation differs
+        from generation. Returns False, without registering, if it already does.'''
+        with self._lock:
+            if self._generations.get(username, 0) != generation:
+                return False
+            self._watchers.setdefault(username, []).append(callback)
+        return True
+
+    def unwatch(self, username, callback):
+        '''Forget a callback registered with watch() that is no longer needed'''
+        with self._lock:
+            watchers = self._watchers.get(username)
+            if watchers and callback in watchers:
+                watchers.remove(callback)
+                if not watchers:
+                    del self._watchers[username]
+
+    async def wait_async(self, username, generation, timeout):
+        '''Wait until username's generation differs from generation, holding no
+        thread; False on timeout'''
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def waiter():
+            loop.call_soon_threadsafe(_resolve, future)
+
+        if not self.watch(username, generation, waiter):
+            return True
+        try:
+            await asyncio.wait_for(future, timeout)
+            return True
+        except asyncio.TimeoutError:
+            self.unwatch(username, waiter)
+            return False
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class _StatsShard:
+    '''The counters of one thread; only that thread writes them'''
+
+    def __init__(self):
+        kinds = COMMAND_KINDS + ('invalid',)
+        self.counts = dict.fromkeys(kinds, 0)
+        self.errors = dict.fromkeys(kinds, 0)
+        self.latency = {kind: [0] * (len(LATENCY_BUCKETS_MS) + 1) for kind in kinds}
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+
+class ServerStats:
+    '''Request counts, error counts, latency histograms and message bytes moved.
+
+    Every thread records into a shard of its own, so recording takes no
+    lock; snapshot() adds the shards up. Shards never change shape after
+    they are created, so they can be read while their thread updates them.
+    A snapshot is therefore not atomic, which is fine for monitoring.'''
+
+    def __init__(self):
+        self.started = time.time()
+        self._local = threading.local()
+        self._shards = []
+        self._shards_lock = threading.Lock()
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = _StatsShard()
+            with self._shards_lock:
+                self._shards.append(shard)
+        return shard
+
+    def record(self, kind, seconds, error):
+        '''Count a command of the given kind; seconds is None to leave it out of the latencies'''
+        shard = self._shard()
+        shard.counts[kind] += 1
+        if error:
+            shard.errors[kind] += 1
+        if seconds is not None:
+            shard.latency[kind][bisect_left(LATENCY_BUCKETS_MS, seconds * 1000)] += 1
+
+    def add_bytes(self, read=0, written=0):
+        '''Count message bytes read from or written to storage'''
+        shard = self._shard()
+        shard.bytes_read += read
+        shard.bytes_written += written
+
+    def snapshot(self):
+        '''Return the totals of every thread as a JSON-compatible dict'''
+        with self._shards_lock:
+            shards = list(self._shards)
+        kinds = COMMAND_KINDS + ('invalid',)
+        latency = {}
+        for kind in kinds:
+            buckets = [sum(column) for column in zip(*(shard.latency[kind] for shard in shards))]
+            if any(buckets):
+                latency[kind] = {
+                    'count': sum(buckets),
+                    **{f'p{q}_ms': _percentile(buckets, q / 100) for q in (50, 95, 99)}}
+        return {
+            'uptime': time.time() - self.started,
+            'commands': {kind: sum(shard.counts[kind] for shard in shards) for kind in kinds},
+            'errors': {kind: sum(shard.errors[kind] for shard in shards) for kind in kinds},
+            'latency': latency,
+            'storage': {
+                'bytes_read': sum(shard.bytes_read for shard in shards),
+                'bytes_written': sum(shard.bytes_written for shard in shards)}}
+
+
+def _percentile(buckets, fraction):
+    '''Upper bound, in ms, of the histogram bucket holding the given fraction of samples'''
+    rank = fraction * sum(buckets)
+    seen = 0
+    for bound, count in zip(LATENCY_BUCKETS_MS, buckets):
+        seen += count
+        if seen >= rank:
+            return bound
+    return LATENCY_BUCKETS_MS[-1]  # slower than every bound
+
+
+class SharedSessions(MutableMapping):
+    '''token -> user mapping shared by every process of a multi-process server.
+
+    Tokens are kept in the storage backend, so a token issued by another
+    process can be looked up; tokens issued by this process are also cached
+    in memory, and iterating only lists those.'''
+
+    def __init__(self, storage):
+        self.storage = storage
+        self._local = {}
+
+    def __getitem__(self, token):
+        username = self._local.get(token) or self.storage.get_session(token)
+        if username is None:
+            raise KeyError(token)
+        return username
+
+    def __setitem__(self, token, username):
+        self.storage.save_session(token, username)
+        self._local[token] = username
+
+    def __delitem__(self, token):
+        self._local.pop(token, None)
+        self.storage.delete_session(token)
+
+    def __iter__(self):
+        return iter(self._local)
+
+    def __len__(self):
+        return len(self._local)
 
 
 class DSUServer:
-    def __init__(self, host='127.0.0.1', port=3001):
+    '''Reads every connection on one selector loop and executes their requests
+    on a fixed pool of worker threads.
+
+    A connection only holds a worker while one of its requests runs; a
+    long-poll fetch waits without one. Once max_connections are open, a new
+    connection is answered with an error and closed straight away.
+    Connections that stay silent for idle_timeout seconds are closed,
+    unless they are subscribed and just waiting for pushes.
+
+    With reuse_port, several server processes can listen on the same port
+    (see run_processes); wakeup_interval then makes long-poll fetches and
+    subscriptions check the storage periodically for messages stored by
+    the other processes.
+
+    Request statistics are answered to the stats command and, with
+    stats_port, over HTTP on that local port.
+    '''
+
+    def __init__(self, host='127.0.0.1', port=3001, storage=None,
+                 workers=WORKERS, backlog=LISTEN_BACKLOG,
+                 max_connections=MAX_CONNECTIONS, idle_timeout=IDLE_TIMEOUT,
+                 reuse_port=False, wakeup_interval=None, stats_port=None):
         self.host = host
         self.port = port
+        self.storage = storage
+        self.workers = workers
+        self.backlog = backlog
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.reuse_port = reuse_port
+        self.wakeup_interval = wakeup_interval
         self.sessions = {}  # token -> user
-        self.clients = []
+        self.clients = {}  # socket (or asyncio writer) -> ClientSession
+        self._clients_lock = threading.Lock()
+        self._pool = None  # executes requests of the threaded server
+        self._selector = None
+        self._wakeup = None  # socket pair that interrupts the selector loop
+        self._calls = deque()  # (callback, args) to run on the selector loop
+        self._timers = []  # heap of (monotonic time, id, callback)
+        self._timer_ids = itertools.count()
+        self._stopped = threading.Event()
+        self.subscribers = {}  # user -> set of subscribed ClientSessions
+        self._subscribers_lock = threading.Lock()
+        self.notifier = MessageNotifier()
+        self.stats = ServerStats()
+        self.stats_port = stats_port
+
+    def _serve_connections(self, srv):
+        '''Accept connections and read commands from all of them on one selector loop.
+
+        Commands that arrive are handed to the worker pool, one batch per
+        connection at a time, so their replies keep their order; a worker
+        is only held while a request is being executed.'''
+        self._selector.register(srv, selectors.EVENT_READ, None)
+        self._selector.register(self._wakeup[0], selectors.EVENT_READ, self._wakeup)
+        if self.idle_timeout:
+            self._call_later(time.monotonic(), self._reap_idle)
+        while not self._stopped.is_set():
+            timeout = None
+            if self._timers:
+                timeout = max(self._timers[0][0] - time.monotonic(), 0)
+            for key, events in self._selector.select(timeout):
+                if key.data is None:
+                    self._accept(srv)
+                elif key.data is self._wakeup:
+                    self._run_calls()
+                else:
+                    if events & selectors.EVENT_WRITE:
+                        self._flush(key.data)
+                    if events & selectors.EVENT_READ:
+                        self._read(key.data)
+            now = time.monotonic()
+            while self._timers and self._timers[0][0] <= now:
+                heapq.heappop(self._timers)[2]()
+
+    def _call_soon(self, callback, *args):
+        '''Run callback(*args) on the selector loop; may be called from any thread'''
+        self._calls.append((callback, args))
+        try:
+            self._wakeup[1].send(b'\0')
+        except OSError:
+            pass  # the loop is awake already, or gone
+
+    def _run_calls(self):
+        try:
+            while self._wakeup[0].recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self._calls:
+            callback, args = self._calls.popleft()
+            callback(*args)
+
+    def _call_later(self, due, callback):
+        '''Run callback at monotonic time due on the selector loop; loop thread only'''
+        heapq.heappush(self._timers, (due, next(self._timer_ids), callback))
+
+    def _accept(self, srv):
+        '''Accept a connection, or turn it away once max_connections are open'''
+        try:
+            client_socket, address = srv.accept()
+        except BlockingIOError:
+            return
+        if len(self.clients) >= self.max_connections:
+            self._reject(client_socket)
+            return
+        client_socket.setblocking(False)
+        connection = _Connection(client_socket, ClientSession(address))
+        connection.session.send = lambda data, push=False: self._send(connection, data, push)
+        self._track(client_socket, connection.session)
+        self._selector.register(client_socket, selectors.EVENT_READ, connection)
 
-    def handle_client(self, client_socket, client_address):
-        '''Handle requests from a single client'''
-        current_user_token = None
-        self.clients.append(client_socket)
+    def _send(self, connection, data, push=False):
+        '''Write what the socket takes now and queue the rest for the loop (see ClientSession)'''
+        with connection.lock:
+            if connection.closed:
+                raise OSError('Connection closed')
+            if push and connection.outbox_bytes + len(data) > MAX_OUTBOUND_BYTES:
+                raise OSError('Client is not reading its pushes')
+            if not connection.outbox:
+                try:
+                    sent = connection.socket.send(data)
+                except BlockingIOError:
+                    sent = 0
+                data = data[sent:]
+                if not data:
+                    return
+                self._call_soon(self._watch_writable, connection)
+            connection.outbox.append(data)
+            connection.outbox_bytes += len(data)
+
+    def _watch_writable(self, connection):
+        with connection.lock:
+            if connection.outbox and not connection.closed:
+                self._selector.modify(
+                    connection.socket, selectors.EVENT_READ | selectors.EVENT_WRITE, connection)
+
+    def _flush(self, connection):
+        '''Write queued bytes of a writable connection; serve it again once they are out'''
+        with connection.lock:
+            try:
+                while connection.outbox:
+                    data = connection.outbox[0]
+                    sent = connection.socket.send(data)
+                    connection.outbox_bytes -= sent
+                    if sent < len(data):
+                        connection.outbox[0] = data[sent:]
+                        return
+                    connection.outbox.popleft()
+            except BlockingIOError:
+                return
+            except OSError as e:
+                logger.warning('Error handling client %s: %s', connection.session.address, e)
+                self._call_soon(self._close, connection)
+                return
+            self._selector.modify(connection.socket, selectors.EVENT_READ, connection)
+            self._dispatch(connection)
+
+    def _read(self, connection):
+        '''Read what a readable connection sent and hand complete commands to a worker'''
+        session = connection.session
+        try:
+            data = connection.socket.recv(RECV_BYTES)
+            session.last_active = time.monotonic()
+            logger.debug('Message received by server: %r', data)
+            if not data:
+                logger.debug('Connection closed.')
+                self._close(connection)
+                return
+            # binary frames arrive already decoded
+            commands = [line if isinstance(line, dict) else line.decode().strip()
+                        for line in connection.framer.feed(data)]
+        except BlockingIOError:
+            return
+        except (OSError, DSPError, UnicodeDecodeError) as e:
+            logger.warning('Error handling client %s: %s', session.address, e)
+            self._close(connection)
+            return
+        with connection.lock:
+            connection.commands.extend(
+                command for command in commands if command or isinstance(command, dict))
+            self._dispatch(connection)
+
+    def _dispatch(self, connection):
+        '''Give a worker the commands of connection, unless one has them already or
+        the client is not reading its replies. Caller holds connection.lock.'''
+        if not connection.busy and connection.commands and not connection.closed \
+                and connection.outbox_bytes <= MAX_OUTBOUND_BYTES:
+            connection.busy = True
+            self._pool.submit(self._serve_commands, connection)
+
+    def _serve_commands(self, connection):
+        '''Answer the waiting commands of a connection in order with a single write.
+
+        Runs on a worker. A long-poll fetch that finds nothing parks the
+        connection instead of holding the worker; it is served again when
+        a message arrives or the wait is over.'''
+        session = connection.session
+        replies = []
+        parked = False
         try:
             while True:
-                data = client_socket.recv(4096)
-                if DEBUG:
-                    print(f"Message received by server: {repr(data)}")
-                direct_message_read = False
-                direct_message_sent = False
-                msg = data.decode().strip()
-                if not msg:
-                    if DEBUG:
-                        print("Connection closed.")
+                if connection.poll:
+                    msg, username, deadline = connection.poll
+                    poll = True
+                    generation = self.notifier.generation(username)
+                    resp = self.process_message(session, msg, record=False)
+                    connection.poll = None
+                else:
+                    with connection.lock:
+                        if not connection.commands or connection.closed:
+                            break
+                        msg = connection.commands.popleft()
+                    poll = self._long_poll(session, msg)
+                    if poll:
+                        username, wait = poll
+                        deadline = time.monotonic() + wait
+                        generation = self.notifier.generation(username)
+                    resp = self.process_message(session, msg)
+                if poll and resp['response'].get('messages') == [] \
+                        and time.monotonic() < deadline:
+                    connection.poll = (msg, username, deadline)
+                    parked = True
                     break
+                poll = None
+                replies.append(self.encode_response(session, resp))
+            if replies:
+                session.send(b''.join(replies))
+        except Exception as e:
+            logger.warning('Error handling client %s: %s', session.address, e)
+            parked = False
+            self._call_soon(self._close, connection)
+        if parked:
+            self._park(connection, username, generation, deadline)
+            return
+        with connection.lock:
+            connection.busy = False
+            if connection.closed:
+                self._finish(connection)
+            else:
+                self._dispatch(connection)
+
+    def _park(self, connection, username, generation, deadline):
+        '''Serve the long-poll fetch of connection again once a message for username
+        arrives, or at deadline (and every wakeup_interval when several processes serve)'''
+        def wake():
+            with connection.lock:
+                if connection.parked is not wake:
+                    return  # woken already, or closed
+                connection.parked = None
+            self.notifier.unwatch(username, wake)
+            self._pool.submit(self._serve_commands, connection)
+
+        with connection.lock:
+            if connection.closed:
+                connection.busy = False
+                self._finish(connection)
+                return
+            connection.parked = wake
+        due = deadline if not self.wakeup_interval else \
+            min(deadline, time.monotonic() + self.wakeup_interval)
+        self._call_soon(self._call_later, due, wake)
+        if not self.notifier.watch(username, generation, wake):
+            wake()
+
+    def _close(self, connection):
+        '''Stop reading a connection; it is closed once no worker serves it'''
+        with connection.lock:
+            if connection.closed:
+                return
+            connection.closed = True
+            try:
+                self._selector.unregister(connection.socket)
+            except (KeyError, ValueError):
+                pass
+            if connection.parked:
+                connection.parked = None
+                connection.busy = False
+            if not connection.busy:
+                self._finish(connection)
+
+    def _finish(self, connection):
+        '''End the session of a closed connection. Caller holds connection.lock.'''
+        self.end_session(connection.session)
+        connection.socket.close()
+        self._untrack(connection.socket)
+
+    def _track(self, connection, session):
+        with self._clients_lock:
+            self.clients[connection] = session
+
+    def _untrack(self, connection):
+        with self._clients_lock:
+            self.clients.pop(connection, None)
+
+    def _long_poll(self, session, msg):
+        '''(username, seconds) if msg is a long-poll fetch this session may make, else None'''
+        try:
+            command = msg if isinstance(msg, dict) else json.loads(msg)
+        except json.JSONDecodeError:
+            return None
+        if not isinstance(command, dict) or command.get('fetch') != 'unread':
+            return None
+        wait = command.get('wait')
+        token = command.get('token')
+        if not _is_seconds(wait) or not wait or not self._authorized(session, token):
+            return None
+        username = self.sessions.get(token)
+        return (username, min(wait, MAX_FETCH_WAIT)) if username else None
+
+    def _reject(self, connection):
+        '''Tell a client the server is busy and hang up'''
+        logger.info('Server busy, connection rejected.')
+        try:
+            connection.sendall(BUSY_REPLY)
+        except OSError:
+            pass
+        connection.close()
+
+    def _reap_idle(self):
+        '''Close connections that stayed silent for idle_timeout seconds; runs as a
+        timer on the selector loop, which owns their sockets'''
+        deadline = time.monotonic() - self.idle_timeout
+        for key in list(self._selector.get_map().values()):
+            connection = key.data
+            if isinstance(connection, _Connection) \
+                    and connection.session.last_active < deadline \
+                    and not connection.session.subscribed_as:
+                logger.debug('Closing idle connection.')
+                self._close(connection)  # a worker serving it finishes the close
+        self._call_later(time.monotonic() + max(self.idle_timeout / 4, 0.5), self._reap_idle)
+
+    def _authorized(self, session, token):
+        '''Whether a command with token may act for a user on session.
+
+        A token is bound to the connection that authenticated, except in a
+        multi-process server (see SharedSessions): there a connection that
+        has not authenticated may present a token issued by another process,
+        and uses that token from then on.'''
+        if session.token is None and isinstance(self.sessions, SharedSessions) \
+                and isinstance(token, str) and token in self.sessions:
+            session.token = token
+            session.adopted = True
+        return token == session.token and token in self.sessions
+
+    def end_session(self, session):
+        '''Forget the subscription of a connection that went away, and the token
+        it authenticated with'''
+        self._unsubscribe(session)
+        if session.token and not session.adopted and session.token in self.sessions:
+            del self.sessions[session.token]
+
+    def _subscribe(self, session, username):
+        '''Push username's direct messages to session from now on'''
+        with self._subscribers_lock:
+            self.subscribers.setdefault(username, set()).add(session)
+        session.subscribed_as = username
+        # whatever arrived before the subscription is delivered right away
+        self._push_unread(username)
+
+    def _unsubscribe(self, session):
+        with self._subscribers_lock:
+            sessions = self.subscribers.get(session.subscribed_as)
+            if sessions:
+                sessions.discard(session)
+                if not sessions:
+                    del self.subscribers[session.subscribed_as]
+        session.subscribed_as = None
+
+    def _poll_subscribers(self):
+        '''Every wakeup_interval, push what other processes stored for subscribed users'''
+        while not self._stopped.wait(self.wakeup_interval):
+            with self._subscribers_lock:
+                usernames = list(self.subscribers)
+            for username in usernames:
                 try:
-                    command = json.loads(msg.strip())
-                except json.JSONDecodeError:
-                    message = 'Incorrectly formatted JSON message.'
-                    status = 'error'
-                else:
-                    message = ""
-                    status = "error"
+                    self._push_unread(username)
+                except Exception as e:
+                    logger.warning('Error pushing messages to %s: %s', username, e)
 
-                    if 'authenticate' in command:
+    def _start_background_threads(self):
+        '''Start the stats endpoint and, with several processes, the subscriber poller'''
+        self._serve_stats()
+        if self.wakeup_interval:
+            threading.Thread(target=self._poll_subscribers, daemon=True).start()
 
-                        if len(command) != 1:
-                            status = "error"
-                            message = "Incorrectly formatted authenticate command."
-                        elif len(command['authenticate']) > 2:
-                            status = "error"
-                            message = "Extra fields provided to authenticate command object."
-                        elif not all(field in command['authenticate'] for field in ['username', 'password']):
-                            status = "error"
-                            message = "Missing required fields for authenticate command object."
-                        elif current_user_token:
-                            status = "error"
-                            message = "User already authenticated on the active session."
-                        else:
-                            # execute authenticate command
+    def stats_snapshot(self):
+        '''Request statistics together with the current sessions and connections'''
+        snapshot = self.stats.snapshot()
+        snapshot['pid'] = os.getpid()  # tells the processes of a multi-process server apart
+        snapshot['sessions'] = len(self.sessions)
+        snapshot['connections'] = len(self.clients)
+        snapshot['storage']['commits'] = self.storage.commit_stats()
+        return snapshot
 
-                            uname = command['authenticate']['username']
-                            password = command['authenticate']['password']
+    def _serve_stats(self):
+        '''Answer GET /stats with stats_snapshot() as JSON on stats_port, from a daemon thread'''
+        if not self.stats_port:
+            return
+        server = self
 
-                            fetched_user = self._get_or_create_new_user(
-                                uname, password)
+        class StatsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip('/') != '/stats':
+                    self.send_error(404)
+                    return
+                body = json.dumps(server.stats_snapshot()).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
 
-                            current_user_token = generate_token()
-                            if not fetched_user:
-                                message = f'Welcome to ICS32 Distributed Social, {
-                                    uname}!'
-                                status = 'ok'
-                                self.sessions[current_user_token] = uname
+            def log_message(self, format, *args):
+                logger.debug('Stats endpoint: ' + format, *args)
 
-                            else:
-                                if fetched_user['password'] != password:
-                                    status = "error"
-                                    message = f'Incorrect password for the user {
-                                        uname}'
-                                    current_user_token = None
+        httpd = ThreadingHTTPServer(('127.0.0.1', self.stats_port), StatsHandler)
+        httpd.daemon_threads = True
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        logger.info('Stats are served on http://127.0.0.1:%s/stats', self.stats_port)
 
-                                else:
-                                    status = "ok"
-                                    message = f'Welcome back, {uname}!'
-                                    self.sessions[current_user_token] = uname
+    def _push_unread(self, username):
+        '''Deliver the unread messages of a subscribed user as directmessage events.
 
-                    # direct message handling
-                    elif 'directmessage' in command:
+        Pushing does not mark messages as read; the client acknowledges them
+        like fetched ones. Each connection remembers the newest id it was
+        pushed, so a message is pushed to it only once.'''
+        with self._subscribers_lock:
+            sessions = list(self.subscribers.get(username, ()))
+        if not sessions:
+            return
+        messages = self._read_unread_messages(
+            username, min(session.pushed_upto for session in sessions))
+        if not messages:
+            return
+        for session in sessions:
+            with session.push_lock:
+                new = [message for message in messages
+                       if message['id'] > session.pushed_upto]
+                if not new:
+                    continue
+                data = b''.join(
+                    self.encode_event(session, {'event': {'type': 'directmessage', **message}})
+                    for message in new)
+                try:
+                    session.send(data, push=True)
+                except OSError as e:
+                    logger.info('Unsubscribed %s: %s', session.address, e)
+                    self._unsubscribe(session)
+                    continue
+                session.pushed_upto = new[-1]['id']
 
-                        args = command['directmessage']
+    def process_message(self, session, msg, record=True):
+        '''Execute one command received on a connection and return the response object.
+
+        msg is a JSON line, or the dict decoded from a binary frame.
+
+        This is shared by every server mode; it may block on storage. It
+        never waits for a long-poll fetch: one that finds no unread messages
+        returns none, and the caller waits for a message and runs the command
+        again with record False, so the request is counted in the stats once.'''
+        direct_message_read = False
+        direct_message_sent = False
+        cursor = None
+        more = False
+        statuses = None
+        compression = None
+        encoding = None
+        stats = None
+        started = time.perf_counter()
+        kind = 'invalid'
+        timed = True  # long-poll fetches stay out of the latencies
+        try:
+            command = msg if isinstance(msg, dict) else json.loads(msg.strip())
+        except json.JSONDecodeError:
+            message = 'Incorrectly formatted JSON message.'
+            status = 'error'
+        else:
+            message = ""
+            status = "error"
+            if isinstance(command, dict):
+                kind = next((name for name in COMMAND_KINDS if name in command), 'invalid')
+
+            if 'authenticate' in command:
+
+                if len(command) != 1:
+                    status = "error"
+                    message = "Incorrectly formatted authenticate command."
+                elif not set(command['authenticate']) <= {
+                        'username', 'password', 'compress', 'encoding'}:
+                    status = "error"
+                    message = "Extra fields provided to authenticate command object."
+                elif not all(field in command['authenticate'] for field in ['username', 'password']):
+                    status = "error"
+                    message = "Missing required fields for authenticate command object."
+                elif 'compress' in command['authenticate'] and \
+                        _compress_threshold(command['authenticate']['compress']) is None:
+                    status = "error"
+                    message = "Unsupported compress field for authenticate command object."
+                elif command['authenticate'].get('encoding', 'json') not in ENCODINGS:
+                    status = "error"
+                    message = "Unsupported encoding field for authenticate command object."
+                elif session.token:
+                    status = "error"
+                    message = "User already authenticated on the active session."
+                else:
+                    # execute authenticate command
+
+                    uname = command['authenticate']['username']
+                    password = command['authenticate']['password']
+
+                    fetched_user = self._get_or_create_new_user(
+                        uname, password)
+
+                    session.token = generate_token()
+                    if not fetched_user:
+                        message = f'Welcome to ICS32 Distributed Social, {
+                            uname}!'
+                        status = 'ok'
+                        self.sessions[session.token] = uname
+
+                    else:
+                        if fetched_user['password'] != password:
+                            status = "error"
+                            message = f'Incorrect password for the user {
+                                uname}'
+                            session.token = None
 
-                        if 'token' not in command:
-                            message = 'Missing token.'
-                            status = 'error'
-                        elif len(command) != 2:
-                            message = "Incorrectly formatted directmessage command."
-                            status = 'error'
-                        elif args not in ['all', 'unread'] and not (isinstance(args, dict) and len(args) == 3):
-                            message = "Incorrect fields provided to directmessage command object."
-                            status = 'error'
-                        elif isinstance(args, dict) and not all(field in command['directmessage'] for field in ['entry', 'timestamp', 'recipient']):
-                            message = "Missing required fields for directmessage command."
-                            status = 'error'
                         else:
-                            token = command['token']
-                            recipient = args['recipient']
-                            # timestamp = args['timestamp']
-                            timestamp = str((datetime.now().timestamp()))
-                            entry = args['entry']
-                            if token == current_user_token and token in self.sessions:
-                                current_user = self.sessions[token]
-                                direct_message_sent = True
-
-                                if self._send_message(
-                                        entry, current_user, recipient, timestamp):
-                                    message = f'Direct message sent'
-                                    status = 'ok'
-                                else:
-                                    message = f'Unable to send direct message'
-                                    status = 'error'
-                            else:
-                                message = 'Invalid user token.'
-                                status = 'error'
-
-                    elif 'fetch' in command:
-                        args = command['fetch']
-                        token = command['token']
-                        if args == 'all':
-                            if token == current_user_token and token in self.sessions:
-                                current_user = self.sessions[token]
-                                direct_message_read = True
-                                message = self._read_all_messages(current_user)
-                                status = 'ok'
-                            else:
-                                message = f'Invalid user token.'
-                                status = 'error'
-                        elif args == 'unread':
-                            if token == current_user_token and token in self.sessions:
-                                current_user = self.sessions[token]
-                                direct_message_read = True
-                                message = self._read_unread_messages(
-                                    current_user)
-                                status = 'ok'
-                            else:
-                                message = f'Invalid user token.'
-                                status = 'error'
+                            status = "ok"
+                            message = f'Welcome back, {uname}!'
+                            self.sessions[session.token] = uname
+
+                    if status == 'ok' and 'compress' in command['authenticate']:
+                        session.compress_threshold = _compress_threshold(
+                            command['authenticate']['compress'])
+                        compression = command['authenticate']['compress']['method']
+                    if status == 'ok' and 'encoding' in command['authenticate']:
+                        encoding = command['authenticate']['encoding']
+                        session.binary = encoding == 'binary'
+
+            # direct message handling
+            elif 'directmessage' in command:
+
+                args = command['directmessage']
+
+                if 'token' not in command:
+                    message = 'Missing token.'
+                    status = 'error'
+                elif len(command) != 2:
+                    message = "Incorrectly formatted directmessage command."
+                    status = 'error'
+                elif isinstance(args, list) or (isinstance(args, dict) and 'recipients' in args):
+                    token = command['token']
+                    items = _batch_items(args)
+                    if items is None:
+                        message = 'Incorrectly formatted directmessage batch.'
+                        status = 'error'
+                    elif self._authorized(session, token):
+                        direct_message_sent = True
+                        sent = self._send_messages(
+                            self.sessions[token], items, datetime.now().timestamp())
+                        statuses = ['ok' if ok else 'error' for ok in sent]
+                        message = f'{sum(sent)} of {len(sent)} direct messages sent'
+                        status = 'ok'
+                        for recipient in {recipient for (_, recipient), ok in zip(items, sent) if ok}:
+                            self._push_unread(recipient)
+                    else:
+                        message = 'Invalid user token.'
+                        status = 'error'
+                elif args not in ['all', 'unread'] and not (isinstance(args, dict) and len(args) == 3):
+                    message = "Incorrect fields provided to directmessage command object."
+                    status = 'error'
+                elif isinstance(args, dict) and not all(field in command['directmessage'] for field in ['entry', 'timestamp', 'recipient']):
+                    message = "Missing required fields for directmessage command."
+                    status = 'error'
+                elif isinstance(args, dict) and not (
+                        isinstance(args['entry'], str) and isinstance(args['recipient'], str)):
+                    message = "Invalid entry or recipient for directmessage command."
+                    status = 'error'
+                else:
+                    token = command['token']
+                    recipient = args['recipient']
+                    # timestamp = args['timestamp']
+                    timestamp = datetime.now().timestamp()
+                    entry = args['entry']
+                    if self._authorized(session, token):
+                        current_user = self.sessions[token]
+                        direct_message_sent = True
 
+                        if self._send_message(
+                                entry, current_user, recipient, timestamp):
+                            message = f'Direct message sent'
+                            status = 'ok'
+                            self._push_unread(recipient)
                         else:
-                            message = 'Invalid argument for fetch field.'
+                            message = f'Unable to send direct message'
                             status = 'error'
+                    else:
+                        message = 'Invalid user token.'
+                        status = 'error'
+
+            elif 'subscribe' in command:
+                token = command.get('token')
+                if len(command) != 2 or command['subscribe'] is not True:
+                    message = 'Incorrectly formatted subscribe command.'
+                    status = 'error'
+                elif self._authorized(session, token):
+                    self._subscribe(session, self.sessions[token])
+                    message = 'Subscribed to direct messages.'
+                    status = 'ok'
+                else:
+                    message = 'Invalid user token.'
+                    status = 'error'
+
+            elif 'ack' in command:
+                args = command['ack']
+                token = command.get('token')
+                if len(command) != 2 or not isinstance(args, dict) or not args \
+                        or not set(args) <= {'upto', 'ids'}:
+                    message = 'Incorrectly formatted ack command.'
+                    status = 'error'
+                elif not _is_count(args.get('upto', 0)) or not (
+                        isinstance(args.get('ids', []), list)
+                        and all(_is_count(message_id) for message_id in args.get('ids', []))):
+                    message = 'Invalid message ids for ack command.'
+                    status = 'error'
+                elif self._authorized(session, token):
+                    acked = self._ack_messages(
+                        self.sessions[token], args.get('upto'), args.get('ids', ()))
+                    message = f'{acked} messages acknowledged.'
+                    status = 'ok'
+                else:
+                    message = 'Invalid user token.'
+                    status = 'error'
 
+            elif 'fetch' in command:
+                args = command['fetch']
+                token = command['token']
+                if args == 'all':
+                    if self._authorized(session, token):
+                        current_user = self.sessions[token]
+                        direct_message_read = True
+                        message = self._read_all_messages(current_user)
+                        status = 'ok'
                     else:
-                        message = 'Invalid command.'
+                        message = f'Invalid user token.'
                         status = 'error'
-                if DEBUG:
-                    print(f'Server sending the following message: "{message}"')
-                if direct_message_read:
-                    resp = {'response': {'type': status, 'messages': message}}
-                elif direct_message_sent:
-                    resp = {'response': {'type': status, 'message': message}}
-                elif status == 'ok':
-                    resp = {
-                        'response': {
-                            'type': status,
-                            'message': message,
-                            'token': current_user_token}}
+                elif args == 'unread':
+                    wait = command.get('wait', 0)
+                    timed = not wait
+                    if not set(command) <= {'fetch', 'token', 'wait'} or not _is_seconds(wait):
+                        message = 'Invalid wait for fetch field.'
+                        status = 'error'
+                    elif self._authorized(session, token):
+                        current_user = self.sessions[token]
+                        direct_message_read = True
+                        message = self._read_unread_messages(
+                            current_user)
+                        status = 'ok'
+                    else:
+                        message = f'Invalid user token.'
+                        status = 'error'
+
+                elif isinstance(args, dict) and args and set(args) <= FETCH_FIELDS:
+                    since = args.get('since', 0)
+                    limit = args.get('limit')
+                    filters = {field: args[field] for field in FETCH_FILTERS if field in args}
+                    if not _is_count(since):
+                        message = 'Invalid cursor for fetch field.'
+                        status = 'error'
+                    elif limit is not None and not (_is_count(limit) and limit > 0):
+                        message = 'Invalid limit for fetch field.'
+                        status = 'error'
+                    elif not isinstance(filters.get('peer', ''), str) \
+                            or filters.get('direction', 'sent') not in MESSAGE_DIRECTIONS \
+                            or not all(_is_seconds(filters.get(bound, 0)) for bound in ('start', 'end')):
+                        message = 'Invalid filter for fetch field.'
+                        status = 'error'
+                    elif self._authorized(session, token):
+                        current_user = self.sessions[token]
+                        direct_message_read = True
+                        if limit is not None:
+                            limit = min(limit, MAX_FETCH_LIMIT)
+                        message, cursor, more = self._read_messages_since(
+                            current_user, since, limit, **filters)
+                        status = 'ok'
+                    else:
+                        message = f'Invalid user token.'
+                        status = 'error'
+
                 else:
-                    resp = {'response': {'type': status, 'message': message}}
-                json_response = json.dumps(resp).encode()
-                client_socket.sendall(json_response + b'\r\n')
-            if current_user_token and current_user_token in self.sessions:
-                del self.sessions[current_user_token]
-        except Exception as e:
-            print(f"Error handling client {client_address}: {e}")
-        finally:
-            client_socket.close()
-            self.clients.remove(client_socket)
+                    message = 'Invalid argument for fetch field.'
+                    status = 'error'
 
-    def _send_message(self, entry, username, recipient, timestamp=''):
-        '''Sends a message from one user (username) to another (recipient). Creates the message in the user's associated object'''
-        with users_file_lock:
-            users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-            existing_users = None
-            with users_path.open('r') as user_file:
-                existing_users = json.load(user_file)
-
-            fetched_sender = existing_users.get(username, None)
-            fetched_user = existing_users.get(recipient, None)
-            if not fetched_sender:
-                return False
-            if not fetched_user:
-                return False
+            elif 'stats' in command:
+                token = command.get('token')
+                if set(command) != {'token', 'stats'} or command['stats'] is not True:
+                    message = 'Incorrectly formatted stats command.'
+                    status = 'error'
+                elif self._authorized(session, token):
+                    stats = self.stats_snapshot()
+                    status = 'ok'
+                else:
+                    message = 'Invalid user token.'
+                    status = 'error'
 
             else:
-                with users_path.open('w') as user_file:
-                    fetched_sender['messages'].append(
-                        {'message': entry, 'recipient': recipient, 'timestamp': timestamp, 'status': 'sent'})
-                    fetched_user['messages'].append(
-                        {'message': entry, 'from': username, 'timestamp': timestamp, 'status': 'unread'})
-                    existing_users[recipient] = fetched_user
-                    existing_users[username] = fetched_sender
-                    json.dump(existing_users, user_file)
-        return True
+                message = 'Invalid command.'
+                status = 'error'
+        logger.debug('Server sending the following message: "%s"', message)
+        if record:
+            self.stats.record(kind, time.perf_counter() - started if timed else None,
+                              status == 'error')
+        if stats is not None:
+            resp = {'response': {'type': status, 'message': message, 'stats': stats}}
+        elif direct_message_read:
+            resp = {'response': {'type': status, 'messages': message}}
+            if cursor is not None:
+                resp['response']['cursor'] = cursor
+                resp['response']['more'] = more
+        elif direct_message_sent:
+            resp = {'response': {'type': status, 'message': message}}
+            if statuses is not None:
+                resp['response']['statuses'] = statuses
+        elif status == 'ok':
+            resp = {
+                'response': {
+                    'type': status,
+                    'message': message,
+                    'token': session.token}}
+            if compression:
+                resp['response']['compress'] = compression
+            if encoding:
+                resp['response']['encoding'] = encoding
+        else:
+            resp = {'response': {'type': status, 'message': message}}
+        return resp
+
+    def encode_response(self, session, resp):
+        '''Serialise a response for the wire: a JSON line, or a compressed or binary frame if negotiated'''
+        if session.binary:
+            return encode_frame(resp)
+        data = json.dumps(resp).encode()
+        if session.compress_threshold is not None and len(data) >= session.compress_threshold:
+            return compress_frame(data, COMPRESS_LEVEL)
+        return data + b'\r\n'
+
+    def encode_event(self, session, event):
+        '''Serialise a pushed event; events are never compressed'''
+        if session.binary:
+            return encode_frame(event)
+        return json.dumps(event).encode() + b'\r\n'
+
+    def _send_message(self, entry, username, recipient, timestamp=None):
+        '''Sends a message from one user (username) to another (recipient). Creates the message in the user's associated object'''
+        self.stats.add_bytes(written=len(entry.encode()))
+        sent = self.storage.send_message(entry, username, recipient, timestamp)
+        if sent:
+            self.notifier.notify(recipient)
+        return sent
+
+    def _send_messages(self, username, items, timestamp=None):
+        '''Sends every (entry, recipient) item from username in one storage transaction and returns a bool per item'''
+        self.stats.add_bytes(written=sum(len(entry.encode()) for entry, _ in items))
+        sent = self.storage.send_messages(
+            username, [(entry, recipient, timestamp) for entry, recipient in items])
+        for recipient in {recipient for (_, recipient), ok in zip(items, sent) if ok}:
+            self.notifier.notify(recipient)
+        return sent
 
     def _read_all_messages(self, username):
         '''Retrieves all messages associated with a user'''
-        with users_file_lock:
-            users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-            existing_users = None
-            with users_path.open('r') as user_file:
-                existing_users = json.load(user_file)
-
-            fetched_user = existing_users.get(username, None)
-            if not fetched_user:
-                return False  # double check that user exists
-            result = []
-            for message in fetched_user['messages']:
-                if 'from' in message:
-                    mod_message = {
-                        'from': message['from'],
-                        'message': message['message'],
-                        'timestamp': message['timestamp']}
-                else:
-                    mod_message = {
-                        'recipient': message['recipient'],
-                        'message': message['message'],
-                        'timestamp': message['timestamp']}
-                result.append(mod_message)
-                if message['status'] == 'unread':
-                    message['status'] = 'read'
+        return self._count_read(self.storage.read_all_messages(username))
 
-            else:
-                with users_path.open('w') as user_file:
-
-                    existing_users[username] = fetched_user
-                    json.dump(existing_users, user_file)
-
-            return sorted(result, key=lambda x: float(x["timestamp"]))
-
-    def _read_unread_messages(self, username):
-        '''Retrieves unread messages associated with the user'''
-        with users_file_lock:
-            users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-            existing_users = None
-            with users_path.open('r') as user_file:
-                existing_users = json.load(user_file)
-
-            fetched_user = existing_users.get(username, None)
-            if not fetched_user:
-                return False  # double check that user exists
-            result = []
-            for message in fetched_user['messages']:
-                if message['status'] == 'unread':
-                    mod_message = {
-                        'from': message['from'],
-                        'message': message['message'],
-                        'timestamp': message['timestamp']}
-                    result.append(mod_message)
-                    message['status'] = 'read'
+    def _read_unread_messages(self, username, after=0):
+        '''Retrieves unread messages associated with the user, newer than message id after'''
+        return self._count_read(self.storage.read_unread_messages(username, after))
 
-            else:
-                with users_path.open('w') as user_file:
-                    existing_users[username] = fetched_user
+    def _ack_messages(self, username, upto=None, ids=()):
+        '''Marks the user's messages up to id upto and those in ids as read'''
+        return self.storage.ack_messages(username, upto, ids)
 
-                    json.dump(existing_users, user_file)
+    def _read_messages_since(self, username, cursor, limit=None, **filters):
+        '''Retrieves up to limit messages stored after cursor that pass the filters, the cursor to use next time and whether more messages follow'''
+        messages, cursor, more = self.storage.read_messages_since(
+            username, cursor, limit, **filters)
+        return self._count_read(messages), cursor, more
 
-            return sorted(result, key=lambda x: float(x["timestamp"]))
+    def _count_read(self, messages):
+        '''Add the text of messages read from storage to the stats and return them'''
+        self.stats.add_bytes(read=sum(len(message['message'].encode()) for message in messages))
+        return messages
 
     def _get_user(self, username):
         '''Gets the user object associated with the username. This function is never called.'''
-        with users_file_lock:
-            users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-            with users_path.open('r') as user_file:
-                existing_users = json.load(user_file)
-                fetched_user = existing_users.get(username, None)
-                return fetched_user
+        return self.storage.get_user(username)
 
     def _get_or_create_new_user(self, username, password):
-        '''Read from the user file and get the username associated with the username. If it doesnt exist, create a new user.'''
-        with users_file_lock:
-            users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-            existing_users = None
-            with users_path.open('r') as user_file:
-                existing_users = json.load(user_file)
-
-            fetched_user = existing_users.get(username, None)
-            if fetched_user:
-                return fetched_user
-            else:
-                with users_path.open('w') as user_file:
-
-                    fetched_user = existing_users.get(username, None)
-                    if fetched_user:  # double check that no user exists
-                        return False
-                    else:
-                        existing_users.update({username: {'password': password, 'bio': {
-                                              "entry": "", "timestamp": ""}, 'posts': [], 'messages': []}})
-                    json.dump(existing_users, user_file)
+        '''Get the user associated with the username. If it doesnt exist, create a new user.'''
+        return self.storage.get_or_create_user(username, password)
 
     def _create_storage_system(self):
-        '''Creates the local storage system if it doesnt already exist. Will create a directory called "store" with two files posts.json and users.json'''
-        users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-        store_path = Path('.') / Path(STORE_DIR_PATH)
-        store_path.mkdir(exist_ok=True)
-        if not users_path.exists():
-            with users_path.open('w') as json_file:
-                json.dump({}, json_file, indent=4)
+        '''Creates the local storage system if it doesnt already exist. Will create a directory called "store" holding users.json and its write-ahead log'''
+        if self.storage is None:
+            self.storage = JsonStorage(Path('.') / Path(STORE_DIR_PATH))
 
     def start_server(self):
         '''Starts the server (hence the name of the method :))'''
         self._create_storage_system()  # does nothing if the server store files exists already
+        self._pool = ThreadPoolExecutor(max_workers=self.workers)
+        self._selector = selectors.DefaultSelector()
+        self._wakeup = socket.socketpair()
+        for end in self._wakeup:
+            end.setblocking(False)
+        self._start_background_threads()
         try:
             with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as srv:
+                srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                if self.reuse_port:
+                    srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
                 srv.bind((self.host, self.port))
-                srv.listen(5)
-                if DEBUG:
-                    print("DSUserver is listening on port", self.port)
-                while True:
-                    connection, address = srv.accept()
-                    client_handler = threading.Thread(
-                        target=self.handle_client, args=(
-                            connection, address))
-                    client_handler.start()
+                srv.listen(self.backlog)
+                srv.setblocking(False)
+                logger.info('DSUserver is listening on port %s', self.port)
+                self._serve_connections(srv)
         except KeyboardInterrupt as e:
-            if DEBUG:
-                print(f'Server shutting down...')
+            logger.info('Server shutting down...')
         finally:
-            for conn in self.clients:
+            self._stopped.set()
+            with self._clients_lock:
+                connections = list(self.clients)
+                self.clients = {}
+            for conn in connections:
                 conn.close()
-            self.clients = []
-            if DEBUG:
-                print('Disconnected all clients.')
+            logger.info('Disconnected all clients.')
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._selector.close()
+            for end in self._wakeup:
+                end.close()
+            self._close_storage()
+
+    def _close_storage(self):
+        '''Flush and close the storage backend on shutdown'''
+        if self.storage:
+            logger.info('Storage commits: %s', self.storage.commit_stats())
+            self.storage.close()
+
+
+class AsyncDSUServer(DSUServer):
+    '''DSUServer that serves every connection from one asyncio event loop.
+
+    Connections cost a coroutine instead of a thread, so it admits far more
+    of them by default (ASYNC_MAX_CONNECTIONS). Commands are parsed
+    and executed by DSUServer.process_message, which may block on storage,
+    so it runs in a thread pool of storage_workers threads.
+    '''
+
+    def __init__(self, host='127.0.0.1', port=3001, storage=None,
+                 storage_workers=ASYNC_STORAGE_WORKERS, backlog=ASYNC_BACKLOG,
+                 max_connections=ASYNC_MAX_CONNECTIONS, idle_timeout=IDLE_TIMEOUT,
+                 reuse_port=False, wakeup_interval=None, stats_port=None):
+        super().__init__(host, port, storage, backlog=backlog,
+                         max_connections=max_connections, idle_timeout=idle_timeout,
+                         reuse_port=reuse_port, wakeup_interval=wakeup_interval,
+                         stats_port=stats_port)
+        self.storage_workers = storage_workers
+        self.executor = None
+
+    async def handle_client_async(self, reader, writer):
+        '''Handle requests from a single client on the event loop'''
+        client_address = writer.get_extra_info('peername')
+        loop = asyncio.get_running_loop()
+        if len(self.clients) >= self.max_connections:
+            logger.info('Server busy, connection rejected.')
+            writer.write(BUSY_REPLY)
+            writer.close()
+            return
+
+        def send(data, push=False):
+            # pushes come from executor threads; hand them to the event loop
+            if push and writer.transport.get_write_buffer_size() + len(data) > MAX_OUTBOUND_BYTES:
+                raise OSError('Client is not reading its pushes')
+            loop.call_soon_threadsafe(writer.write, data)
+
+        session = ClientSession(client_address, send)
+        self.clients[writer] = session
+        try:
+            while True:
+                idle_timeout = None if session.subscribed_as else (self.idle_timeout or None)
+                try:
+                    async with asyncio.timeout(idle_timeout):
+                        msg = await _read_command(reader)
+                except TimeoutError:
+                    logger.debug('Closing idle connection.')
+                    break
+                logger.debug('Message received by server: %r', msg)
+                if not msg and not isinstance(msg, dict):
+                    logger.debug('Connection closed.')
+                    break
+                resp = await self._process_async(session, msg)
+                writer.write(self.encode_response(session, resp))
+                await writer.drain()
+        except Exception as e:
+            logger.warning('Error handling client %s: %s', client_address, e)
+        finally:
+            self.end_session(session)
+            self.clients.pop(writer, None)
+            writer.close()
+
+    async def _process_async(self, session, msg):
+        '''Run process_message in the executor, waiting for long-poll fetches on the loop'''
+        loop = asyncio.get_running_loop()
+        poll = self._long_poll(session, msg) if isinstance(msg, dict) or '"wait"' in msg else None
+        if poll:
+            username, wait = poll
+            deadline = loop.time() + wait
+            generation = self.notifier.generation(username)
+        resp = await loop.run_in_executor(
+            self.executor, self.process_message, session, msg)
+        while poll and resp['response'].get('messages') == []:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            woke = await self.notifier.wait_async(
+                username, generation, min(remaining, self.wakeup_interval or remaining))
+            if not woke and not self.wakeup_interval:
+                break
+            generation = self.notifier.generation(username)
+            resp = await loop.run_in_executor(
+                self.executor, self.process_message, session, msg, False)
+        return resp
+
+    async def _serve(self):
+        srv = await asyncio.start_server(
+            self.handle_client_async, self.host, self.port,
+            limit=MAX_LINE_BYTES, backlog=self.backlog,
+            reuse_port=self.reuse_port or None)
+        logger.info('DSUserver (asyncio) is listening on port %s', self.port)
+        async with srv:
+            await srv.serve_forever()
+
+    def start_server(self):
+        '''Starts the event loop and serves until interrupted'''
+        self._create_storage_system()
+        self.executor = ThreadPoolExecutor(max_workers=self.storage_workers)
+        self._serve_stats()
+        # idle connections are timed out by handle_client_async, not by _reap_idle
+        if self.wakeup_interval:
+            threading.Thread(target=self._poll_subscribers, daemon=True).start()
+        try:
+            asyncio.run(self._serve())
+        except KeyboardInterrupt:
+            logger.info('Server shutting down...')
+        finally:
+            self._stopped.set()
+            self.executor.shutdown(wait=True)
+            self._close_storage()
+
+
+STORAGE_BACKENDS = {
+    'json': JsonStorage,
+    'sharded': ShardedStorage,
+    'sqlite': SqliteStorage}
+
+
+SERVER_MODES = {'threaded': DSUServer, 'async': AsyncDSUServer}
+
+
+def run_server(host='127.0.0.1', port1=3001, storage='json', durability=None,
+               mode='threaded', processes=1, **server_options):
+    '''Run a server of the given mode; server_options go to its constructor'''
+    if processes > 1:
+        run_processes(host, port1, storage, durability, mode, processes,
+                      **server_options)
+        return
+    try:
+        store_path = Path('.') / Path(STORE_DIR_PATH)
+        options = {'durability': durability} if durability else {}
+        server = SERVER_MODES[mode](
+            host, port1, STORAGE_BACKENDS[storage](store_path, **options),
+            **server_options)
+        server.start_server()
+    except Exception as e:
+        logger.error('Server raised the following error: %s', e)
+
+
+def run_processes(host, port1, storage, durability, mode, processes,
+                  **server_options):
+    '''Serve port1 from several processes that share one storage backend.
+
+    Every process accepts on the same port through SO_REUSEPORT, so the
+    kernel spreads connections across them and JSON work runs on every
+    core. Only a shared backend (sqlite) can be opened by all of them.
+    Statistics are kept per process; with a stats_port, process i serves
+    its own on stats_port + i.'''
+    backend = STORAGE_BACKENDS[storage]
+    if not backend.shared:
+        logger.error('The %s storage cannot be shared between processes; '
+                     'use --storage sqlite.', storage)
+        return
+    options = {'durability': durability} if durability else {}
+    # create the store once and drop the tokens of a previous run
+    store = backend(Path('.') / Path(STORE_DIR_PATH), **options)
+    store.clear_sessions()
+    store.close()
+    stats_port = server_options.pop('stats_port', None)
+    workers = [multiprocessing.Process(
+        target=_serve_process,
+        args=(host, port1, storage, options, mode,
+              dict(server_options, stats_port=stats_port + index if stats_port else None)))
+        for index in range(processes)]
+    for worker in workers:
+        worker.start()
+
+    def stop(signum, frame):
+        for worker in workers:
+            worker.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        # the workers got the interrupt too and shut down on their own
+        for worker in workers:
+            worker.join()
 
 
-def run_server(host='127.0.0.1', port1=3001):
+def _serve_process(host, port1, storage, options, mode, server_options):
+    '''Body of one run_processes worker'''
+    # terminate() shuts the worker down like an interrupt does
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
     try:
-        server = DSUServer(host, port1)
+        backend = STORAGE_BACKENDS[storage](
+            Path('.') / Path(STORE_DIR_PATH), **options)
+        server = SERVER_MODES[mode](
+            host, port1, backend, reuse_port=True,
+            wakeup_interval=PROCESS_WAKEUP, **server_options)
+        server.sessions = SharedSessions(backend)
         server.start_server()
     except Exception as e:
-        print(f'Server raised the following error:{e}')
+        logger.error('Server raised the following error: %s', e)
 
 
 if __name__ == '__main__':
     host = '127.0.0.1'
-    port1 = 3001
-    port2 = 3002
-    if len(sys.argv) >= 2:
-        port1 = int(sys.argv[1])
+    parser = argparse.ArgumentParser(description='ICS32 DSU server')
+    parser.add_argument('port', nargs='?', type=int, default=3001)
+    parser.add_argument('--storage', choices=sorted(STORAGE_BACKENDS),
+                        default='json',
+                        help='json: users.json + write-ahead log, '
+                             'sharded: one file and lock per user, '
+                             'sqlite: store/users.db')
+    parser.add_argument('--durability', choices=DURABILITY_MODES,
+                        help='commit: fsync every write, batch: group commits '
+                             'and fsync per batch, os: no fsync (default for '
+                             'json and sharded; sqlite defaults to commit)')
+    parser.add_argument('--mode', choices=sorted(SERVER_MODES),
+                        default='threaded',
+                        help='threaded: a selector loop handing requests to a '
+                             'fixed pool of worker threads, async: every '
+                             'connection on one asyncio event loop')
+    parser.add_argument('--workers', type=int,
+                        help=f'worker threads: requests executed at once in '
+                             f'threaded mode (default {WORKERS}), storage '
+                             f'threads in async mode (default {ASYNC_STORAGE_WORKERS})')
+    parser.add_argument('--backlog', type=int,
+                        help=f'listen backlog (default {LISTEN_BACKLOG}, '
+                             f'async {ASYNC_BACKLOG})')
+    parser.add_argument('--max-connections', type=int,
+                        help=f'open connections before new ones are turned '
+                             f'away (default {MAX_CONNECTIONS}, async '
+                             f'{ASYNC_MAX_CONNECTIONS}; each also needs a file '
+                             f'descriptor, see ulimit -n)')
+    parser.add_argument('--idle-timeout', type=float,
+                        help=f'close connections silent for this many seconds, '
+                             f'0 never does (default {IDLE_TIMEOUT})')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='server processes sharing the port through '
+                             'SO_REUSEPORT; needs --storage sqlite')
+    parser.add_argument('--stats-port', type=int,
+                        help='serve request statistics as JSON on '
+                             'http://127.0.0.1:PORT/stats')
+    parser.add_argument('--log-level', default=LOG_LEVEL,
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help=f'DEBUG logs every message (default {LOG_LEVEL})')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format='%(message)s')
 
-    run_server(host, port1)
+    server_options = {
+        'storage_workers' if args.mode == 'async' else 'workers': args.workers,
+        'backlog': args.backlog,
+        'max_connections': args.max_connections,
+        'idle_timeout': args.idle_timeout,
+        'stats_port': args.stats_port}
+    run_server(host, args.port, args.storage, args.durability, args.mode,
+               args.processes, **{k: v for k, v in server_options.items() if v is not None})
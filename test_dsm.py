@@ -4,8 +4,13 @@ import unittest
 from collections import namedtuple
 import json
 import os
+import threading
+import time
 from pathlib import Path
 from ds_messenger import DirectMessenger
+from ds_protocol import direct_message_request, fetch_request, MessageBatch
+from ds_protocol import MessageReceived as Received, MessageSent as Sent
+from notebook import Notebook
 
 MessageReceived = namedtuple(
     'MessageReceived', [
@@ -44,7 +49,7 @@ class TestDSMessenger(unittest.TestCase):
             user_b.notebook.chats['A'] = []
         user_b.send('hello', 'A')
         messages = user_b.retrieve_all()
-        self.assertIsInstance(messages, list)
+        self.assertIsInstance(messages, MessageBatch)
         hello_msg = next(
             (m for m in messages if getattr(m, 'message', None) == 'hello'), None)
         self.assertIsNotNone(hello_msg)
@@ -53,6 +58,190 @@ class TestDSMessenger(unittest.TestCase):
         self.assertTrue(isinstance(hello_msg.timestamp, (str, float)))
         user_b.close()
 
+    def test_retrieve_since(self):
+        """Test that retrieve_since only returns messages newer than its cursor."""
+        user_b = DirectMessenger('127.0.0.1', 'B', '456')
+        user_a = DirectMessenger('127.0.0.1', 'A', '123')
+        if 'A' not in user_b.notebook.chats:
+            user_b.notebook.chats['A'] = []
+        user_a.retrieve_since()
+        self.assertEqual(user_a.retrieve_since(), [])
+        user_b.send('since_msg', 'A')
+        newer = user_a.retrieve_since()
+        self.assertEqual([m.message for m in newer], ['since_msg'])
+        self.assertEqual(user_a.retrieve_since(), [])
+        user_a.close()
+        # the cursor is kept in the notebook across messengers
+        user_b.send('after_reconnect', 'A')
+        user_a = DirectMessenger('127.0.0.1', 'A', '123')
+        self.assertEqual([m.message for m in user_a.retrieve_since()], ['after_reconnect'])
+        user_b.close()
+        user_a.close()
+
+    def test_iter_history(self):
+        """Test that iter_history pages through the whole history."""
+        user_b = DirectMessenger('127.0.0.1', 'B', '456')
+        user_a = DirectMessenger('127.0.0.1', 'A', '123')
+        if 'A' not in user_b.notebook.chats:
+            user_b.notebook.chats['A'] = []
+        for i in range(3):
+            user_b.send(f'page_msg_{i}', 'A')
+        everything = user_a.retrieve_all()
+        paged = list(user_a.iter_history(page_size=2))
+        self.assertEqual(len(paged), len(everything))
+        self.assertEqual([m.message for m in paged if m.message.startswith('page_msg_')][-3:],
+                         ['page_msg_0', 'page_msg_1', 'page_msg_2'])
+        user_b.close()
+        user_a.close()
+
+    def test_pipeline_and_large_message(self):
+        """Test pipelined requests and a message larger than one socket read."""
+        user_b = DirectMessenger('127.0.0.1', 'B', '456')
+        user_a = DirectMessenger('127.0.0.1', 'A', '123')
+        user_a.retrieve_new()
+        big = 'x' * 20000
+        responses = user_b.pipeline([
+            direct_message_request(user_b.token, 'A', big, 0),
+            direct_message_request(user_b.token, 'A', 'after_big', 0),
+            fetch_request(user_b.token, 'unread')])
+        self.assertEqual([r.type for r in responses], ['ok', 'ok', 'ok'])
+        self.assertEqual([m.message for m in user_a.retrieve_new()], [big, 'after_big'])
+        user_b.close()
+        user_a.close()
+
+    def test_subscribe_pushes_messages(self):
+        """Test that a subscribed messenger gets messages pushed without polling."""
+        user_b = DirectMessenger('127.0.0.1', 'B', '456')
+        user_a = DirectMessenger('127.0.0.1', 'A', '123')
+        user_a.retrieve_new()
+        self.assertTrue(user_a.subscribe())
+        self.assertTrue(user_a.subscribed)
+        user_b.pipeline([direct_message_request(user_b.token, 'A', 'pushed_msg', 0)])
+        pushed = user_a.events.get(timeout=5)
+        self.assertEqual((pushed.message, pushed.from_name), ('pushed_msg', 'B'))
+        # requests still work on a subscribed connection
+        self.assertEqual(user_a.retrieve_new(), [])
+        user_b.close()
+        user_a.close()
+
+    def test_retrieve_new_waits_for_message(self):
+        """Test that a long-poll retrieve_new returns as soon as a message arrives."""
+        user_b = DirectMessenger('127.0.0.1', 'B', '456')
+        user_a = DirectMessenger('127.0.0.1', 'A', '123')
+        user_a.retrieve_new()
+        self.assertEqual(user_a.retrieve_new(wait=0.2), [])
+        sender = threading.Timer(0.3, user_b.send, ('waited_msg', 'A'))
+        sender.start()
+        start = time.monotonic()
+        received = user_a.retrieve_new(wait=10)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual([m.message for m in received], ['waited_msg'])
+        sender.join()
+        user_b.close()
+        user_a.close()
+
+    def test_send_many(self):
+        """Test batch sends, per-message statuses and a multi-recipient send."""
+        user_b = DirectMessenger('127.0.0.1', 'B', '456')
+        user_a = DirectMessenger('127.0.0.1', 'A', '123')
+        user_a.retrieve_new()
+        sent = user_b.send_many([('batch_1', 'A'), ('lost', 'no_such_user_xyz'), ('batch_2', 'A')])
+        self.assertEqual(sent, [True, False, True])
+        self.assertEqual(user_b.send_many(message='multi', recipients=['A', 'B']), [True, True])
+        self.assertEqual([m.message for m in user_a.retrieve_new()], ['batch_1', 'batch_2', 'multi'])
+        user_b.close()
+        user_a.close()
+
+    def test_fetch_is_read_only_until_acked(self):
+        """Test that fetched messages stay unread until the messenger acks them."""
+        user_b = DirectMessenger('127.0.0.1', 'B', '456')
+        user_a = DirectMessenger('127.0.0.1', 'A', '123')
+        user_a.retrieve_new()
+        user_a.flush_acks()
+        user_b.notebook.chats.setdefault('A', [])
+        user_b.send('unacked_msg', 'A')
+        first, second = user_a.pipeline([fetch_request(user_a.token, 'unread')] * 2)
+        self.assertEqual([m.message for m in first.message], ['unacked_msg'])
+        self.assertEqual(first.message, second.message)
+        self.assertIsNotNone(first.message[0].id)
+        self.assertEqual([m.message for m in user_a.retrieve_new()], ['unacked_msg'])
+        self.assertEqual(user_a.retrieve_new(), [])
+        user_b.close()
+        user_a.close()
+
+    def test_compressed_replies(self):
+        """Test that large replies arrive intact when compression is negotiated."""
+        user_b = DirectMessenger('127.0.0.1', 'B', '456')
+        user_a = DirectMessenger('127.0.0.1', 'A', '123', compress=True)
+        self.assertEqual(user_a.response.type, 'ok')
+        user_a.retrieve_new()
+        big = 'compressed ' * 500
+        user_b.notebook.chats.setdefault('A', [])
+        user_b.send(big, 'A')
+        self.assertEqual([m.message for m in user_a.retrieve_new()], [big])
+        self.assertIn(big, [m.message for m in user_a.retrieve_all()])
+        user_b.close()
+        user_a.close()
+
+    def test_binary_encoding(self):
+        """Test that a binary-encoded messenger talks to a JSON one."""
+        user_b = DirectMessenger('127.0.0.1', 'B', '456')
+        user_a = DirectMessenger('127.0.0.1', 'A', '123', binary=True)
+        self.assertEqual(user_a.response.type, 'ok')
+        user_a.retrieve_new()
+        user_b.notebook.chats.setdefault('A', [])
+        user_b.send('binary_msg', 'A')
+        self.assertEqual([m.message for m in user_a.retrieve_new()], ['binary_msg'])
+        self.assertTrue(user_a.send_many([('binary_reply', 'B')]))
+        self.assertIn('binary_reply', [m.message for m in user_b.retrieve_new()])
+        user_b.close()
+        user_a.close()
+
+    def test_server_stats(self):
+        """Test that the stats command reports commands, latencies and sessions."""
+        user_a = DirectMessenger('127.0.0.1', 'A', '123')
+        user_a.send_many([('stats_msg', 'B')])
+        user_a.retrieve_all()
+        stats = user_a.server_stats()
+        self.assertGreaterEqual(stats['commands']['directmessage'], 1)
+        self.assertGreaterEqual(stats['commands']['fetch'], 1)
+        self.assertLessEqual(stats['latency']['fetch']['p50_ms'],
+                             stats['latency']['fetch']['p99_ms'])
+        self.assertGreaterEqual(stats['sessions'], 1)
+        self.assertGreater(stats['storage']['bytes_written'], 0)
+        user_a.close()
+
+    def test_iter_all_matches_retrieve_all(self):
+        """Test that streaming the history yields what retrieve_all returns."""
+        user_a = DirectMessenger('127.0.0.1', 'A', '123')
+        user_a.send_many([(f'stream_{i}', 'B') for i in range(20)])
+        streamed = list(user_a.iter_all(chunk_size=64))
+        self.assertEqual(streamed, user_a.retrieve_all())
+        self.assertEqual(user_a.response.type, 'ok')
+        for msg in user_a.iter_all():
+            break
+        self.assertTrue(user_a.retrieve_all())
+        user_a.close()
+
+    def test_retrieve_conversation(self):
+        """Test that a conversation fetch returns only that peer and direction."""
+        user_b = DirectMessenger('127.0.0.1', 'B', '456')
+        user_c = DirectMessenger('127.0.0.1', 'C_conv', '789')
+        user_a = DirectMessenger('127.0.0.1', 'A', '123')
+        start = time.time()
+        user_b.send_many([('conv_b', 'A')])
+        user_c.send_many([('conv_c', 'A')])
+        user_a.send_many([('conv_reply', 'B')])
+        with_b = user_a.retrieve_conversation('B', start=start)
+        self.assertEqual([m.message for m in with_b], ['conv_b', 'conv_reply'])
+        received = user_a.retrieve_conversation('B', direction='received', start=start)
+        self.assertEqual([m.message for m in received], ['conv_b'])
+        self.assertEqual([m.message for m in user_a.retrieve_conversation('C_conv')], ['conv_c'])
+        self.assertEqual(user_a.retrieve_conversation('B', end=0), [])
+        for user in (user_b, user_c, user_a):
+            user.close()
+        Path('C_conv_notebook.json').unlink(missing_ok=True)
+
     def test_init_sets_attributes(self):
         """Test that initialization sets attributes correctly."""
         user_a = DirectMessenger('127.0.0.1', 'A', '123')
@@ -88,6 +277,31 @@ class TestDSMessenger(unittest.TestCase):
         self.assertIn('test message', user_b.notebook.chats['B'])
         user_b.close()
 
+    def test_new_messages_returned_once(self):
+        """Test that repeated unread messages are dropped by id without keeping every id."""
+        user_a = DirectMessenger('127.0.0.1', 'A', '123')
+        first = [Received('one', 'B', 1.0, 'unread', 1), Received('two', 'B', 2.0, 'unread', 2)]
+        self.assertEqual(user_a._new_messages(first), first)
+        again = user_a._new_messages(first[1:] + [Received('three', 'B', 3.0, 'unread', 3)])
+        self.assertEqual([m.message for m in again], ['three'])
+        self.assertEqual(user_a._delivered_upto, 3)
+        user_a.close()
+
+    def test_notebook_keeps_chats_in_batches(self):
+        """Test that chats are saved as lists and loaded back as MessageBatch objects."""
+        path = Path('batch_notebook.json')
+        notebook = Notebook('A', '123', '')
+        notebook.add_contact_and_message(str(path), 'B', Received('hi', 'B', 1.0, 'read', 4))
+        notebook.add_contact_and_message(str(path), 'B', Sent('yo', 'B', 2.0, 'sent'))
+        try:
+            loaded = Notebook('A', '123', '')
+            loaded.load(str(path))
+        finally:
+            path.unlink()
+        self.assertIsInstance(loaded.chats['B'], MessageBatch)
+        self.assertEqual(loaded.chats['B'], notebook.chats['B'])
+        self.assertEqual(loaded.chats['B'][1].recipient, 'B')
+
     def test_save_method(self):
         """Test the save method for writing JSON data."""
         user_a = DirectMessenger('127.0.0.1', 'A', '123')
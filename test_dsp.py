@@ -1,14 +1,47 @@
+import io
 import unittest
 import json
 from ds_protocol import (
+    DSPError,
+    LineFramer,
+    MessageFramer,
     auth_request,
     extract_json,
     direct_message_request,
+    direct_message_batch_request,
+    direct_message_multi_request,
     fetch_request,
-    _extract_messages_received,
-    _extract_messages_sent
+    ack_request,
+    subscribe_request,
+    stats_request,
+    is_event,
+    extract_event,
+    compress_frame,
+    read_message,
+    iter_messages,
+    encode_binary,
+    decode_binary,
+    encode_frame,
+    MessageReceived,
+    MessageSent,
+    MessageBatch
 )
 
+
+def _extract_messages_received(json_obj: dict) -> list:
+    """The received messages extract_json makes of a fetch response."""
+    return [m for m in _extract_records(json_obj) if isinstance(m, MessageReceived)]
+
+
+def _extract_messages_sent(json_obj: dict) -> list:
+    """The sent messages extract_json makes of a fetch response."""
+    return [m for m in _extract_records(json_obj) if isinstance(m, MessageSent)]
+
+
+def _extract_records(json_obj: dict) -> MessageBatch:
+    response = dict(json_obj['response'], type='ok')
+    return extract_json(json.dumps({'response': response})).message
+
 class TestDSProtocol(unittest.TestCase):
     def test_auth_request(self):
         req = auth_request("alice", "pw123")
@@ -27,6 +60,127 @@ class TestDSProtocol(unittest.TestCase):
         self.assertIn('"token": "token123"', req)
         self.assertIn('"messages": "all"', req)
 
+    def test_fetch_since_request(self):
+        req = json.loads(fetch_request("token123", since=7))
+        self.assertEqual(req, {"token": "token123", "fetch": {"since": 7}})
+
+    def test_fetch_page_request(self):
+        req = json.loads(fetch_request("token123", limit=50))
+        self.assertEqual(req["fetch"], {"since": 0, "limit": 50})
+
+    def test_fetch_conversation_request(self):
+        req = json.loads(fetch_request("token123", peer="bob", direction="sent", start=1.5))
+        self.assertEqual(req["fetch"], {"since": 0, "peer": "bob", "direction": "sent", "start": 1.5})
+
+    def test_fetch_wait_request(self):
+        req = json.loads(fetch_request("token123", "unread", wait=30))
+        self.assertEqual(req, {"token": "token123", "fetch": "unread", "wait": 30})
+
+    def test_direct_message_batch_requests(self):
+        batch = json.loads(direct_message_batch_request("token123", [("bob", "hi"), ("amy", "yo")], 1))
+        self.assertEqual([(i["recipient"], i["entry"]) for i in batch["directmessage"]],
+                         [("bob", "hi"), ("amy", "yo")])
+        multi = json.loads(direct_message_multi_request("token123", ["bob", "amy"], "hi", 1))
+        self.assertEqual(multi["directmessage"]["recipients"], ["bob", "amy"])
+
+    def test_extract_json_statuses(self):
+        json_msg = '{"response": {"type": "ok", "message": "1 of 2 direct messages sent", "statuses": ["ok", "error"]}}'
+        self.assertEqual(extract_json(json_msg).statuses, ["ok", "error"])
+
+    def test_ack_request(self):
+        req = json.loads(ack_request("token123", upto=7, ids={12, 9}))
+        self.assertEqual(req, {"token": "token123", "ack": {"upto": 7, "ids": [9, 12]}})
+        self.assertEqual(json.loads(ack_request("token123", ids=[3]))["ack"], {"ids": [3]})
+
+    def test_extract_json_message_ids(self):
+        json_msg = '{"response": {"type": "ok", "messages": [{"id": 4, "from": "bob", "message": "hi", "timestamp": 1.0}]}}'
+        self.assertEqual(extract_json(json_msg).message[0].id, 4)
+
+    def test_extract_json_cursor(self):
+        json_msg = '{"response": {"type": "ok", "messages": [], "cursor": 12}}'
+        result = extract_json(json_msg)
+        self.assertEqual(result.message, [])
+        self.assertEqual(result.cursor, 12)
+        self.assertFalse(result.more)
+
+    def test_line_framer_partial_and_pipelined(self):
+        framer = LineFramer()
+        self.assertEqual(framer.feed(b'{"a": 1}\r\n{"b"'), [b'{"a": 1}'])
+        self.assertEqual(framer.feed(b': 2}'), [])
+        self.assertEqual(framer.feed(b'\r\n{"c": 3}\r\n{"d": 4}\r\n'),
+                         [b'{"b": 2}', b'{"c": 3}', b'{"d": 4}'])
+
+    def test_line_framer_too_long(self):
+        framer = LineFramer(max_line=8)
+        framer.feed(b'12345')
+        with self.assertRaises(DSPError):
+            framer.feed(b'67890')
+
+    def test_auth_request_compress(self):
+        req = json.loads(auth_request("alice", "pw123", compress="zlib", threshold=512))
+        self.assertEqual(req["authenticate"]["compress"], {"method": "zlib", "threshold": 512})
+        self.assertNotIn("compress", json.loads(auth_request("alice", "pw123"))["authenticate"])
+
+    def test_read_message_frames_and_lines(self):
+        big = json.dumps({"response": {"type": "ok", "messages": ["x" * 5000]}})
+        frame = compress_frame(big.encode())
+        self.assertLess(len(frame), len(big))
+        stream = io.BufferedReader(io.BytesIO(frame + b'{"a": 1}\r\n' + frame))
+        self.assertEqual(read_message(stream), big)
+        self.assertEqual(read_message(stream), '{"a": 1}\r\n')
+        self.assertEqual(read_message(stream), big)
+        self.assertEqual(read_message(stream), '')
+
+    def test_read_message_truncated_frame(self):
+        stream = io.BufferedReader(io.BytesIO(compress_frame(b'{"a": 1}')[:-2]))
+        with self.assertRaises(DSPError):
+            read_message(stream)
+
+    def test_binary_round_trip(self):
+        value = {"response": {"type": "ok", "messages": [
+            {"message": "h\u00e9 \r\n", "from": "bob", "timestamp": 1.5, "id": 3}],
+            "cursor": None, "more": False, "custom key": [True, False, -7]}}
+        data = encode_binary(value)
+        self.assertLess(len(data), len(json.dumps(value)))
+        self.assertEqual(decode_binary(data), value)
+        with self.assertRaises(DSPError):
+            decode_binary(data[:-1])
+        with self.assertRaises(DSPError):
+            encode_binary({"set": {1, 2}})
+
+    def test_message_framer_mixed(self):
+        framer = MessageFramer()
+        frame = encode_frame({"token": "t", "fetch": "all"})
+        self.assertEqual(framer.feed(b'{"a": 1}\r\n' + frame[:3]), [b'{"a": 1}'])
+        self.assertEqual(framer.feed(frame[3:] + b'{"b": 2}\r\n'),
+                         [{"token": "t", "fetch": "all"}, b'{"b": 2}'])
+        stream = io.BufferedReader(io.BytesIO(frame + b'{"c": 3}\r\n'))
+        self.assertEqual(read_message(stream), {"token": "t", "fetch": "all"})
+        self.assertEqual(read_message(stream), '{"c": 3}\r\n')
+
+    def test_extract_json_and_event_from_dict(self):
+        self.assertEqual(extract_json({"response": {"type": "ok", "message": "hi"}}).message, "hi")
+        event = {"event": {"type": "directmessage", "from": "bob", "message": "hi",
+                           "timestamp": 1.5, "id": 2}}
+        self.assertTrue(is_event(event))
+        self.assertEqual(extract_event(event).id, 2)
+
+    def test_stats_request_and_response(self):
+        self.assertEqual(json.loads(stats_request("token123")),
+                         {"token": "token123", "stats": True})
+        result = extract_json('{"response": {"type": "ok", "message": "", '
+                              '"stats": {"commands": {"fetch": 2}}}}')
+        self.assertEqual(result.stats, {"commands": {"fetch": 2}})
+
+    def test_subscribe_request_and_event(self):
+        self.assertEqual(json.loads(subscribe_request("token123")),
+                         {"token": "token123", "subscribe": True})
+        line = '{"event": {"type": "directmessage", "from": "bob", "message": "hi", "timestamp": 1.5}}'
+        self.assertTrue(is_event(line))
+        self.assertFalse(is_event('{"response": {"type": "ok"}}'))
+        msg = extract_event(line)
+        self.assertEqual((msg.message, msg.from_name, msg.timestamp), ("hi", "bob", 1.5))
+
     def test_extract_json_valid(self):
         json_msg = '{"response": {"type": "ok", "message": "Welcome", "token": "abc"}}'
         result = extract_json(json_msg)
@@ -90,6 +244,78 @@ class TestDSProtocol(unittest.TestCase):
         self.assertEqual(len(received), 1)
         self.assertEqual(len(sent), 1)
     
+    def test_extract_json_keeps_server_order(self):
+        json_msg = json.dumps({"response": {"type": "ok", "messages": [
+            {"message": "a", "recipient": "bob", "timestamp": 1.0, "id": 1},
+            {"message": "b", "from": "bob", "timestamp": 2.0, "id": 2},
+            {"message": "c", "recipient": "eve", "timestamp": 3.0, "id": 3}]}})
+        result = extract_json(json_msg)
+        self.assertEqual([m.message for m in result.message], ["a", "b", "c"])
+        self.assertEqual([type(m).__name__ for m in result.message],
+                         ["MessageSent", "MessageReceived", "MessageSent"])
+
+    def test_iter_messages_streams_in_small_chunks(self):
+        messages = [{"id": i, "message": f"m\u00e9 {i}", "timestamp": float(i),
+                     "from" if i % 2 else "recipient": "bob"} for i in range(1, 50)]
+        line = json.dumps({"response": {"type": "ok", "messages": messages, "cursor": 49,
+                                        "more": False}}).encode() + b'\r\n'
+        stream = io.BufferedReader(io.BytesIO(line + b'{"a": 1}\r\n'))
+        records = iter_messages(stream, chunk_size=5)
+        streamed = []
+        with self.assertRaises(StopIteration) as done:
+            while True:
+                streamed.append(next(records))
+        self.assertEqual(streamed, extract_json(line.decode()).message)
+        self.assertEqual(done.exception.value.cursor, 49)
+        self.assertEqual(read_message(stream), '{"a": 1}\r\n')
+
+    def test_iter_messages_closed_early_and_errors(self):
+        line = json.dumps({"response": {"type": "ok", "messages": [
+            {"id": i, "message": "x", "timestamp": 1.0, "from": "bob"} for i in range(10)]}})
+        stream = io.BufferedReader(io.BytesIO(line.encode() + b'\r\n{"a": 1}\r\n'))
+        records = iter_messages(stream, chunk_size=8)
+        next(records)
+        records.close()
+        self.assertEqual(read_message(stream), '{"a": 1}\r\n')
+        stream = io.BufferedReader(io.BytesIO(b'{"response": {"type": "error", "message": "no"}}\r\n'))
+        with self.assertRaises(StopIteration) as done:
+            next(iter_messages(stream))
+        self.assertEqual(done.exception.value.message, "no")
+        stream = io.BufferedReader(io.BytesIO(b'{"response": {"type": "ok", "messages": [{"id"'))
+        with self.assertRaises(DSPError):
+            list(iter_messages(stream))
+
+    def test_message_records_behave_like_tuples(self):
+        msg = MessageReceived("hi", "bob", 1.5, "unread", id=3)
+        self.assertEqual((msg.from_name, msg.peer, msg[0], len(msg)), ("bob", "bob", "hi", 5))
+        message, peer, timestamp, status, msg_id = msg
+        self.assertEqual((timestamp, status, msg_id), (1.5, "unread", 3))
+        self.assertEqual(msg, ("hi", "bob", 1.5, "unread", 3))
+        self.assertNotEqual(msg, MessageSent("hi", "bob", 1.5, "unread", 3))
+        self.assertIn("sent", MessageSent("hi", recipient="bob", timestamp=1.5, status="sent"))
+        with self.assertRaises(AttributeError):
+            msg.extra = 1
+
+    def test_message_batch_columns(self):
+        result = extract_json(json.dumps({"response": {"type": "ok", "messages": [
+            {"message": "a", "from": "bob", "timestamp": "1", "status": "unread", "id": 1},
+            {"message": "b", "recipient": "bob", "timestamp": 2.0, "status": "sent", "id": 2},
+            {"message": "c", "from": "eve", "timestamp": 3.0}]}}))
+        batch = result.message
+        self.assertIsInstance(batch, MessageBatch)
+        self.assertEqual(batch, [MessageReceived("a", "bob", 1.0, "unread", 1),
+                                 MessageSent("b", "bob", 2.0, "sent", 2),
+                                 MessageReceived("c", "eve", 3.0)])
+        self.assertEqual(batch.peers, ["bob", "eve"])
+        self.assertEqual(list(batch.ids), [1, 2, 0])
+        self.assertEqual(batch[-1].from_name, "eve")
+        self.assertEqual(batch[1:], list(batch)[1:])
+        self.assertEqual(MessageBatch(batch.to_json()), batch)
+        with self.assertRaises(ValueError):
+            MessageBatch([["x", "bob", 1.0, "lost"]])
+        with self.assertRaises(TypeError):
+            MessageBatch(["x"])
+
     def test_extract_json_no_message_or_messages(self):
         # Covers lines 46-53: response with neither 'message' nor 'messages'
         json_msg = '{"response": {"type": "ok"}}'
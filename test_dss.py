@@ -0,0 +1,525 @@
+"""Unit tests for the server storage backends."""
+
+import hashlib
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from ds_storage import (
+    JsonStorage,
+    ShardedStorage,
+    SqliteStorage,
+    Storage,
+    migrate_json_to_sqlite,
+    LOG_PATH,
+    SHARDS_PATH,
+    USERS_PATH
+)
+
+
+class TestJsonStorage(unittest.TestCase):
+    """Unit tests for JsonStorage."""
+
+    def setUp(self):
+        self.store_dir = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(self.store_dir)
+
+    def test_new_user_and_message(self):
+        """Test creating users and sending a message between them."""
+        storage = JsonStorage(self.store_dir)
+        self.assertIsNone(storage.get_or_create_user('A', '123'))
+        self.assertIsNone(storage.get_or_create_user('B', '456'))
+        self.assertEqual(storage.get_or_create_user('A', 'x')['password'], '123')
+        self.assertTrue(storage.send_message('hi', 'A', 'B', '1.0'))
+        self.assertFalse(storage.send_message('hi', 'A', 'nobody', '2.0'))
+        unread = storage.read_unread_messages('B')
+        self.assertEqual(unread, [{'id': 1, 'from': 'A', 'message': 'hi', 'timestamp': 1.0}])
+        # reading changes nothing until the message is acknowledged
+        self.assertEqual(storage.read_unread_messages('B'), unread)
+        self.assertEqual(storage.ack_messages('B', upto=1), 1)
+        self.assertEqual(storage.ack_messages('B', upto=1), 0)
+        self.assertEqual(storage.read_unread_messages('B'), [])
+        self.assertFalse(storage.ack_messages('nobody', upto=1))
+        storage.close()
+
+    def test_send_messages_batch(self):
+        """Test a batch send with an unknown recipient and clamped timestamps."""
+        storage = JsonStorage(self.store_dir)
+        for name in ('A', 'B', 'C'):
+            storage.get_or_create_user(name, '123')
+        statuses = storage.send_messages(
+            'A', [('one', 'B', 5.0), ('two', 'nobody', 5.0), ('three', 'C', 4.0)])
+        self.assertEqual(statuses, [True, False, True])
+        self.assertEqual([(m['message'], m['timestamp']) for m in storage.read_all_messages('A')],
+                         [('one', 5.0), ('three', 5.0)])
+        self.assertEqual(storage.read_unread_messages('C'),
+                         [{'id': 1, 'from': 'A', 'message': 'three', 'timestamp': 5.0}])
+        storage.close()
+        reopened = JsonStorage(self.store_dir)
+        self.assertEqual(len(reopened.read_all_messages('B')), 1)
+        reopened.close()
+
+    def test_filtered_fetch(self):
+        """Test peer, direction and time filters, also after reloading the index."""
+        storage = JsonStorage(self.store_dir)
+        for name in ('A', 'B', 'C'):
+            storage.get_or_create_user(name, '123')
+        storage.send_message('b1', 'B', 'A', 1.0)
+        storage.send_message('c1', 'C', 'A', 2.0)
+        storage.send_message('a1', 'A', 'B', 3.0)
+        storage.send_message('b2', 'B', 'A', 4.0)
+
+        def fetch(*args, **filters):
+            messages, cursor, more = storage.read_messages_since('A', *args, **filters)
+            return [m['message'] for m in messages], cursor, more
+        self.assertEqual(fetch(0, peer='B')[0], ['b1', 'a1', 'b2'])
+        self.assertEqual(fetch(0, peer='B', direction='received')[0], ['b1', 'b2'])
+        self.assertEqual(fetch(0, direction='sent')[0], ['a1'])
+        self.assertEqual(fetch(0, start=2.0, end=4.0)[0], ['c1', 'a1'])
+        self.assertEqual(fetch(0, peer='nobody'), ([], 0, False))
+        page, cursor, more = fetch(0, 1, peer='B')
+        self.assertEqual((page, more), (['b1'], True))
+        self.assertEqual(fetch(cursor, peer='B')[0], ['a1', 'b2'])
+        storage._log.close()
+        storage = JsonStorage(self.store_dir)
+        self.assertEqual(fetch(0, peer='C')[0], ['c1'])
+        storage.close()
+
+    def test_read_messages_since(self):
+        """Test that a cursor fetch returns only messages after the cursor."""
+        storage = JsonStorage(self.store_dir)
+        storage.get_or_create_user('A', '123')
+        storage.get_or_create_user('B', '456')
+        storage.send_message('one', 'A', 'B', '1.0')
+        messages, cursor, more = storage.read_messages_since('B', 0)
+        self.assertEqual([m['message'] for m in messages], ['one'])
+        self.assertFalse(more)
+        self.assertEqual(storage.read_messages_since('B', cursor), ([], cursor, False))
+        storage.send_message('two', 'B', 'A', '2.0')
+        messages, cursor, _ = storage.read_messages_since('B', cursor)
+        self.assertEqual(messages, [{'id': 2, 'recipient': 'A', 'message': 'two', 'timestamp': 2.0}])
+        self.assertFalse(storage.read_messages_since('nobody', 0))
+        storage.close()
+
+    def test_paginated_fetch(self):
+        """Test that pages come back in order and leave the messages unread."""
+        storage = JsonStorage(self.store_dir)
+        storage.get_or_create_user('A', '123')
+        storage.get_or_create_user('B', '456')
+        for i in range(5):
+            storage.send_message(str(i), 'A', 'B', f'{i}.0')
+        pages = []
+        cursor, more = 0, True
+        while more:
+            messages, cursor, more = storage.read_messages_since('B', cursor, 2)
+            pages.append([m['message'] for m in messages])
+        self.assertEqual(pages, [['0', '1'], ['2', '3'], ['4']])
+        self.assertEqual(len(storage.read_unread_messages('B')), 5)
+        self.assertEqual(storage.ack_messages('B', upto=cursor), 5)
+        self.assertEqual(storage.read_unread_messages('B'), [])
+        storage.close()
+
+    def test_timestamps_kept_in_order(self):
+        """Test that legacy string timestamps are parsed and merged into order."""
+        legacy = {'A': {'password': '123', 'bio': {'entry': '', 'timestamp': ''}, 'posts': [],
+                        'messages': [
+                            {'message': 'b', 'recipient': 'B', 'timestamp': '2.5', 'status': 'sent'},
+                            {'message': 'a', 'recipient': 'B', 'timestamp': '1.5', 'status': 'sent'}]},
+                  'B': {'password': '456', 'bio': {'entry': '', 'timestamp': ''}, 'posts': [],
+                        'messages': []}}
+        (self.store_dir / USERS_PATH).write_text(json.dumps(legacy))
+        storage = JsonStorage(self.store_dir)
+        self.assertEqual([(m['message'], m['timestamp']) for m in storage.read_all_messages('A')],
+                         [('a', 1.5), ('b', 2.5)])
+        # a clock that went backwards never puts a message before older ones
+        storage.send_message('c', 'A', 'B', 1.0)
+        self.assertEqual(storage.read_all_messages('A')[-1],
+                         {'id': 3, 'recipient': 'B', 'message': 'c', 'timestamp': 2.5})
+        storage.close()
+
+    def test_replay_log_without_compaction(self):
+        """Test that mutations survive a restart through the log alone."""
+        storage = JsonStorage(self.store_dir)
+        storage.get_or_create_user('A', '123')
+        storage.get_or_create_user('B', '456')
+        storage.send_message('hi', 'A', 'B', '1.0')
+        # simulate a crash: the log is never folded into users.json
+        storage._log.close()
+        with (self.store_dir / USERS_PATH).open() as users_file:
+            self.assertEqual(json.load(users_file), {})
+        reopened = JsonStorage(self.store_dir)
+        self.assertEqual(len(reopened.read_all_messages('A')), 1)
+        self.assertEqual(len(reopened.read_unread_messages('B')), 1)
+        reopened.close()
+
+    def test_batch_send_is_one_log_record(self):
+        """Test that a batch send is logged as one record and replayed all or nothing."""
+        storage = JsonStorage(self.store_dir)
+        for name in ('A', 'B', 'C'):
+            storage.get_or_create_user(name, '123')
+        storage.send_messages('A', [('one', 'B', 1.0), ('two', 'C', 2.0), ('three', 'B', 3.0)])
+        storage._log.close()
+        lines = (self.store_dir / LOG_PATH).read_text().splitlines()
+        self.assertEqual(json.loads(lines[-1])['op'], 'messages')
+        self.assertEqual(len(lines), 5)  # header, three users, one batch
+        reopened = JsonStorage(self.store_dir)
+        self.assertEqual(len(reopened.read_all_messages('A')), 3)
+        reopened._log.close()
+        # a torn batch record is dropped as a whole
+        (self.store_dir / USERS_PATH).write_text('{}')
+        header = json.dumps({'op': 'base', 'sha1': hashlib.sha1(b'{}').hexdigest()})
+        (self.store_dir / LOG_PATH).write_text(
+            '\n'.join([header] + lines[1:-1] + [lines[-1][:-20]]))
+        torn = JsonStorage(self.store_dir)
+        self.assertEqual(torn.read_all_messages('A'), [])
+        torn.close()
+
+    def test_compaction_writes_snapshot(self):
+        """Test that compaction folds the log into users.json."""
+        storage = JsonStorage(self.store_dir, compact_every=3)
+        storage.get_or_create_user('A', '123')
+        storage.get_or_create_user('B', '456')
+        storage.send_message('hi', 'A', 'B', '1.0')
+        with (self.store_dir / USERS_PATH).open() as users_file:
+            users = json.load(users_file)
+        self.assertEqual(users['B']['messages'][0]['status'], 'unread')
+        with (self.store_dir / LOG_PATH).open() as log_file:
+            self.assertEqual(len(log_file.readlines()), 1)
+        storage.close()
+
+    def test_stale_log_is_ignored(self):
+        """Test that a log written against an older snapshot is not replayed."""
+        storage = JsonStorage(self.store_dir)
+        storage.get_or_create_user('A', '123')
+        storage.get_or_create_user('B', '456')
+        storage.send_message('hi', 'A', 'B', '1.0')
+        storage._log.sync()
+        stale_log = (self.store_dir / LOG_PATH).read_text()
+        storage.close()
+        # crash after users.json was replaced but before the log was reset
+        (self.store_dir / LOG_PATH).write_text(stale_log)
+        reopened = JsonStorage(self.store_dir)
+        self.assertEqual(len(reopened.read_all_messages('A')), 1)
+        reopened.close()
+
+    def test_empty_unread_does_not_log(self):
+        """Test that fetching with nothing unread appends nothing to the log."""
+        storage = JsonStorage(self.store_dir)
+        storage.get_or_create_user('A', '123')
+        storage.read_unread_messages('A')
+        storage.read_all_messages('A')
+        self.assertEqual(storage._log_records, 1)
+        storage.close()
+
+    def test_unread_queue_rebuilt_on_load(self):
+        """Test that the unread queue is rebuilt from the snapshot and the log."""
+        storage = JsonStorage(self.store_dir)
+        storage.get_or_create_user('A', '123')
+        storage.get_or_create_user('B', '456')
+        storage.send_message('one', 'A', 'B', '1.0')
+        storage.compact()
+        storage.send_message('two', 'A', 'B', '2.0')
+        storage._log.close()
+        reopened = JsonStorage(self.store_dir)
+        self.assertEqual([m['message'] for m in reopened.read_unread_messages('B')],
+                         ['one', 'two'])
+        reopened.send_message('three', 'A', 'B', '3.0')
+        self.assertEqual(len(reopened.read_all_messages('B')), 3)
+        self.assertEqual(reopened.ack_messages('B', ids=[2]), 1)
+        reopened._log.close()
+        # the acknowledgement of a single id is replayed from the log
+        again = JsonStorage(self.store_dir)
+        self.assertEqual([m['message'] for m in again.read_unread_messages('B')],
+                         ['one', 'three'])
+        self.assertEqual([m['message'] for m in again.read_unread_messages('B', after=1)],
+                         ['three'])
+        again.close()
+
+    def test_sessions_in_memory(self):
+        """Test that a store only one process opens keeps session tokens in memory."""
+        storage = JsonStorage(self.store_dir)
+        storage.save_session('t1', 'A')
+        storage.save_session('t2', 'B')
+        self.assertEqual(storage.get_session('t1'), 'A')
+        storage.delete_session('t1')
+        self.assertIsNone(storage.get_session('t1'))
+        storage.clear_sessions()
+        self.assertIsNone(storage.get_session('t2'))
+        storage.close()
+
+    def test_storage_is_abstract(self):
+        """Test that a backend missing part of the interface cannot be created."""
+        with self.assertRaises(TypeError):
+            Storage()
+
+        class Partial(Storage):
+            def get_user(self, username):
+                return None
+
+        with self.assertRaises(TypeError):
+            Partial()
+
+    def test_group_commit_modes(self):
+        """Test that every durability mode persists commits and reports stats."""
+        for durability in ('commit', 'batch', 'os'):
+            store_dir = self.store_dir / durability
+            storage = JsonStorage(store_dir, durability=durability)
+            storage.get_or_create_user('A', '123')
+            storage.get_or_create_user('B', '456')
+            threads = [threading.Thread(target=storage.send_message,
+                                        args=(str(i), 'A', 'B', float(i)))
+                       for i in range(20)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            stats = storage.commit_stats()
+            self.assertEqual(stats['durability'], durability)
+            if durability != 'os':
+                self.assertEqual(stats['commits'], 22)
+            if durability == 'commit':
+                self.assertEqual(stats['batches'], 22)
+            storage._log.close()  # no compaction: everything comes from the log
+            reopened = JsonStorage(store_dir)
+            self.assertEqual(len(reopened.read_unread_messages('B')), 20)
+            reopened.close()
+
+
+class TestShardedStorage(unittest.TestCase):
+    """Unit tests for ShardedStorage."""
+
+    def setUp(self):
+        self.store_dir = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(self.store_dir)
+
+    def test_one_file_per_user(self):
+        """Test that each user is persisted to its own file."""
+        storage = ShardedStorage(self.store_dir)
+        storage.get_or_create_user('A', '123')
+        storage.get_or_create_user('B/C', '456')
+        storage.send_message('hi', 'A', 'B/C', '1.0')
+        names = sorted(p.name for p in (self.store_dir / SHARDS_PATH).iterdir())
+        self.assertEqual(names, ['A.json', 'B%2FC.json'])
+        reopened = ShardedStorage(self.store_dir)
+        self.assertEqual(reopened.read_unread_messages('B/C'),
+                         [{'id': 1, 'from': 'A', 'message': 'hi', 'timestamp': 1.0}])
+
+    def test_splits_existing_users_json(self):
+        """Test that an existing users.json is split into shards."""
+        storage = JsonStorage(self.store_dir)
+        storage.get_or_create_user('A', '123')
+        storage.get_or_create_user('B', '456')
+        storage.send_message('hi', 'A', 'B', '1.0')
+        storage.close()
+        sharded = ShardedStorage(self.store_dir)
+        self.assertEqual(sharded.get_user('A')['password'], '123')
+        self.assertEqual(len(sharded.read_all_messages('B')), 1)
+
+    def test_interrupted_split_is_redone(self):
+        """Test that a half-written split of users.json is discarded and done again."""
+        storage = JsonStorage(self.store_dir)
+        storage.get_or_create_user('A', '123')
+        storage.get_or_create_user('B', '456')
+        storage.close()
+        partial = self.store_dir / (SHARDS_PATH + '.tmp')
+        partial.mkdir()
+        (partial / 'A.json').write_text('{"password": "1')
+        sharded = ShardedStorage(self.store_dir)
+        self.assertFalse(partial.exists())
+        self.assertEqual(sharded.get_user('A')['password'], '123')
+        self.assertEqual(sharded.get_user('B')['password'], '456')
+
+    def test_locks_of_unknown_users_are_dropped(self):
+        """Test that looking up users does not leave a lock behind for each of them."""
+        storage = ShardedStorage(self.store_dir)
+        storage.get_or_create_user('A', '123')
+        for i in range(100):
+            self.assertIsNone(storage.get_user(f'nobody{i}'))
+        self.assertEqual(len(storage._locks), 0)
+
+    def test_commit_stats(self):
+        """Test that each user creation and send is counted as a commit."""
+        storage = ShardedStorage(self.store_dir, durability='commit')
+        storage.get_or_create_user('A', '123')
+        storage.get_or_create_user('B', '456')
+        storage.send_messages('A', [('1', 'B', None), ('2', 'B', None)])
+        stats = storage.commit_stats()
+        self.assertEqual(stats['durability'], 'commit')
+        self.assertEqual((stats['commits'], stats['batches']), (3, 3))
+
+    def test_concurrent_opposite_sends(self):
+        """Test that crossing sends between two users neither deadlock nor drop messages."""
+        storage = ShardedStorage(self.store_dir)
+        storage.get_or_create_user('A', '123')
+        storage.get_or_create_user('B', '456')
+
+        def send(sender, recipient):
+            for i in range(50):
+                storage.send_message(str(i), sender, recipient, str(i))
+
+        threads = [threading.Thread(target=send, args=pair)
+                   for pair in [('A', 'B'), ('B', 'A')]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=10)
+        self.assertEqual(len(storage.read_all_messages('A')), 100)
+        self.assertEqual(len(storage.read_all_messages('B')), 100)
+
+
+class TestSqliteStorage(unittest.TestCase):
+    """Unit tests for SqliteStorage and the JSON migrator."""
+
+    def setUp(self):
+        self.store_dir = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(self.store_dir)
+
+    def test_send_and_read(self):
+        """Test users, messages and read status in SQLite."""
+        storage = SqliteStorage(self.store_dir)
+        self.assertIsNone(storage.get_or_create_user('A', '123'))
+        self.assertIsNone(storage.get_or_create_user('B', '456'))
+        self.assertEqual(storage.get_or_create_user('B', 'x')['password'], '456')
+        self.assertFalse(storage.send_message('hi', 'A', 'nobody', '1.0'))
+        self.assertTrue(storage.send_message('hi', 'A', 'B', '1748448997.321911'))
+        self.assertTrue(storage.send_message('yo', 'B', 'A', '1748448998.5'))
+        self.assertEqual(storage.read_all_messages('A'), [
+            {'id': 1, 'recipient': 'B', 'message': 'hi', 'timestamp': 1748448997.321911},
+            {'id': 4, 'from': 'B', 'message': 'yo', 'timestamp': 1748448998.5}])
+        self.assertEqual(len(storage.read_unread_messages('A')), 1)
+        self.assertEqual(storage.read_unread_messages('B'),
+                         [{'id': 2, 'from': 'A', 'message': 'hi', 'timestamp': 1748448997.321911}])
+        self.assertEqual(storage.read_unread_messages('B', after=2), [])
+        self.assertEqual(storage.ack_messages('B', ids=[2]), 1)
+        self.assertEqual(storage.ack_messages('A', upto=4), 1)
+        self.assertEqual(storage.read_unread_messages('A'), [])
+        self.assertEqual(storage.read_unread_messages('B'), [])
+        self.assertFalse(storage.read_unread_messages('nobody'))
+        self.assertFalse(storage.ack_messages('nobody', upto=1))
+        storage.close()
+
+    def test_send_messages_batch(self):
+        """Test that a batch send stores the known recipients in one transaction."""
+        storage = SqliteStorage(self.store_dir)
+        for name in ('A', 'B', 'C'):
+            storage.get_or_create_user(name, '123')
+        statuses = storage.send_messages(
+            'A', [('one', 'B', 5.0), ('two', 'nobody', 5.0), ('three', 'C', 4.0)])
+        self.assertEqual(statuses, [True, False, True])
+        self.assertEqual([(m['message'], m['timestamp']) for m in storage.read_all_messages('A')],
+                         [('one', 5.0), ('three', 5.0)])
+        self.assertEqual(storage.send_messages('nobody', [('x', 'B', None)]), [False])
+        storage.close()
+
+    def test_commit_stats(self):
+        """Test that each write transaction is counted as a commit, and reads are not."""
+        storage = SqliteStorage(self.store_dir, durability='os')
+        storage.get_or_create_user('A', '123')
+        storage.get_or_create_user('A', '123')
+        storage.get_or_create_user('B', '456')
+        storage.send_messages('A', [('1', 'B', None), ('2', 'B', None)])
+        storage.ack_messages('B', upto=2)
+        storage.read_all_messages('B')
+        stats = storage.commit_stats()
+        self.assertEqual(stats['durability'], 'os')
+        self.assertEqual(stats['commits'], 4)
+        storage.close()
+
+    def test_sessions_shared_between_connections(self):
+        """Test that a token saved by one storage object is seen by another."""
+        first = SqliteStorage(self.store_dir)
+        second = SqliteStorage(self.store_dir)
+        first.save_session('tok', 'A')
+        self.assertEqual(second.get_session('tok'), 'A')
+        second.delete_session('tok')
+        self.assertIsNone(first.get_session('tok'))
+        first.save_session('other', 'B')
+        first.clear_sessions()
+        self.assertIsNone(second.get_session('other'))
+        first.close()
+        second.close()
+
+    def test_filtered_fetch(self):
+        """Test peer, direction and time filters against the SQLite indexes."""
+        storage = SqliteStorage(self.store_dir)
+        for name in ('A', 'B', 'C'):
+            storage.get_or_create_user(name, '123')
+        storage.send_message('b1', 'B', 'A', 1.0)
+        storage.send_message('c1', 'C', 'A', 2.0)
+        storage.send_message('a1', 'A', 'B', 3.0)
+        storage.send_message('b2', 'B', 'A', 4.0)
+
+        def fetch(*args, **filters):
+            messages, cursor, more = storage.read_messages_since('A', *args, **filters)
+            return [m['message'] for m in messages], cursor, more
+        self.assertEqual(fetch(0, peer='B')[0], ['b1', 'a1', 'b2'])
+        self.assertEqual(fetch(0, peer='B', direction='received')[0], ['b1', 'b2'])
+        self.assertEqual(fetch(0, direction='sent')[0], ['a1'])
+        self.assertEqual(fetch(0, start=2.0, end=4.0)[0], ['c1', 'a1'])
+        self.assertEqual(fetch(0, peer='nobody'), ([], 0, False))
+        page, cursor, more = fetch(0, 1, peer='B')
+        self.assertEqual((page, more), (['b1'], True))
+        self.assertEqual(fetch(cursor, peer='B')[0], ['a1', 'b2'])
+        storage.close()
+
+    def test_read_messages_since(self):
+        """Test cursor fetches against the message row ids."""
+        storage = SqliteStorage(self.store_dir)
+        storage.get_or_create_user('A', '123')
+        storage.get_or_create_user('B', '456')
+        storage.send_message('one', 'A', 'B', '1.0')
+        messages, cursor, _ = storage.read_messages_since('B', 0)
+        self.assertEqual([m['message'] for m in messages], ['one'])
+        self.assertEqual(messages[0]['id'], cursor)
+        self.assertEqual(storage.read_messages_since('B', cursor), ([], cursor, False))
+        storage.send_message('two', 'A', 'B', '2.0')
+        messages, _, _ = storage.read_messages_since('B', cursor)
+        self.assertEqual([m['message'] for m in messages], ['two'])
+        storage.close()
+
+    def test_paginated_fetch(self):
+        """Test that pages come back in order and leave the messages unread."""
+        storage = SqliteStorage(self.store_dir)
+        storage.get_or_create_user('A', '123')
+        storage.get_or_create_user('B', '456')
+        for i in range(5):
+            storage.send_message(str(i), 'A', 'B', f'{i}.0')
+        pages = []
+        cursor, more = 0, True
+        while more:
+            messages, cursor, more = storage.read_messages_since('B', cursor, 2)
+            pages.append([m['message'] for m in messages])
+        self.assertEqual(pages, [['0', '1'], ['2', '3'], ['4']])
+        self.assertEqual(len(storage.read_unread_messages('B')), 5)
+        self.assertEqual(storage.ack_messages('B', upto=cursor), 5)
+        self.assertEqual(storage.read_unread_messages('B'), [])
+        storage.close()
+
+    def test_migrate_from_json(self):
+        """Test that the migrator copies users, logged messages and status."""
+        source = JsonStorage(self.store_dir)
+        source.get_or_create_user('A', '123')
+        source.get_or_create_user('B', '456')
+        source.send_message('hi', 'A', 'B', '1.0')
+        source.send_message('yo', 'B', 'A', '2.0')
+        source.ack_messages('A', upto=2)
+        source._log.close()  # leave the messages in the log only
+        self.assertEqual(migrate_json_to_sqlite(self.store_dir), 2)
+        storage = SqliteStorage(self.store_dir)
+        self.assertEqual(storage.get_user('A')['password'], '123')
+        self.assertEqual(storage.read_unread_messages('A'), [])
+        self.assertEqual([(m['from'], m['message'], m['timestamp'])
+                          for m in storage.read_unread_messages('B')], [('A', 'hi', 1.0)])
+        storage.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,324 @@
+"""Unit tests for DSUServer and its server modes."""
+
+import asyncio
+import json
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from ds_protocol import (auth_request, direct_message_request, extract_event, extract_json,
+                         fetch_request, is_event, read_message, stats_request,
+                         subscribe_request)
+from ds_storage import JsonStorage
+from server import AsyncDSUServer, ClientSession, DSUServer, BUSY_REPLY
+
+SERVER_PATH = Path(__file__).resolve().parent / 'server.py'
+
+
+def _command(**fields):
+    return json.dumps(fields)
+
+
+class LiveServerTestCase(unittest.TestCase):
+    """Runs server.py with the given options in a temporary store for each test."""
+
+    def setUp(self):
+        self.workdir = Path(tempfile.mkdtemp())
+        self.process = None
+        self.sockets = []
+
+    def tearDown(self):
+        self.stop()
+        shutil.rmtree(self.workdir)
+
+    def stop(self):
+        """Close the connections and interrupt the server."""
+        for sock in self.sockets:
+            sock.close()
+        self.sockets = []
+        if self.process:
+            self.process.send_signal(signal.SIGINT)
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+            self.process.stdout.close()
+            self.process = None
+
+    def start(self, *options):
+        """Start server.py on a free port and wait until it accepts connections."""
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            self.port = sock.getsockname()[1]
+        self.process = subprocess.Popen(
+            [sys.executable, str(SERVER_PATH), str(self.port), '--log-level', 'WARNING',
+             *options],
+            cwd=self.workdir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+                time.sleep(0.2)  # let the server see the probe go away
+                return
+            except OSError:
+                time.sleep(0.05)
+        self.fail('server.py did not start listening')
+
+    def connect(self):
+        """Open a connection; return the socket and a buffered reader of it."""
+        sock = socket.create_connection(('127.0.0.1', self.port), timeout=5)
+        self.sockets.append(sock)
+        return sock, sock.makefile('rb')
+
+    def request(self, connection, request):
+        sock, stream = connection
+        sock.sendall(request.encode() + b'\r\n')
+        return extract_json(read_message(stream))
+
+    def login(self, username):
+        """Connect and authenticate; return the connection and its token."""
+        connection = self.connect()
+        resp = self.request(connection, auth_request(username, 'pw'))
+        self.assertEqual(resp.type, 'ok')
+        return connection, resp.token
+
+
+class TestProcessMessage(unittest.TestCase):
+    """Unit tests for commands executed by DSUServer.process_message."""
+
+    def setUp(self):
+        self.store_dir = Path(tempfile.mkdtemp())
+        self.storage = JsonStorage(self.store_dir)
+        self.server = DSUServer(storage=self.storage)
+
+    def tearDown(self):
+        self.storage.close()
+        shutil.rmtree(self.store_dir)
+
+    def login(self, server, username):
+        session = ClientSession(('127.0.0.1', 0))
+        resp = server.process_message(
+            session, _command(authenticate={'username': username, 'password': 'pw'}))
+        self.assertEqual(resp['response']['type'], 'ok')
+        return session
+
+    def test_directmessage_entry_must_be_text(self):
+        """Test that a non-string entry gets an error response."""
+        session = self.login(self.server, 'A')
+        self.login(self.server, 'B')
+        for entry in (5, {'text': 'hi'}, None):
+            resp = self.server.process_message(session, _command(
+                token=session.token,
+                directmessage={'entry': entry, 'recipient': 'B', 'timestamp': 1.0}))
+            self.assertEqual(resp['response']['type'], 'error')
+        self.assertEqual(self.storage.read_all_messages('B'), [])
+        self.assertEqual(self.server.stats.snapshot()['errors']['directmessage'], 3)
+
+    def test_token_bound_to_its_connection(self):
+        """Test that a single-process server rejects a token used on another connection."""
+        owner = self.login(self.server, 'A')
+        other = ClientSession(('127.0.0.1', 0))
+        for command in (_command(token=owner.token, stats=True),
+                        _command(token=owner.token, fetch='all')):
+            resp = self.server.process_message(other, command)
+            self.assertEqual(resp['response']['type'], 'error')
+        self.assertIsNone(other.token)
+
+    def test_long_poll_counted_once(self):
+        """Test that an async long-poll fetch woken several times counts as one request."""
+        server = AsyncDSUServer(storage=self.storage)
+        server.executor = ThreadPoolExecutor(2)
+        session = self.login(server, 'A')
+        msg = _command(token=session.token, fetch='unread', wait=1)
+
+        async def poll():
+            waiting = asyncio.ensure_future(server._process_async(session, msg))
+            for _ in range(3):
+                await asyncio.sleep(0.05)
+                server.notifier.notify('A')  # wakes the fetch, which finds nothing
+            return await waiting
+
+        try:
+            resp = asyncio.run(poll())
+        finally:
+            server.executor.shutdown()
+        self.assertEqual(resp['response']['messages'], [])
+        self.assertEqual(server.stats.snapshot()['commands']['fetch'], 1)
+
+
+class TestServerModes(LiveServerTestCase):
+    """Live tests that every server mode must pass alike."""
+
+    def test_blank_lines_are_skipped(self):
+        """Test that blank lines between commands are ignored rather than closing the connection."""
+        for mode in ('threaded', 'async'):
+            with self.subTest(mode=mode):
+                self.start('--mode', mode)
+                sock, stream = connection = self.connect()
+                sock.sendall(b'\r\n\n' + auth_request('A', 'pw').encode() + b'\r\n\r\n')
+                resp = extract_json(read_message(stream))
+                self.assertEqual(resp.type, 'ok')
+                self.assertEqual(self.request(connection, stats_request(resp.token)).type, 'ok')
+                self.stop()
+
+
+class TestThreadedServer(LiveServerTestCase):
+    """Live tests of the worker pool, connection limit and idle reaper of DSUServer."""
+
+    def test_more_connections_than_workers(self):
+        """Test that subscribed connections do not keep workers from other clients."""
+        self.start('--workers', '2')
+        for username in ('A', 'B'):
+            connection, token = self.login(username)
+            self.assertEqual(self.request(connection, subscribe_request(token)).type, 'ok')
+        started = time.monotonic()
+        self.login('C')
+        self.assertLess(time.monotonic() - started, 2)
+
+    def test_long_poll_holds_no_worker(self):
+        """Test that a waiting long-poll fetch leaves the only worker to other clients."""
+        self.start('--workers', '1')
+        poller, token = self.login('A')
+        sender, sender_token = self.login('B')
+        poller[0].sendall(fetch_request(token, 'unread', wait=10).encode() + b'\r\n')
+        time.sleep(0.2)
+        resp = self.request(sender, direct_message_request(sender_token, 'A', 'hi', '1'))
+        self.assertEqual(resp.type, 'ok')
+        started = time.monotonic()
+        resp = extract_json(read_message(poller[1]))
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual([msg.message for msg in resp.message], ['hi'])
+
+    def test_connection_limit_rejects_with_busy(self):
+        """Test that connections past max_connections get the busy reply and are closed."""
+        self.start('--max-connections', '2')
+        self.login('A')
+        self.login('B')
+        _, stream = self.connect()
+        self.assertEqual(read_message(stream), BUSY_REPLY.decode())
+        self.assertEqual(read_message(stream), '')
+
+    def test_connection_admitted_after_close(self):
+        """Test that closing a connection frees its place under max_connections."""
+        self.start('--max-connections', '1')
+        (sock, _), _ = self.login('A')
+        sock.close()
+        time.sleep(0.2)
+        self.login('B')
+
+    def test_stalled_subscriber_does_not_block_senders(self):
+        """Test that pushes to a subscriber that stops reading never hold up its senders."""
+        self.start()
+        subscriber = socket.socket()
+        subscriber.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        subscriber.connect(('127.0.0.1', self.port))
+        self.sockets.append(subscriber)
+        stalled = (subscriber, subscriber.makefile('rb'))
+        token = self.request(stalled, auth_request('A', 'pw')).token
+        self.assertEqual(self.request(stalled, subscribe_request(token)).type, 'ok')
+        sender, sender_token = self.login('B')
+        entry = 'x' * 100000
+        for _ in range(60):  # far more than the socket buffers and MAX_OUTBOUND_BYTES
+            started = time.monotonic()
+            resp = self.request(sender, direct_message_request(sender_token, 'A', entry, '1'))
+            self.assertEqual(resp.type, 'ok')
+            self.assertLess(time.monotonic() - started, 2)
+
+    def test_idle_reaper(self):
+        """Test that silent connections are closed unless they are subscribed."""
+        self.start('--idle-timeout', '1')
+        (_, idle), _ = self.login('A')
+        subscribed, token = self.login('B')
+        self.request(subscribed, subscribe_request(token))
+        self.assertEqual(read_message(idle), '')  # closed within the socket timeout
+        sender, sender_token = self.login('C')
+        self.request(sender, direct_message_request(sender_token, 'B', 'still here', '1'))
+        self.assertIn('still here', read_message(subscribed[1]))
+
+
+class TestAsyncServer(LiveServerTestCase):
+    """Live tests of the commands served by AsyncDSUServer (--mode async)."""
+
+    def setUp(self):
+        super().setUp()
+        self.start('--mode', 'async')
+
+    def test_authenticate(self):
+        """Test new and returning users and a wrong password."""
+        self.login('A')
+        connection = self.connect()
+        self.assertEqual(self.request(connection, auth_request('A', 'pw')).message,
+                         'Welcome back, A!')
+        self.assertEqual(self.request(self.connect(), auth_request('A', 'wrong')).type, 'error')
+
+    def test_send_and_fetch(self):
+        """Test that a direct message is fetched as unread, then with the whole history."""
+        receiver, token = self.login('A')
+        sender, sender_token = self.login('B')
+        resp = self.request(sender, direct_message_request(sender_token, 'A', 'hi', '1'))
+        self.assertEqual(resp.type, 'ok')
+        unread = self.request(receiver, fetch_request(token, 'unread'))
+        self.assertEqual([(m.message, m.from_name) for m in unread.message], [('hi', 'B')])
+        history = self.request(sender, fetch_request(sender_token, 'all'))
+        self.assertEqual([(m.message, m.recipient) for m in history.message], [('hi', 'A')])
+
+    def test_long_poll_wait(self):
+        """Test that a waiting fetch returns when a message arrives, or empty at its timeout."""
+        receiver, token = self.login('A')
+        sender, sender_token = self.login('B')
+        started = time.monotonic()
+        self.assertEqual(self.request(receiver, fetch_request(token, 'unread', wait=0.5)).message, [])
+        self.assertGreaterEqual(time.monotonic() - started, 0.4)
+        receiver[0].sendall(fetch_request(token, 'unread', wait=10).encode() + b'\r\n')
+        time.sleep(0.2)
+        self.request(sender, direct_message_request(sender_token, 'A', 'wake up', '1'))
+        started = time.monotonic()
+        resp = extract_json(read_message(receiver[1]))
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual([m.message for m in resp.message], ['wake up'])
+
+    def test_subscribe_events(self):
+        """Test that messages to a subscribed connection are pushed as events."""
+        receiver, token = self.login('A')
+        sender, sender_token = self.login('B')
+        self.assertEqual(self.request(receiver, subscribe_request(token)).type, 'ok')
+        self.request(sender, direct_message_request(sender_token, 'A', 'pushed', '1'))
+        line = read_message(receiver[1])
+        self.assertTrue(is_event(line))
+        event = extract_event(line)
+        self.assertEqual((event.message, event.from_name), ('pushed', 'B'))
+
+
+class TestMultiProcessServer(LiveServerTestCase):
+    """Live tests of --processes with the shared SQLite store."""
+
+    def test_token_used_in_another_process(self):
+        """Test that a token issued by one process is accepted by another."""
+        self.start('--processes', '2', '--storage', 'sqlite')
+        first, token = self.login('A')
+        self.login('B')
+        issued_by = self.request(first, stats_request(token)).stats['pid']
+        for _ in range(50):
+            other = self.connect()
+            resp = self.request(other, stats_request(token))
+            self.assertEqual(resp.type, 'ok')
+            if resp.stats['pid'] != issued_by:
+                break
+        else:
+            self.fail('every connection landed in the process that issued the token')
+        resp = self.request(other, direct_message_request(token, 'B', 'across', '1'))
+        self.assertEqual(resp.type, 'ok')
+        history = self.request(first, fetch_request(token, 'all'))
+        self.assertEqual([m.message for m in history.message], ['across'])
+        self.assertEqual(self.request(self.connect(), stats_request('not-a-token')).type, 'error')
+
+
+if __name__ == '__main__':
+    unittest.main()